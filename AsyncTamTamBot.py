@@ -0,0 +1,335 @@
+# -*- coding: UTF-8 -*-
+import asyncio
+import contextvars
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+from openapi_client import Update, MessageCreatedUpdate, MessageCallbackUpdate, NewMessageBody, ChatType, SendMessageResult
+from openapi_client.rest import ApiException
+from ttgb_cmn.cmn import Utils
+from ttgb_cmn.lng import get_text as _, translation_activate
+
+from .TamTamBot import TamTamBot
+from .cls import UpdateCmn
+from .cls.AsyncApiAdapter import AsyncApiAdapter
+from .cls.cmn import TimeStat
+
+# Язык обрабатываемого обновления - для активации перевода в потоках пула
+update_language = contextvars.ContextVar('update_language', default=None)
+
+
+# noinspection PyBroadException
+class AsyncTamTamBot(TamTamBot):
+    # Вариант бота на asyncio. Обновления обрабатываются задачами цикла событий, число одновременно
+    # обрабатываемых обновлений ограничено TT_BOT_ASYNC_MAX_IN_FLIGHT.
+    # Обработчики (cmd_handler_*, handle_*) могут быть как корутинами, так и обычными методами -
+    # последние выполняются в пуле потоков, как и блокирующие вызовы openapi_client.
+    # Для вызова API из корутин предназначены self.amsg, self.achats, self.aapi, self.aupload.
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(self.async_executor_max_workers(), 'async-exec')
+        super(AsyncTamTamBot, self).__init__()
+
+        self.amsg = AsyncApiAdapter(self.msg, self.executor)
+        self.achats = AsyncApiAdapter(self.chats, self.executor)
+        self.aapi = AsyncApiAdapter(self.api, self.executor)
+        self.aupload = AsyncApiAdapter(self.upload, self.executor)
+        self.asubscriptions = AsyncApiAdapter(self.subscriptions, self.executor)
+
+        self.in_flight_max = Utils.str_to_int(os.environ.get('TT_BOT_ASYNC_MAX_IN_FLIGHT')) or 10000
+        self.in_flight = 0
+        self.processed = 0
+        self.handle_stat = TimeStat()
+        self._in_flight_sem = None
+        self._lanes = {}
+        self._tasks = set()  # Ссылки на выполняющиеся задачи, чтобы их не удалил сборщик мусора
+
+    @staticmethod
+    def async_executor_max_workers():
+        # type: () -> int
+        return Utils.str_to_int(os.environ.get('TT_BOT_ASYNC_EXECUTOR_MAX_WORKERS')) or 64
+
+    def stats(self):
+        # type: () -> dict
+        return {'in_flight': self.in_flight, 'in_flight_max': self.in_flight_max, 'processed': self.processed, 'handle': self.handle_stat.as_dict()}
+
+    async def run_sync(self, func, *args, **kwargs):
+        # Выполнение блокирующего вызова в пуле потоков с сохранением контекста
+        loop = asyncio.get_running_loop()
+        ctx = contextvars.copy_context()
+        return await loop.run_in_executor(self.executor, functools.partial(ctx.run, func, *args, **kwargs))
+
+    @staticmethod
+    def _run_with_language(language, func, *args):
+        translation_activate(language)
+        return func(*args)
+
+    async def call_handler(self, handler, update):
+        # Вызов обработчика: корутина ожидается, обычный метод выполняется в пуле потоков
+        if asyncio.iscoroutinefunction(handler):
+            return await handler(update)
+        language = update_language.get()
+        if language:
+            return await self.run_sync(self._run_with_language, language, handler, update)
+        return await self.run_sync(handler, update)
+
+    def get_update_handler_async(self, update):
+        # Если обработчик типа обновления не переопределён в наследнике, то используется его асинхронная версия
+        handler = self.get_update_handler(update)
+        if handler:
+            name = handler.__name__
+            handler_async = getattr(self, '%s_async' % name, None)
+            if handler_async and getattr(type(self), name) is getattr(AsyncTamTamBot, name, None):
+                return handler_async
+        return handler
+
+    def _lane_acquire(self, key):
+        # type: (object) -> asyncio.Lock or None
+        # Полоса - блокировка, общая для обновлений с одинаковым ключом, и счётчик её пользователей
+        if key is None:
+            return None
+        lane = self._lanes.get(key)
+        if lane is None:
+            lane = [asyncio.Lock(), 0]
+            self._lanes[key] = lane
+        lane[1] += 1
+        return lane[0]
+
+    def _lane_release(self, key):
+        # type: (object) -> None
+        lane = self._lanes.get(key)
+        if lane is not None:
+            lane[1] -= 1
+            if lane[1] <= 0:
+                self._lanes.pop(key)
+
+    async def _handle_update_task(self, update, key=None):
+        # type: (Update, object) -> None
+        lock = self._lane_acquire(key)
+        ts = time()
+        try:
+            if lock:
+                async with lock:
+                    await self.handle_update_async(update)
+            else:
+                await self.handle_update_async(update)
+        finally:
+            if lock:
+                self._lane_release(key)
+            self.handle_stat.add(time() - ts)
+            self.in_flight -= 1
+            self.processed += 1
+            self._in_flight_sem.release()
+
+    async def dispatch_async(self, update):
+        # type: (Update) -> asyncio.Task
+        if self._in_flight_sem is None:
+            self._in_flight_sem = asyncio.Semaphore(self.in_flight_max)
+        await self._in_flight_sem.acquire()
+        self.in_flight += 1
+        task = asyncio.create_task(self._handle_update_task(update, self.dispatch_key(update)))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def polling(self):
+        asyncio.run(self.polling_async())
+
+    async def polling_async(self):
+        self.lgz.info('Start (asyncio). Press Ctrl-Break for stopping.')
+        marker = None
+        while not self.stop_polling:
+            try:
+                await self.run_sync(self.before_polling_update_list)
+                self.lgz.debug('Update request')
+                params = self.polling_tuner.request_params()
+                if marker:
+                    ul = await self.asubscriptions.get_updates(marker=marker, types=Update.update_types, **params)
+                else:
+                    ul = await self.asubscriptions.get_updates(types=Update.update_types, **params)
+                self.lgz.debug('Update request completed. Marker=%s' % marker)
+                marker = ul.marker
+                slt = self.polling_tuner.on_updates(ul.updates)
+                if ul.updates:
+                    await self.run_sync(self.after_polling_update_list, True)
+                    self.lgz.info('There are %s updates' % len(ul.updates))
+                    for update in ul.updates:
+                        await self.dispatch_async(update)
+                    self.lgz.info('Async state: %s; polling state: %s' % (self.stats(), self.polling_tuner.stats()))
+                else:
+                    await self.run_sync(self.after_polling_update_list)
+                    self.lgz.debug('No updates...')
+                if slt:
+                    self.lgz.debug('Pause for %s seconds' % slt)
+                    await asyncio.sleep(slt)
+
+            except ApiException as err:
+                if str(err.body).lower().find('Invalid access_token'):
+                    raise
+            except Exception:
+                self.lgz.exception('Exception')
+                slt = self.polling_tuner.on_error()
+                self.lgz.warning('Pause for %s seconds because there was an error' % slt)
+                await asyncio.sleep(slt)
+        self.lgz.info('Stopping')
+
+    # Обработка тела запроса (для асинхронных веб-серверов)
+    async def handle_request_body_async(self, request_body):
+        # type: (bytes) -> None
+        incoming_data = None
+        try:
+            if request_body:
+                request_body = await self.run_sync(self.before_handle_request_body, request_body)
+                incoming_data = self.deserialize_update(request_body)
+                if incoming_data:
+                    incoming_data = await self.run_sync(self.after_handle_request_body, incoming_data)
+                    if isinstance(incoming_data, Update):
+                        if not self.update_is_service(UpdateCmn.get(incoming_data, self)):
+                            await (await self.dispatch_async(incoming_data))
+                        else:
+                            self.lgz.debug('This update is service - passed')
+        except Exception as e:
+            self.lgz.exception('Exception')
+            if isinstance(incoming_data, Update):
+                await self.run_sync(self.send_error_message, UpdateCmn.get(incoming_data, self), e)
+
+    async def handle_update_async(self, update):
+        # type: (Update) -> bool
+        try:
+            self.lgz.debug(' -> %s' % type(update))
+            await self.run_sync(self.update_caches_by_update, update)
+            is_command = self.update_is_command(update)
+            language = await self.run_sync(self.get_user_language_by_update, update)
+            translation_activate(language)
+            update_language.set(language)
+            try:
+                await self.run_sync(self.before_handle_update, update)
+
+                if is_command:
+                    res = await self.process_command_async(update)
+                elif isinstance(update, MessageCreatedUpdate) and self.update_is_service(UpdateCmn.get(update, self)):
+                    res = False
+                    self.lgz.debug('This update is service - passed')
+                else:
+                    handler = self.get_update_handler_async(update)
+                    if handler:
+                        self.lgz.debug('entry to %s' % handler)
+                        res = await self.call_handler(handler, update)
+                        self.lgz.debug('exit from %s with result=%s' % (handler, res))
+                    else:
+                        res = False
+            finally:
+                await self.run_sync(self.after_handle_update, update)
+                self.polling_tuner.on_handled(update)
+            return res
+        except Exception as e:
+            self.lgz.exception('Exception')
+            await self.run_sync(self.send_error_message, UpdateCmn.get(update, self), e)
+
+    async def call_cmd_handler_async(self, update):
+        # type: (UpdateCmn or Update) -> (bool, bool)
+        handler_exists = False
+        if not isinstance(update, (Update, UpdateCmn)):
+            return False, False
+        if not isinstance(update, UpdateCmn):
+            update = UpdateCmn.get(update, self)
+        if not update.this_cmd_response:
+            handler = self.get_cmd_handler(update)
+            await self.run_sync(self.prev_step_delete, update.index)
+        else:
+            handler = self.get_cmd_handler(update.update_previous)
+        if handler:
+            handler_exists = True
+            self.lgz.debug('Call handler %s.' % handler)
+            res = False
+            if callable(handler):
+                res = await self.call_handler(handler, update)
+            else:
+                self.lgz.debug('Handler %s not callable.' % handler)
+            if update.required_cmd_response and not update.this_cmd_response:
+                await self.run_sync(self.prev_step_write, update.index, update.update_current)
+            elif update.this_cmd_response and (res or res is None) or not update.this_cmd_response:
+                await self.run_sync(self.prev_step_delete, update.index)
+        else:
+            res = False
+        return handler_exists, res
+
+    async def process_command_async(self, update):
+        # type: (Update) -> bool
+        res_w_m = None
+        update = UpdateCmn.get(update, self)
+        try:
+            await self.run_sync(self.set_user_language_by_update, update.update_current, update.user_locale, True)
+            if not update.chat_id:
+                return False
+            if update.cmd_bot and (update.cmd_bot != self.username):
+                self.lgz.debug('The command "%(cmd)s" is not applicable to the current bot "%(bot_c)s", but for bot "%(bot)s".' % {'cmd': update.cmd, 'bot_c': self.username, 'bot': update.cmd_bot})
+                return False
+
+            cmd = update.cmd
+            self.lgz.debug('cmd="%s"; chat_id=%s; user_id=%s' % (update.cmd, update.chat_id, update.user_id))
+
+            if self.waiting_msg and update.chat_type == ChatType.DIALOG:
+                msg_t = (('{%s} ' % self.title) + _('Wait for process your request (%s)...') % cmd) + self.SERVICE_STR_SEQUENCE
+                res_w_m = await self.amsg.send_message(NewMessageBody(msg_t), chat_id=update.chat_id)
+
+            handler_exists, res = await self.call_cmd_handler_async(update)
+            if handler_exists:
+                pass
+            elif update.cmd == '+':
+                res = True
+            elif update.cmd == '-':
+                res = False
+            else:
+                self.lgz.debug('Handler not exists.')
+                if isinstance(update.update_current, MessageCallbackUpdate):
+                    await self.run_sync(self.send_notification, update, _('"%s" is an incorrect command. Please specify.') % cmd)
+                else:
+                    await self.amsg.send_message(NewMessageBody(_('"%s" is an incorrect command. Please specify.') % cmd, link=update.link), chat_id=update.chat_id)
+                res = False
+            return res
+        finally:
+            if isinstance(res_w_m, SendMessageResult):
+                await self.amsg.delete_message(res_w_m.message.body.mid)
+
+    async def handle_message_created_update_async(self, update):
+        # type: (MessageCreatedUpdate) -> bool
+        update = UpdateCmn.get(update, self)
+        # Проверка на ответ команде
+        update_previous = await self.run_sync(self.prev_step_get, update.index)
+        if isinstance(update_previous, Update):
+            self.lgz.debug('Command answer detected (%s).' % update.index)
+            update.this_cmd_response = True
+            update.update_previous = update_previous
+            update_previous = UpdateCmn.get(update_previous, self)
+            res_w_m = None
+            try:
+                if self.waiting_msg and update.chat_type == ChatType.DIALOG:
+                    msg_t = (('{%s} ' % self.title) + _('Wait for process your request (%s)...') % update_previous.cmd) + self.SERVICE_STR_SEQUENCE
+                    res_w_m = await self.amsg.send_message(NewMessageBody(msg_t), chat_id=update.chat_id)
+
+                handler_exists, res = await self.call_cmd_handler_async(update)
+            finally:
+                if isinstance(res_w_m, SendMessageResult):
+                    await self.amsg.delete_message(res_w_m.message.body.mid)
+            return res
+        self.lgz.debug('Trivial message. Not commands answer (%s).' % update.index)
+        return await self.call_handler(self.receive_message, update)
+
+    async def handle_message_callback_update_async(self, update):
+        # type: (MessageCallbackUpdate) -> bool
+        self.register_callback(update)
+
+        if update.callback.payload:
+            self.lgz.debug('MessageCallbackUpdate:\r\n%s' % update.callback.payload)
+            res = await self.process_command_async(update)
+            if res:
+                await self.run_sync(self.delete_message, update.message.body.mid)
+        else:
+            res = await self.run_sync(self.delete_message, update.message.body.mid)
+        return res
+
+    async def handle_bot_started_update_async(self, update):
+        return await self.process_command_async(update)
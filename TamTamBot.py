@@ -1,19 +1,22 @@
 # -*- coding: UTF-8 -*-
+import copy
 import json
-import math
 import os
 import re
 import sqlite3
 import sys
 import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor, Future, FIRST_COMPLETED, wait as futures_wait
 from datetime import datetime
 from datetime import timedelta
-from threading import Thread
-from time import sleep
+from threading import Lock
+from time import sleep, time
 
 import requests
 import six
 import urllib3
+from requests.adapters import HTTPAdapter
 
 from openapi_client import Configuration, Update, ApiClient, SubscriptionsApi, MessagesApi, BotsApi, ChatsApi, \
     UploadApi, MessageCreatedUpdate, MessageCallbackUpdate, BotStartedUpdate, \
@@ -30,7 +33,7 @@ from openapi_client.rest import ApiException, RESTResponse
 from openapi_client.utl import OacUtils
 from ttgb_cmn.cmn import Utils, BotLogger
 from ttgb_cmn.lng import get_text as _, translation_activate
-from .cls import ChatExt, UpdateCmn, CallbackButtonCmd, ChatActionRequestRepeater
+from .cls import ChatExt, UpdateCmn, CallbackButtonCmd, ChatActionScheduler, UpdateDispatcher, PollingTuner, SqliteStorage, UserLanguageCache, UpdateRouter, BoundedStore, ChatMembershipCache, ChatsAdminIndex, PageIterator, MessageCache, ApiRateLimiter, RateLimitedApi, OutboundQueue, AdminAlerter, RateLimiter, BroadcastJournal, MultipartStream, UploadTokenCache, ChunkedUpload, ChunkedUploadError, AttachmentReadiness
 
 
 class TamTamBotException(Exception):
@@ -40,15 +43,44 @@ class TamTamBotException(Exception):
 # noinspection SqlNoDataSourceInspection,SqlDialectInspection,GrazieInspection
 class TamTamBot(object):
     _work_threads_max_count = None
-    threads = []
-    chats_action = {}
-    callbacks_list = {}
+    _work_queue_max_size = None
+    _dispatch_mode = None
+    dispatcher = None
+    dispatcher_lock = Lock()
+    # Общие для всех экземпляров хранилища ограниченного размера (см. BoundedStore)
+    callbacks_list = BoundedStore(Utils.str_to_int(os.environ.get('TT_BOT_CALLBACKS_STORE_SIZE')) or 100000, 3600, name='callbacks_list')
 
-    limited_buttons = {}
+    limited_buttons = BoundedStore(Utils.str_to_int(os.environ.get('TT_BOT_LIMITED_BUTTONS_STORE_SIZE')) or 10000, 7 * 24 * 3600, name='limited_buttons')
 
     SERVICE_STR_SEQUENCE = chr(8203) + chr(8203) + chr(8203)
 
-    last_mcb_update = {}
+    # Режимы распределения обновлений по рабочим потокам (TT_BOT_DISPATCH_MODE):
+    # pool - общая очередь; chat - последовательно в пределах чата; index - в пределах пары чат-пользователь (UpdateCmn.index)
+    DISPATCH_MODE_POOL = 'pool'
+    DISPATCH_MODE_CHAT = 'chat'
+    DISPATCH_MODE_INDEX = 'index'
+
+    # Обработчики обновлений по умолчанию (порядок важен для классов-наследников).
+    # Таблица компилируется однократно для класса бота (см. UpdateRouter); наследники могут дополнять её
+    # декоратором update_handler. Псевдонимы команд задаются в CMD_ALIASES: {'псевдоним': 'команда'}.
+    UPDATE_HANDLERS = [
+        (MessageCreatedUpdate, 'handle_message_created_update'),
+        (MessageCallbackUpdate, 'handle_message_callback_update'),
+        (MessageEditedUpdate, 'handle_message_edited_update'),
+        (MessageRemovedUpdate, 'handle_message_removed_update'),
+        (BotStartedUpdate, 'handle_bot_started_update'),
+        (BotAddedToChatUpdate, 'handle_bot_added_to_chat_update'),
+        (BotRemovedFromChatUpdate, 'handle_bot_removed_from_chat_update'),
+        (UserAddedToChatUpdate, 'handle_user_added_to_chat_update'),
+        (UserRemovedFromChatUpdate, 'handle_user_removed_from_chat_update'),
+        (ChatTitleChangedUpdate, 'handle_chat_title_changed_update'),
+        (MessageChatCreatedUpdate, 'handle_message_chat_created_update'),
+        (MessageConstructionRequest, 'handle_message_construction_request'),
+        (MessageConstructedUpdate, 'handle_message_constructed_update'),
+    ]
+    CMD_ALIASES = {}
+
+    last_mcb_update = BoundedStore(Utils.str_to_int(os.environ.get('TT_BOT_LAST_MCB_STORE_SIZE')) or 100000, 3600, name='last_mcb_update')
 
     lgz = BotLogger.get_instance()
 
@@ -65,19 +97,72 @@ class TamTamBot(object):
 
         self.trace_requests = self.lgz.trace_requests
 
-        self.polling_sleep_time = 5
+        self.polling_sleep_time = 5  # Максимальная пауза после пустого ответа
         self.polling_error_sleep_time = 5
+        self.polling_error_sleep_time_max = 60
+        self.polling_tuner = PollingTuner(
+            Utils.str_to_int(os.environ.get('TT_BOT_POLLING_LIMIT')) or 100, Utils.str_to_int(os.environ.get('TT_BOT_POLLING_TIMEOUT')) or 30,
+            self.polling_sleep_time, self.polling_error_sleep_time, self.polling_error_sleep_time_max
+        )
 
         self.client = ApiClient(self.conf)
-
+        # Общее ограничение частоты запросов к API (запросов в секунду - всего и в один чат) и число параллельных запросов при обходе чатов
+        self.api_limiter = ApiRateLimiter(
+            Utils.str_to_int(os.environ.get('TT_BOT_API_RATE_LIMIT')) or 30,
+            Utils.str_to_int(os.environ.get('TT_BOT_API_CHAT_RATE_LIMIT')) or 5,
+            Utils.str_to_int(os.environ.get('TT_BOT_API_CHAT_BURST')) or 10,
+        )
+        self.api_max_retry = Utils.str_to_int(os.environ.get('TT_BOT_API_MAX_RETRY')) or 5
+        self.chats_fanout_workers = Utils.str_to_int(os.environ.get('TT_BOT_CHATS_FANOUT_WORKERS')) or 8
+        self.pages_prefetch = Utils.get_environ_bool('TT_BOT_PAGES_PREFETCH', True)
+        self.messages_fetch_workers = Utils.str_to_int(os.environ.get('TT_BOT_MESSAGES_FETCH_WORKERS')) or 4
+
+        # Все запросы, кроме получения событий, проходят через общий ограничитель
         self.subscriptions = SubscriptionsApi(self.client)
-        self.msg = MessagesApi(self.client)
-        self.api = BotsApi(self.client)
-        self.chats = ChatsApi(self.client)
-        self.upload = UploadApi(self.client)
+        self.msg = RateLimitedApi(MessagesApi(self.client), self.api_limiter, self.api_max_retry, lgz=self.lgz)  # type: MessagesApi
+        self.api = RateLimitedApi(BotsApi(self.client), self.api_limiter, self.api_max_retry, lgz=self.lgz)  # type: BotsApi
+        self.chats = RateLimitedApi(ChatsApi(self.client), self.api_limiter, self.api_max_retry, chat_id_positional=True, lgz=self.lgz)  # type: ChatsApi
+        self.upload = RateLimitedApi(UploadApi(self.client), self.api_limiter, self.api_max_retry, lgz=self.lgz)  # type: UploadApi
 
         self._languages_dict = None
+        self.chat_cache = ChatMembershipCache(
+            Utils.str_to_int(os.environ.get('TT_BOT_CHAT_CACHE_SIZE')) or 10000,
+            Utils.str_to_int(os.environ.get('TT_BOT_CHAT_CACHE_TTL')) or 300,
+        )
+        self.message_cache = MessageCache(
+            Utils.str_to_int(os.environ.get('TT_BOT_MESSAGE_CACHE_SIZE')) or 10000,
+            Utils.str_to_int(os.environ.get('TT_BOT_MESSAGE_CACHE_TTL')) or 3600,
+        )
+        # Очередь исходящих сообщений: отправка без ожидания ответа сервера, с сохранением порядка в пределах чата
+        self.outbound = OutboundQueue(
+            Utils.str_to_int(os.environ.get('TT_BOT_OUTBOUND_SENDERS')) or 4,
+            Utils.str_to_int(os.environ.get('TT_BOT_OUTBOUND_QUEUE_MAX_SIZE')) or None,
+            Utils.str_to_int(os.environ.get('TT_BOT_OUTBOUND_PUT_TIMEOUT')) or None,
+            lgz=self.lgz,
+        )
+        self._chat_action_scheduler = None
+        self.chat_action_scheduler_lock = Lock()
         self._admins_contacts = None
+        self._upload_session = None
+        self.upload_session_lock = Lock()
+        self.upload_workers = Utils.str_to_int(os.environ.get('TT_BOT_UPLOAD_WORKERS')) or 4
+        # Файлы от TT_BOT_UPLOAD_CHUNKED_THRESHOLD байт загружаются частями по TT_BOT_UPLOAD_CHUNK_SIZE байт с повтором каждой части
+        self.upload_chunk_size = Utils.str_to_int(os.environ.get('TT_BOT_UPLOAD_CHUNK_SIZE')) or 4 * 1024 * 1024
+        self.upload_chunked_threshold = Utils.str_to_int(os.environ.get('TT_BOT_UPLOAD_CHUNKED_THRESHOLD')) or 16 * 1024 * 1024
+        self.upload_chunk_max_retry = Utils.str_to_int(os.environ.get('TT_BOT_UPLOAD_CHUNK_MAX_RETRY')) or 5
+        self.upload_chunk_resumes = Utils.str_to_int(os.environ.get('TT_BOT_UPLOAD_CHUNK_RESUMES')) or 3
+        # Ожидание готовности загруженных вложений перед отправкой сообщения (задержка подстраивается по типу вложения)
+        self.attachment_readiness = AttachmentReadiness(
+            max_delay=Utils.str_to_int(os.environ.get('TT_BOT_ATTACHMENT_MAX_DELAY')) or 30, lgz=self.lgz
+        )
+        self.admin_alerts_timeout = Utils.str_to_int(os.environ.get('TT_BOT_ADMIN_ALERTS_TIMEOUT')) or 5
+        self.admin_alerter = AdminAlerter(
+            self.send_admin_digest,
+            Utils.str_to_int(os.environ.get('TT_BOT_ADMIN_ALERTS_DIGEST_PERIOD')) or 300,
+            Utils.str_to_int(os.environ.get('TT_BOT_ADMIN_ALERTS_FORGET_PERIOD')) or 3600,
+            Utils.str_to_int(os.environ.get('TT_BOT_ADMIN_ALERTS_RATE')) or 1,
+            lgz=self.lgz,
+        )
 
         try:
             self.info = self.api.get_my_info()
@@ -102,9 +187,36 @@ class TamTamBot(object):
 
         self.stop_polling = False
 
+        self.storage = SqliteStorage(self.get_db_path(), lgz=self.lgz)
         self.prev_step_table_name = 'tamtambot_prev_step'
         self.user_prop_table_name = 'tamtambot_user_prop'
+        self.prev_step_lock = Lock()
+        self.prev_step_keys = None
         self.db_prepare()
+        self.prev_step_keys_load()
+        self.broadcast_journal = BroadcastJournal(
+            self.storage, self.user_id, ttl=Utils.str_to_int(os.environ.get('TT_BOT_BROADCAST_JOURNAL_TTL')) or 7 * 86400
+        ) if self.user_id is not None else None
+        self.upload_cache = UploadTokenCache(
+            self.storage, self.user_id, ttl=Utils.str_to_int(os.environ.get('TT_BOT_UPLOAD_CACHE_TTL')) or 86400
+        ) if Utils.get_environ_bool('TT_BOT_UPLOAD_CACHE', True) and self.user_id is not None else None
+        self.broadcast_workers = Utils.str_to_int(os.environ.get('TT_BOT_BROADCAST_WORKERS')) or 8
+        self.broadcast_rate = Utils.str_to_int(os.environ.get('TT_BOT_BROADCAST_RATE')) or 20
+        self.language_cache = UserLanguageCache(
+            self.storage, self.user_prop_table_name,
+            Utils.str_to_int(os.environ.get('TT_BOT_LANGUAGE_CACHE_SIZE')) or 100000,
+            Utils.str_to_int(os.environ.get('TT_BOT_LANGUAGE_CACHE_TTL')) or 3600,
+            lgz=self.lgz,
+        )
+        # Индекс "администратор -> чаты"; отключается через TT_BOT_CHATS_INDEX=False (тогда чаты перебираются через API)
+        # Назначение/снятие администраторов не порождает событий: чаты, найденные по индексу, перепроверяются по кэшу администраторов
+        # (не старше TT_BOT_CHAT_CACHE_TTL), а новые назначения попадают в индекс не позже чем через TT_BOT_CHATS_INDEX_RECONCILE_PERIOD
+        self.chats_index = ChatsAdminIndex(self.storage, self.user_id, lgz=self.lgz) \
+            if Utils.get_environ_bool('TT_BOT_CHATS_INDEX', True) and self.user_id is not None else None
+        self.chats_index_reconcile_period = Utils.str_to_int(os.environ.get('TT_BOT_CHATS_INDEX_RECONCILE_PERIOD')) or 3600
+        if self.chats_index is not None and not self.chats_index.is_built:
+            # Первичное построение индекса - в фоне; до его завершения чаты перебираются через API
+            self.chats_index.reconcile_in_background(self.chats_index_build)
 
         self.lgz.info('%s inited.' % self.title)
 
@@ -206,20 +318,14 @@ class TamTamBot(object):
 
     def get_user_language_by_update(self, update):
         # type: (Update) -> str
-        update = UpdateCmn(update, self)
+        update = UpdateCmn.get(update, self)
         language = update.user_locale or self.get_default_language()
         if language[:2] not in self.languages_dict.keys():
             language = self.get_default_language()
-        if update:
-            cursor = self.conn_srv.cursor()
-            # noinspection SqlResolve
-            cursor.execute(
-                'SELECT [language] FROM %(table)s WHERE [user_id]=:user_id' %
-                {'table': self.user_prop_table_name}, {'user_id': update.user_id})
-            row = cursor.fetchone()
-            cursor.close()
-            if row:
-                language = row[0] or self.get_default_language()
+        if update and update.user_id:
+            lang_stored = self.language_cache.get(update.user_id)
+            if lang_stored is not None:
+                language = lang_stored or self.get_default_language()
                 self.lgz.debug(' -> update.user_id=%s -> language: "%s"' % (update.user_id, language))
         return language
 
@@ -228,28 +334,9 @@ class TamTamBot(object):
         language = language or self.get_default_language()
         if language[:2] not in self.languages_dict.keys():
             language = self.get_default_language()
-        update = UpdateCmn(update, self)
-        if update:
-            cursor = self.conn_srv.cursor()
-            # noinspection SqlResolve
-            cursor.execute(
-                'SELECT COUNT([language]) FROM %(table)s WHERE [user_id]=:user_id' %
-                {'table': self.user_prop_table_name}, {'user_id': update.user_id})
-            row = cursor.fetchone()
-
-            if row[0] > 0:
-                if not soft_setting:
-                    # noinspection SqlResolve,SqlWithoutWhere
-                    cursor.execute(
-                        'UPDATE %(table)s SET [language] = :language WHERE [user_id]=:user_id' %
-                        {'table': self.user_prop_table_name}, {'language': language, 'user_id': update.user_id})
-            else:
-                # noinspection SqlResolve
-                cursor.execute(
-                    'INSERT INTO %(table)s ([user_id], [language]) VALUES (:user_id, :language)' %
-                    {'table': self.user_prop_table_name}, {'language': language, 'user_id': update.user_id})
-            cursor.connection.commit()
-            cursor.close()
+        update = UpdateCmn.get(update, self)
+        if update and update.user_id:
+            self.language_cache.set(update.user_id, language, soft_setting)
             self.lgz.debug(' -> update.user_id=%s -> language: "%s"' % (update.user_id, language))
 
     @property
@@ -272,32 +359,49 @@ class TamTamBot(object):
             self.lgz.info('The default encoding is set to %s' % sys.getdefaultencoding())
 
     def check_threads(self):
-        self.lgz.info('%s of %s threads are used.' % (len(TamTamBot.threads), TamTamBot.work_threads_max_count()))
-        while len(TamTamBot.threads) >= TamTamBot.work_threads_max_count():
-            err = 'Threads pool is full. The maximum number (%s) is used. Awaiting release.' % TamTamBot.work_threads_max_count()
-            self.lgz.debug(err)
-            threads = TamTamBot.threads.copy()
-            for t in threads:
-                if not t.is_alive():
-                    self.lgz.debug('stop %s!' % t)
-                    t.join()
-                    TamTamBot.threads.remove(t)
-                else:
-                    self.lgz.debug('still work %s!' % t)
-            self.lgz.info('After trying to release: %s out of %s are used.' % (len(TamTamBot.threads), TamTamBot.work_threads_max_count()))
+        self.lgz.info('Dispatcher state: %s' % self.get_dispatcher().stats())
+        self.lgz.info('Outbound queue state: %s' % self.outbound.stats())
+        self.lgz.info('Attachment readiness state: %s' % self.attachment_readiness.stats())
+
+    @classmethod
+    def get_dispatcher(cls):
+        # type: () -> UpdateDispatcher
+        dispatcher = TamTamBot.dispatcher
+        if dispatcher is None:
+            with TamTamBot.dispatcher_lock:
+                if TamTamBot.dispatcher is None:
+                    TamTamBot.dispatcher = UpdateDispatcher(
+                        cls.work_threads_max_count(), cls.work_queue_max_size(), 'update', cls.lgz, sharded=cls.dispatch_mode() != cls.DISPATCH_MODE_POOL
+                    )
+                    TamTamBot.dispatcher.start()
+                dispatcher = TamTamBot.dispatcher
+        return dispatcher
+
+    def dispatch(self, func, args=(), block=True, timeout=None, key=None):
+        # type: (callable, tuple, bool, float, object) -> bool
+        res = self.get_dispatcher().submit(func, args, block, timeout, key)
+        self.lgz.debug('Task %s (key=%s) queued=%s. Queue depth=%s' % (func, key, res, self.get_dispatcher().queue_depth))
+        return res
+
+    def dispatch_key(self, update):
+        # type: (Update) -> object
+        # Ключ полосы обработки: обновления с одинаковым ключом обрабатываются последовательно
+        mode = self.dispatch_mode()
+        if mode == self.DISPATCH_MODE_POOL or not isinstance(update, Update):
+            return None
+        update = UpdateCmn.get(update, self)
+        if mode == self.DISPATCH_MODE_CHAT:
+            return update.chat_id if update.chat_id is not None else update.index
+        return update.index
 
     @classmethod
     def check_commands(cls, commands):
         # type: ([BotCommand]) -> []
         err_c = []
+        router = UpdateRouter.get(cls)
         for cmd in commands:
-            handler_name = 'cmd_handler_%s' % cmd.name
-            if hasattr(cls, handler_name):
-                cmd_h = getattr(cls, handler_name)
-                if not callable(cmd_h):
-                    err_c.append(handler_name)
-            else:
-                err_c.append(handler_name)
+            if not router.get_cmd_handler_name(cmd.name):
+                err_c.append('cmd_handler_%s' % cmd.name)
         return err_c
 
     @property
@@ -312,8 +416,31 @@ class TamTamBot(object):
 
     @property
     def conn_srv(self):
-        # noinspection PyUnresolvedReferences
-        return sqlite3.connect(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'ttb.sqlite3'))
+        # type: () -> sqlite3.Connection
+        # Постоянное соединение текущего потока
+        return self.storage.conn
+
+    @staticmethod
+    def get_db_path():
+        # type: () -> str
+        return os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'ttb.sqlite3')
+
+    def shutdown(self):
+        # Завершение работы: остановка рабочих потоков и закрытие соединений с БД
+        self.stop_polling = True
+        # Диспетчер общий для всех ботов процесса: ссылка сбрасывается, остальные боты при необходимости создадут новый
+        with TamTamBot.dispatcher_lock:
+            dispatcher = TamTamBot.dispatcher
+            TamTamBot.dispatcher = None
+        if dispatcher is not None:
+            dispatcher.stop()
+        self.admin_alerter.stop()
+        self.attachment_readiness.stop()
+        self.outbound.stop()
+        if self._chat_action_scheduler is not None:
+            self._chat_action_scheduler.stop()
+        self.language_cache.close()
+        self.storage.close()
 
     def db_prepare(self):
         # Создание таблицы
@@ -327,7 +454,7 @@ class TamTamBot(object):
                 [language] CHAR (10)
             );        
         ''' % (self.prev_step_table_name, self.user_prop_table_name)
-        self.conn_srv.cursor().executescript(sql_s)
+        self.storage.executescript(sql_s)
 
     @classmethod
     def work_threads_max_count(cls):
@@ -338,6 +465,27 @@ class TamTamBot(object):
 
         return cls._work_threads_max_count
 
+    @classmethod
+    def work_queue_max_size(cls):
+        if cls._work_queue_max_size is None:
+            cls._work_queue_max_size = Utils.str_to_int(os.environ.get('TT_BOT_WORK_QUEUE_MAX_SIZE'))
+            if cls._work_queue_max_size is None:
+                cls._work_queue_max_size = cls.work_threads_max_count() * 2
+
+        return cls._work_queue_max_size
+
+    @classmethod
+    def dispatch_mode(cls):
+        # type: () -> str
+        if cls._dispatch_mode is None:
+            mode = (os.environ.get('TT_BOT_DISPATCH_MODE') or cls.DISPATCH_MODE_POOL).lower()
+            if mode not in (cls.DISPATCH_MODE_POOL, cls.DISPATCH_MODE_CHAT, cls.DISPATCH_MODE_INDEX):
+                cls.lgz.warning('Unknown dispatch mode "%s". Mode "%s" is used.' % (mode, cls.DISPATCH_MODE_POOL))
+                mode = cls.DISPATCH_MODE_POOL
+            cls._dispatch_mode = mode
+
+        return cls._dispatch_mode
+
     @staticmethod
     def add_buttons_to_message_body(message_body, buttons):
         # type: (NewMessageBody, list) -> NewMessageBody
@@ -375,10 +523,10 @@ class TamTamBot(object):
         if not isinstance(update, (Update, UpdateCmn)):
             return False, False
         if not isinstance(update, UpdateCmn):
-            update = UpdateCmn(update, self)
-        cmd_handler = 'cmd_handler_%s' % update.cmd
-        if hasattr(self, cmd_handler):
-            return getattr(self, cmd_handler)
+            update = UpdateCmn.get(update, self)
+        name = UpdateRouter.get(type(self)).get_cmd_handler_name(update.cmd)
+        if name:
+            return getattr(self, name)
 
     def call_cmd_handler(self, update):
         # type: (UpdateCmn or Update) -> (bool, bool)
@@ -386,7 +534,7 @@ class TamTamBot(object):
         if not isinstance(update, (Update, UpdateCmn)):
             return False, False
         if not isinstance(update, UpdateCmn):
-            update = UpdateCmn(update, self)
+            update = UpdateCmn.get(update, self)
         if not update.this_cmd_response:
             handler = self.get_cmd_handler(update)
             self.prev_step_delete(update.index)
@@ -418,7 +566,7 @@ class TamTamBot(object):
         Например, для команды "start" см. ниже метод cmd_handler_start
         """
         res_w_m = None
-        update = UpdateCmn(update, self)
+        update = UpdateCmn.get(update, self)
         try:
             self.set_user_language_by_update(update.update_current, update.user_locale, soft_setting=True)
             if not update.chat_id:
@@ -437,6 +585,7 @@ class TamTamBot(object):
 
             if self.waiting_msg and chat_type == ChatType.DIALOG:
                 msg_t = (('{%s} ' % self.title) + _('Wait for process your request (%s)...') % cmd) + self.SERVICE_STR_SEQUENCE
+                # Отправляется синхронно: обработчики отвечают через self.msg, и ответ не должен опередить это сообщение
                 res_w_m = self.msg.send_message(NewMessageBody(msg_t), chat_id=chat_id)
 
             self.lgz.debug('Trying call handler.')
@@ -454,12 +603,12 @@ class TamTamBot(object):
                 if isinstance(update.update_current, MessageCallbackUpdate):
                     self.send_notification(update, _('"%s" is an incorrect command. Please specify.') % cmd)
                 else:
-                    self.msg.send_message(NewMessageBody(_('"%s" is an incorrect command. Please specify.') % cmd, link=link), chat_id=chat_id)
+                    self.send_message_async(NewMessageBody(_('"%s" is an incorrect command. Please specify.') % cmd, link=link), chat_id=chat_id)
                 res = False
             return res
         finally:
             if isinstance(res_w_m, SendMessageResult):
-                self.msg.delete_message(res_w_m.message.body.mid)
+                self.delete_message_async(res_w_m.message.body.mid, chat_id=chat_id)
 
     def cmd_handler_start(self, update):
         # type: (UpdateCmn) -> bool
@@ -559,39 +708,38 @@ class TamTamBot(object):
             try:
                 self.before_polling_update_list()
                 self.lgz.debug('Update request')
+                params = self.polling_tuner.request_params()
                 if marker:
-                    ul = self.subscriptions.get_updates(marker=marker, types=Update.update_types, _request_timeout=45)
+                    ul = self.subscriptions.get_updates(marker=marker, types=Update.update_types, **params)
                 else:
-                    ul = self.subscriptions.get_updates(types=Update.update_types, _request_timeout=45)
+                    ul = self.subscriptions.get_updates(types=Update.update_types, **params)
                 self.lgz.debug('Update request completed. Marker=%s' % marker)
                 marker = ul.marker
+                slt = self.polling_tuner.on_updates(ul.updates)
                 if ul.updates:
                     self.after_polling_update_list(True)
                     self.lgz.info('There are %s updates' % len(ul.updates))
                     self.lgz.debug(ul)
                     for update in ul.updates:
                         self.lgz.debug(type(update))
-                        self.check_threads()
-
-                        t = Thread(target=self.handle_update, args=(update,))
-                        TamTamBot.threads.append(t)
-                        t.name = 'pooling-thr-%04d' % len(TamTamBot.threads)
-                        t.setDaemon(True)
-                        self.lgz.debug('Thread started. Threads count=%s' % len(TamTamBot.threads))
-                        t.start()
+                        self.dispatch(self.handle_update, (update,), key=self.dispatch_key(update))
+                    self.check_threads()
+                    self.lgz.info('Polling state: %s' % self.polling_tuner.stats())
                 else:
                     self.after_polling_update_list()
                     self.lgz.debug('No updates...')
-                self.lgz.debug('Pause for %s seconds' % self.polling_sleep_time)
-                sleep(self.polling_sleep_time)
+                if slt:
+                    self.lgz.debug('Pause for %s seconds' % slt)
+                    sleep(slt)
 
             except ApiException as err:
                 if str(err.body).lower().find('Invalid access_token'):
                     raise
             except Exception:
                 self.lgz.exception('Exception')
-                self.lgz.warning('Pause for %s seconds because there was an error' % self.polling_error_sleep_time)
-                sleep(self.polling_error_sleep_time)
+                slt = self.polling_tuner.on_error()
+                self.lgz.warning('Pause for %s seconds because there was an error' % slt)
+                sleep(slt)
                 # raise
         self.lgz.info('Stopping')
 
@@ -600,29 +748,18 @@ class TamTamBot(object):
         pass
 
     # Обработка тела запроса
+    # Тело разбирается один раз - в вызывающем потоке, рабочему потоку передаётся готовый объект
     def handle_request_body(self, request_body):
         # type: (bytes) -> None
-        self.check_threads()
-
-        if len(TamTamBot.threads) < TamTamBot.work_threads_max_count():
-            t = Thread(target=self.handle_request_body_, args=(request_body,))
-            # noinspection PyBroadException
-            try:
-                TamTamBot.threads.append(t)
-                t.name = 'webhook-thr-%04d' % len(TamTamBot.threads)
-                t.setDaemon(True)
-                self.lgz.debug('Thread started. Threads count=%s' % len(TamTamBot.threads))
-                t.start()
-            except Exception:
-                self.lgz.exception('Exception')
-            finally:
-                self.lgz.debug('exited')
-        else:
-            err = 'Threads pool is full. The maximum number (%s) is used.' % TamTamBot.work_threads_max_count()
+        incoming_data = self.parse_request_body(request_body)
+        if not incoming_data:
+            return
+        timeout = Utils.str_to_int(os.environ.get('TT_BOT_WORK_QUEUE_PUT_TIMEOUT'))
+        if not self.dispatch(self.handle_incoming_data, (incoming_data,), timeout=timeout, key=self.dispatch_key(incoming_data)):
+            err = 'Work queue is full. The maximum number (%s) is used.' % TamTamBot.work_queue_max_size()
             self.lgz.debug(err)
-            incoming_data = self.deserialize_update(request_body)
             if isinstance(incoming_data, Update):
-                update = UpdateCmn(incoming_data, self)
+                update = UpdateCmn.get(incoming_data, self)
                 self.send_error_message(update)
                 self.send_admin_message(err, update)
 
@@ -631,30 +768,41 @@ class TamTamBot(object):
         if self:
             return request_body
 
-    # Обработка тела запроса
-    def handle_request_body_(self, request_body):
-        # type: (bytes) -> None
-        incoming_data = None
+    def parse_request_body(self, request_body):
+        # type: (bytes) -> object
         # noinspection PyBroadException
         try:
             if request_body:
                 self.lgz.debug('request body:\n%s\n%s' % (request_body, request_body.decode('utf-8')))
                 request_body = self.before_handle_request_body(request_body)
-                incoming_data = self.deserialize_update(request_body)
-                if incoming_data:
-                    incoming_data = self.after_handle_request_body(incoming_data)
-                    self.lgz.debug('incoming data:\n type=%s;\n data=%s' % (type(incoming_data), incoming_data))
-                    if isinstance(incoming_data, Update):
-                        if not self.update_is_service(UpdateCmn(incoming_data, self)):
-                            self.handle_update(incoming_data)
-                        else:
-                            self.lgz.debug('This update is service - passed')
+                return self.deserialize_update(request_body)
+        except Exception:
+            self.lgz.exception('Exception')
+
+    # Обработка тела запроса
+    def handle_request_body_(self, request_body):
+        # type: (bytes) -> None
+        self.handle_incoming_data(self.parse_request_body(request_body))
+
+    # Обработка разобранного тела запроса
+    def handle_incoming_data(self, incoming_data):
+        # type: (object) -> None
+        # noinspection PyBroadException
+        try:
+            if incoming_data:
+                incoming_data = self.after_handle_request_body(incoming_data)
+                self.lgz.debug('incoming data:\n type=%s;\n data=%s' % (type(incoming_data), incoming_data))
+                if isinstance(incoming_data, Update):
+                    if not self.update_is_service(UpdateCmn.get(incoming_data, self)):
+                        self.handle_update(incoming_data)
+                    else:
+                        self.lgz.debug('This update is service - passed')
         except Exception as e:
             self.lgz.exception('Exception')
             if isinstance(incoming_data, Update):
-                self.send_error_message(UpdateCmn(incoming_data, self), e)
+                self.send_error_message(UpdateCmn.get(incoming_data, self), e)
         finally:
-            self.lgz.debug('Thread exited. Threads count=%s' % len(TamTamBot.threads))
+            self.lgz.debug('Request body handled. Queue depth=%s' % self.get_dispatcher().queue_depth)
 
     def after_handle_request_body(self, incoming_data):
         # type: (object) -> object
@@ -675,10 +823,16 @@ class TamTamBot(object):
         if not link:
             if isinstance(update, UpdateCmn):
                 link = update.link
+        # Повторы уже отправленной ошибки (или того же текста) не рассылаются, а попадают в периодическую сводку
+        if exception and not self.admin_alerter.check(exception):
+            self.lgz.debug('Admin alert suppressed (repeat): %s' % self.admin_alerter.summary(exception))
+            return []
+        if not exception and not self.admin_alerter.check_text(text):
+            self.lgz.debug('Admin alert suppressed (repeat): %s' % text[:200])
+            return []
         err = ''
         if exception:
             err = "\n<mark>%s</mark>: <pre>%s</pre>" % (OacUtils.escape(exception.__class__.__name__), OacUtils.escape(traceback.format_exc()))
-        res = []
         now = datetime.now()
         if not text_escaped:
             text = OacUtils.escape(text)
@@ -686,51 +840,48 @@ class TamTamBot(object):
         text_add = ''
         if exception and update:
             text_add = ('<pre>%s</pre>' % OacUtils.escape(str(update.update_current)))
-        if self.admins_contacts:
-            if self.admins_contacts.get('chats'):
-                for el in self.admins_contacts.get('chats'):
-                    try:
-                        res_s = self.send_message_long_text(
-                            NewMessageBody(link=link, notify=notify, format=TextFormat.HTML),
-                            text,
-                            chat_id=el,
-                        )
-                        if res_s:
-                            res.extend(res_s)
-                        if res_s and isinstance(res_s[0], SendMessageResult) and text_add:
-                            res_s = self.send_message_long_text(
-                                NewMessageBody(link=NewMessageLink(MessageLinkType.REPLY, res_s[0].message.body.mid), notify=notify, format=TextFormat.HTML),
-                                text_add,
-                                chat_id=el,
-                            )
-                            if res_s:
-                                res.extend(res_s)
-                    except Exception as e:
-                        self.lgz.exception(e)
+        return self.send_admin_contacts(text, text_add, notify, link)
 
-            if self.admins_contacts.get('users'):
-                for el in self.admins_contacts.get('users'):
-                    try:
-                        res_s = self.send_message_long_text(
-                            NewMessageBody(link=link, notify=notify, format=TextFormat.HTML),
-                            text,
-                            user_id=el,
-                        )
-                        if res_s:
-                            res.extend(res_s)
-                        if isinstance(res_s, SendMessageResult) and text_add:
-                            res_s = self.send_message_long_text(
-                                NewMessageBody(link=NewMessageLink(MessageLinkType.REPLY, res_s.message.body.mid), notify=notify, format=TextFormat.HTML),
-                                text_add,
-                                user_id=el,
-                            )
-                            if res_s:
-                                res.extend(res_s)
-                    except Exception as e:
-                        self.lgz.exception(e)
+    # Рассылка по всем контактам администраторов - параллельно, в пределах ограничения частоты оповещений.
+    # Ожидание разрешения ограничителя - не дольше admin_alerts_timeout на всю рассылку, а не на каждый контакт
+    def send_admin_contacts(self, text, text_add=None, notify=True, link=None):
+        # type: (str, str, bool, NewMessageLink) -> []
+        res = []
+        contacts = [{'chat_id': el} for el in self.admins_contacts.get('chats') or []]
+        contacts.extend({'user_id': el} for el in self.admins_contacts.get('users') or [])
+        if contacts:
+            deadline = time() + self.admin_alerts_timeout
+            for res_s in self.admin_alerter.map(lambda contact: self.send_admin_contact(contact, text, text_add, notify, link, deadline), contacts):
+                res.extend(res_s)
+        return res
 
+    def send_admin_contact(self, contact, text, text_add=None, notify=True, link=None, deadline=None):
+        # type: (dict, str, str, bool, NewMessageLink, float) -> []
+        # contact - {'chat_id': ...} или {'user_id': ...}
+        res = []
+        try:
+            if not self.admin_alerter.acquire(max(deadline - time(), 0) if deadline else self.admin_alerts_timeout):
+                self.lgz.warning('Admin message to %s dropped: alerts rate limit exceeded.' % contact)
+                return res
+            res_s = self.send_message_long_text(NewMessageBody(link=link, notify=notify, format=TextFormat.HTML), text, **contact)
+            if res_s:
+                res.extend(res_s)
+            if res_s and isinstance(res_s[0], SendMessageResult) and text_add:
+                res_s = self.send_message_long_text(
+                    NewMessageBody(link=NewMessageLink(MessageLinkType.REPLY, res_s[0].message.body.mid), notify=notify, format=TextFormat.HTML),
+                    text_add,
+                    **contact
+                )
+                if res_s:
+                    res.extend(res_s)
+        except Exception as e:
+            self.lgz.exception(e)
         return res
 
+    def send_admin_digest(self, text):
+        # type: (str) -> []
+        return self.send_admin_contacts('%s(bot @%s): %s' % (datetime.now(), OacUtils.escape(self.username), OacUtils.escape(text)), notify=False)
+
     def send_error_message(self, update, error=None, link=None):
         # type: (UpdateCmn, Exception, NewMessageLink) -> bool
         if not isinstance(update, UpdateCmn):
@@ -749,7 +900,7 @@ class TamTamBot(object):
         if not self.update_is_service(update):
             try:
                 if update and update.user_id and update.chat_id:
-                    chat = self.chats.get_chat(update.chat_id)
+                    chat = self.get_chat(update.chat_id)
                     if isinstance(chat, Chat):
                         chat = ChatExt(chat, self.title)
                         if isinstance(chat, ChatExt):
@@ -798,126 +949,108 @@ class TamTamBot(object):
         # type: (Update) -> str
         return self.serialize_open_api_object(update)
 
+    @property
+    def chat_action_scheduler(self):
+        # type: () -> ChatActionScheduler
+        if self._chat_action_scheduler is None:
+            with self.chat_action_scheduler_lock:
+                if self._chat_action_scheduler is None:
+                    self._chat_action_scheduler = ChatActionScheduler(
+                        self.chats,
+                        Utils.str_to_int(os.environ.get('TT_BOT_CHAT_ACTION_PERIOD')) or 5,
+                        Utils.str_to_int(os.environ.get('TT_BOT_CHAT_ACTION_IDLE_TIMEOUT')) or 60,
+                        Utils.str_to_int(os.environ.get('TT_BOT_CHAT_ACTION_MAX_ACTIVE')) or 1000,
+                        Utils.str_to_int(os.environ.get('TT_BOT_CHAT_ACTION_SENDERS')) or 2,
+                        self.lgz,
+                    )
+        return self._chat_action_scheduler
+
     def action_repeat(self, chat_id, action_name, on=True):
         # type: (int, str, bool) -> None
-        if chat_id in self.chats_action:
-            t = self.chats_action[chat_id]
-        else:
-            t = ChatActionRequestRepeater(self.chats, chat_id)
-            self.chats_action[chat_id] = t
-            t.start()
-        if t:
-            t.action_switch(action_name, on)
+        if not on and self._chat_action_scheduler is None:
+            return
+        self.chat_action_scheduler.action_switch(chat_id, action_name, on)
 
     def before_handle_update(self, update):
         # type: (Update) -> None
-        update = UpdateCmn(update, self)
+        update = UpdateCmn.get(update, self)
         if update.chat_id:
             self.chats.send_action(update.chat_id, ActionRequestBody(SenderAction.MARK_SEEN))
             if update.chat_type in [ChatType.DIALOG]:
                 # Запускаем повторитель события
                 self.action_repeat(update.chat_id, SenderAction.TYPING_ON)
 
+    def update_is_command(self, update):
+        # type: (Update) -> bool
+        # Определение команды; обращение к боту вида "@bot /cmd" приводится к "/cmd"
+        is_command = False
+        cmd_prefix = '@%s /' % self.info.username
+        if isinstance(update, MessageCreatedUpdate):
+            if update.message.body.text.startswith(cmd_prefix):
+                is_command = True
+                # Поверхностная копия: исходное сообщение (например, в кэше сообщений) не изменяется
+                body = copy.copy(update.message.body)
+                body.text = str(body.text).replace(cmd_prefix, '/')
+                update.message = copy.copy(update.message)
+                update.message.body = body
+                UpdateCmn.reset(update)
+            elif update.message.body.text.startswith('/'):
+                if update.message.recipient.chat_type == ChatType.DIALOG:
+                    is_command = True
+        return is_command
+
+    def get_update_handler(self, update):
+        # type: (Update) -> callable
+        name = UpdateRouter.get(type(self)).get_update_handler_name(type(update))
+        if name:
+            return getattr(self, name)
+
     def handle_update(self, update):
         # type: (Update) -> bool
         # noinspection PyBroadException
         try:
             self.lgz.debug(' -> %s' % type(update))
+            self.update_caches_by_update(update)
+            is_command = self.update_is_command(update)
             language = self.get_user_language_by_update(update)
             translation_activate(language)
             try:
                 self.before_handle_update(update)
 
-                is_command = False
-                cmd_prefix = '@%s /' % self.info.username
-                if isinstance(update, MessageCreatedUpdate):
-                    if update.message.body.text.startswith(cmd_prefix):
-                        is_command = True
-                        update.message.body.text = str(update.message.body.text).replace(cmd_prefix, '/')
-                    elif update.message.body.text.startswith('/'):
-                        if update.message.recipient.chat_type == ChatType.DIALOG:
-                            is_command = True
-
                 if is_command:
                     self.lgz.debug('entry to %s' % self.process_command)
                     res = self.process_command(update)
                     self.lgz.debug('exit from %s with result=%s' % (self.process_command, res))
-                elif isinstance(update, MessageCreatedUpdate):
-                    if not self.update_is_service(UpdateCmn(update, self)):
-                        self.lgz.debug('entry to %s' % self.handle_message_created_update)
-                        res = self.handle_message_created_update(update)
-                        self.lgz.debug('exit from %s with result=%s' % (self.handle_message_created_update, res))
+                elif isinstance(update, MessageCreatedUpdate) and self.update_is_service(UpdateCmn.get(update, self)):
+                    res = False
+                    self.lgz.debug('This update is service - passed')
+                else:
+                    handler = self.get_update_handler(update)
+                    if handler:
+                        self.lgz.debug('entry to %s' % handler)
+                        res = handler(update)
+                        self.lgz.debug('exit from %s with result=%s' % (handler, res))
                     else:
                         res = False
-                        self.lgz.debug('This update is service - passed')
-                elif isinstance(update, MessageCallbackUpdate):
-                    self.lgz.debug('entry to %s' % self.handle_message_callback_update)
-                    res = self.handle_message_callback_update(update)
-                    self.lgz.debug('exit from %s with result=%s' % (self.handle_message_callback_update, res))
-                elif isinstance(update, MessageEditedUpdate):
-                    self.lgz.debug('entry to %s' % self.handle_message_edited_update)
-                    res = self.handle_message_edited_update(update)
-                    self.lgz.debug('exit from %s with result=%s' % (self.handle_message_edited_update, res))
-                elif isinstance(update, MessageRemovedUpdate):
-                    self.lgz.debug('entry to %s' % self.handle_message_removed_update)
-                    res = self.handle_message_removed_update(update)
-                    self.lgz.debug('exit from %s with result=%s' % (self.handle_message_removed_update, res))
-                elif isinstance(update, BotStartedUpdate):
-                    self.lgz.debug('entry to %s' % self.handle_bot_started_update)
-                    res = self.handle_bot_started_update(update)
-                    self.lgz.debug('exit from %s with result=%s' % (self.handle_bot_started_update, res))
-                elif isinstance(update, BotAddedToChatUpdate):
-                    self.lgz.debug('entry to %s' % self.handle_bot_added_to_chat_update)
-                    res = self.handle_bot_added_to_chat_update(update)
-                    self.lgz.debug('exit from %s with result=%s' % (self.handle_bot_added_to_chat_update, res))
-                elif isinstance(update, BotRemovedFromChatUpdate):
-                    self.lgz.debug('entry to %s' % self.handle_bot_removed_from_chat_update)
-                    res = self.handle_bot_removed_from_chat_update(update)
-                    self.lgz.debug('exit from %s with result=%s' % (self.handle_bot_removed_from_chat_update, res))
-                elif isinstance(update, UserAddedToChatUpdate):
-                    self.lgz.debug('entry to %s' % self.handle_user_added_to_chat_update)
-                    res = self.handle_user_added_to_chat_update(update)
-                    self.lgz.debug('exit from %s with result=%s' % (self.handle_user_added_to_chat_update, res))
-                elif isinstance(update, UserRemovedFromChatUpdate):
-                    self.lgz.debug('entry to %s' % self.handle_user_removed_from_chat_update)
-                    res = self.handle_user_removed_from_chat_update(update)
-                    self.lgz.debug('exit from %s with result=%s' % (self.handle_user_removed_from_chat_update, res))
-                elif isinstance(update, ChatTitleChangedUpdate):
-                    self.lgz.debug('entry to %s' % self.handle_chat_title_changed_update)
-                    res = self.handle_chat_title_changed_update(update)
-                    self.lgz.debug('exit from %s with result=%s' % (self.handle_chat_title_changed_update, res))
-                elif isinstance(update, MessageChatCreatedUpdate):
-                    self.lgz.debug('entry to %s' % self.handle_message_chat_created_update)
-                    res = self.handle_message_chat_created_update(update)
-                    self.lgz.debug('exit from %s with result=%s' % (self.handle_message_chat_created_update, res))
-                elif isinstance(update, MessageConstructionRequest):
-                    self.lgz.debug('entry to %s' % self.handle_message_construction_request)
-                    res = self.handle_message_construction_request(update)
-                    self.lgz.debug('exit from %s with result=%s' % (self.handle_message_construction_request, res))
-                elif isinstance(update, MessageConstructedUpdate):
-                    self.lgz.debug('entry to %s' % self.handle_message_constructed_update)
-                    res = self.handle_message_constructed_update(update)
-                    self.lgz.debug('exit from %s with result=%s' % (self.handle_message_constructed_update, res))
-                else:
-                    res = False
             finally:
                 self.after_handle_update(update)
+                self.polling_tuner.on_handled(update)
             return res
         except Exception as e:
             self.lgz.exception('Exception')
-            update = UpdateCmn(update, self)
+            update = UpdateCmn.get(update, self)
             self.send_error_message(update, e)
 
     def after_handle_update(self, update):
         # type: (Update) -> None
-        update = UpdateCmn(update, self)
+        update = UpdateCmn.get(update, self)
         if update.chat_id:
             # Отключаем повторитель события
             self.action_repeat(update.chat_id, SenderAction.TYPING_ON, False)
 
     def handle_message_created_update(self, update):
         # type: (MessageCreatedUpdate) -> bool
-        update = UpdateCmn(update, self)
+        update = UpdateCmn.get(update, self)
         # Проверка на ответ команде
         update_previous = self.prev_step_get(update.index)
         if isinstance(update_previous, Update):
@@ -925,7 +1058,7 @@ class TamTamBot(object):
             # Если это ответ на вопрос команды, то установить соответствующий признак и снова вызвать команду
             update.this_cmd_response = True
             update.update_previous = update_previous
-            update_previous = UpdateCmn(update_previous, self)
+            update_previous = UpdateCmn.get(update_previous, self)
             res_w_m = None
             try:
                 if self.waiting_msg and update.chat_type == ChatType.DIALOG:
@@ -935,7 +1068,7 @@ class TamTamBot(object):
                 handler_exists, res = self.call_cmd_handler(update)
             finally:
                 if isinstance(res_w_m, SendMessageResult):
-                    self.msg.delete_message(res_w_m.message.body.mid)
+                    self.delete_message_async(res_w_m.message.body.mid, chat_id=update.chat_id)
             return res
         self.lgz.debug('Trivial message. Not commands answer (%s).' % update.index)
         return self.receive_message(update)
@@ -948,22 +1081,36 @@ class TamTamBot(object):
 
     def handle_message_callback_update(self, update):
         # type: (MessageCallbackUpdate) -> bool
-        self.last_mcb_update[update.message.recipient.chat_id] = update
-        ind = UpdateCmn.get_callback_index(update.callback)
-        if self.callbacks_list.get(ind):
-            self.callbacks_list[ind] = [update.callback.timestamp, self.callbacks_list[ind][0]]
-        else:
-            self.callbacks_list[ind] = [update.callback.timestamp]
+        self.register_callback(update)
 
         if update.callback.payload:
             self.lgz.debug('MessageCallbackUpdate:\r\n%s' % update.callback.payload)
             res = self.process_command(update)
             if res:
-                self.delete_message(update.message.body.mid)
+                self.delete_message_async(update.message.body.mid)
         else:
             res = self.delete_message(update.message.body.mid)
         return res
 
+    def register_callback(self, update):
+        # type: (MessageCallbackUpdate) -> None
+        # Запоминание последнего нажатия в чате и двух последних моментов нажатия кнопки (для is_double_click)
+        self.last_mcb_update.set(update.message.recipient.chat_id, update)
+        ts = update.callback.timestamp
+        self.callbacks_list.update_with(UpdateCmn.get_callback_index(update.callback), lambda prev: [ts, prev[0]] if prev else [ts])
+
+    @classmethod
+    def stores_stats(cls):
+        # type: () -> [dict]
+        return [cls.callbacks_list.stats(), cls.last_mcb_update.stats(), cls.limited_buttons.stats()]
+
+    def caches_stats(self):
+        # type: () -> dict
+        return {
+            'chats': self.chat_cache.stats(), 'languages': self.language_cache.stats(), 'messages': self.message_cache.stats(),
+            'uploads': self.upload_cache.stats() if self.upload_cache is not None else None,
+        }
+
     def handle_message_edited_update(self, update):
         # type: (MessageEditedUpdate) -> bool
         pass
@@ -1008,12 +1155,30 @@ class TamTamBot(object):
         # type: (MessageConstructedUpdate) -> bool
         pass
 
-    def get_chat_members(self, chat_id, user_ids=None):
-        # type: (int, [int]) -> {ChatMember}
-        marker = None
-        m_dict = {}
-        members = []
-        while True:
+    # Генератор элементов постраничной выдачи; следующая страница запрашивается заранее (отключается через TT_BOT_PAGES_PREFETCH=False).
+    # Обход можно прервать в любой момент - фоновый запрос страниц прекращается при закрытии генератора.
+    def iter_pages(self, fetch_page, marker=None, name='page-prefetch'):
+        # type: (callable, object, str) -> Iterator
+        pages = PageIterator(fetch_page, marker, self.pages_prefetch, name)
+        try:
+            for item in pages:
+                yield item
+        finally:
+            pages.close()
+
+    def iter_chats(self):
+        # type: () -> Iterator[Chat]
+        def fetch_page(marker):
+            chat_list = self.get_chats_page(marker)
+            if isinstance(chat_list, ChatList):
+                return chat_list.chats, chat_list.marker
+            return [], None
+
+        return self.iter_pages(fetch_page, name='chats-prefetch')
+
+    def iter_chat_members(self, chat_id, user_ids=None):
+        # type: (int, [int]) -> Iterator[ChatMember]
+        def fetch_page(marker):
             if user_ids:
                 cm = self.chats.get_members(chat_id, user_ids=user_ids)
             elif marker:
@@ -1021,34 +1186,70 @@ class TamTamBot(object):
             else:
                 cm = self.chats.get_members(chat_id)
             if isinstance(cm, ChatMembersList):
-                marker = cm.marker
-                members.extend(cm.members)
-                for c in cm.members:
-                    if isinstance(c, ChatMember):
-                        m_dict[c.user_id] = c
-            if not marker:
-                break
-        return m_dict
+                return [c for c in cm.members if isinstance(c, ChatMember)], cm.marker
+            return [], None
 
-    def get_chat_admins(self, chat_id):
-        # type: (int) -> {ChatMember}
-        marker = None
-        m_dict = {}
-        admins = []
-        while True:
+        return self.iter_pages(fetch_page, name='members-prefetch')
+
+    def iter_chat_admins(self, chat_id):
+        # type: (int) -> Iterator[ChatMember]
+        def fetch_page(marker):
             if marker:
                 cm = self.chats.get_admins(chat_id, marker=marker)
             else:
                 cm = self.chats.get_admins(chat_id)
             if isinstance(cm, ChatMembersList):
-                marker = cm.marker
-                admins.extend(cm.members)
-                for c in cm.members:
-                    if isinstance(c, ChatMember):
-                        m_dict[c.user_id] = c
-            if not marker:
-                break
-        return m_dict
+                return [c for c in cm.members if isinstance(c, ChatMember)], cm.marker
+            return [], None
+
+        return self.iter_pages(fetch_page, name='admins-prefetch')
+
+    def get_chat_members(self, chat_id, user_ids=None, cached=False):
+        # type: (int, [int], bool) -> {ChatMember}
+        if cached:
+            key = (ChatMembershipCache.MEMBERS, tuple(sorted(user_ids)) if user_ids else None)
+            return self.chat_cache.get_or_load(chat_id, key, self.get_chat_members, chat_id, user_ids)
+        return {c.user_id: c for c in self.iter_chat_members(chat_id, user_ids)}
+
+    def get_chat_admins(self, chat_id, cached=False):
+        # type: (int, bool) -> {ChatMember}
+        if cached:
+            return self.chat_cache.get_or_load(chat_id, (ChatMembershipCache.ADMINS,), self.get_chat_admins, chat_id)
+        return {c.user_id: c for c in self.iter_chat_admins(chat_id)}
+
+    def get_chat(self, chat_id):
+        # type: (int) -> Chat
+        return self.chat_cache.get_or_load(chat_id, (ChatMembershipCache.CHAT,), self.chats.get_chat, chat_id)
+
+    def get_chat_membership(self, chat_id):
+        # type: (int) -> ChatMember
+        return self.chat_cache.get_or_load(chat_id, (ChatMembershipCache.MEMBERSHIP,), self.chats.get_membership, chat_id)
+
+    def update_caches_by_update(self, update):
+        # type: (Update) -> None
+        # Сброс кэшированных сведений о чате по событиям, которые их изменяют
+        if isinstance(update, (BotAddedToChatUpdate, BotRemovedFromChatUpdate)):
+            self.chat_cache.invalidate(update.chat_id)
+        elif isinstance(update, (UserAddedToChatUpdate, UserRemovedFromChatUpdate)):
+            self.chat_cache.invalidate(update.chat_id, ChatMembershipCache.MEMBERS, ChatMembershipCache.ADMINS)
+        elif isinstance(update, ChatTitleChangedUpdate):
+            self.chat_cache.invalidate(update.chat_id, ChatMembershipCache.CHAT)
+
+        # Индекс чатов: удаление бота из чата отрабатывается сразу, остальные события - при следующем обращении к индексу
+        if self.chats_index is not None:
+            if isinstance(update, BotRemovedFromChatUpdate):
+                self.chats_index.remove_chat(update.chat_id)
+            elif isinstance(update, (BotAddedToChatUpdate, BotStartedUpdate, UserAddedToChatUpdate, UserRemovedFromChatUpdate, ChatTitleChangedUpdate)):
+                self.chats_index.mark_stale(update.chat_id)
+
+        # Кэш сообщений; update_is_command не изменяет кэшированное сообщение, а заменяет его в событии копией
+        if isinstance(update, MessageCreatedUpdate):
+            self.message_cache.put(update.message)
+        elif isinstance(update, MessageEditedUpdate):
+            if isinstance(update.message, Message) and isinstance(update.message.body, MessageBody):
+                self.message_cache.invalidate(update.message.body.mid)
+        elif isinstance(update, MessageRemovedUpdate):
+            self.message_cache.invalidate(update.message_id)
 
     # Определяет разрешённость чата
     def chat_is_allowed(self, chat_ext, user_id=None):
@@ -1079,7 +1280,7 @@ class TamTamBot(object):
         user_id = user_id or (user.user_id if user else None)
         if user_id and chat and not user:
             try:
-                user = self.get_chat_admins(chat.chat_id).get(user_id) if chat.type != ChatType.DIALOG else self.chats.get_chat(chat.chat_id).dialog_with_user
+                user = self.get_chat_admins(chat.chat_id, cached=True).get(user_id) if chat.type != ChatType.DIALOG else self.get_chat(chat.chat_id).dialog_with_user
             except ApiException as e:
                 return 'Error: %s (%s|%s) -> %s' % (user_id, chat.chat_id, chat.title, e) + title
         if user:
@@ -1095,12 +1296,12 @@ class TamTamBot(object):
                 bot_user = None
                 try:
                     if chat.type != ChatType.DIALOG:
-                        bot_user = self.chats.get_membership(chat.chat_id)
+                        bot_user = self.get_chat_membership(chat.chat_id)
                         if isinstance(bot_user, ChatMember):
                             # Только если бот админ
                             if bot_user.is_admin:
                                 try:
-                                    members = self.get_chat_members(chat.chat_id, [user_id])
+                                    members = self.get_chat_members(chat.chat_id, [user_id], cached=True)
                                 except ApiException as err:
                                     if err.status != 404:
                                         raise
@@ -1151,35 +1352,48 @@ class TamTamBot(object):
     # Формирует список чатов пользователя, в которых админы и он и бот с возможностью доп проверки разрешений
     def get_users_chats_with_bot_adm(self, user_id, admin_only):
         # type: (int, bool) -> dict
-        marker = None
+        if self.chats_index is not None and self.chats_index_sync():
+            return self.get_users_chats_with_bot_adm_indexed(user_id, admin_only)
         chats_available = {}
-        while True:
-            if marker:
-                chat_list = self.chats.get_chats(marker=marker)
-            else:
-                chat_list = self.chats.get_chats()
-            if isinstance(chat_list, ChatList):
-                marker = chat_list.marker
-                for chat in chat_list.chats:
-                    self.lgz.debug('Found chat => chat_id=%(id)s; type: %(type)s; status: %(status)s; title: %(title)s; participants: %(participants)s; owner: %(owner)s' %
-                                   {'id': chat.chat_id, 'type': chat.type, 'status': chat.status, 'title': chat.title, 'participants': chat.participants_count, 'owner': chat.owner_id})
-                    chat_ext = self.chat_is_available(chat, user_id)
-                    if chat_ext and (admin_only or self.chat_is_allowed(chat_ext, user_id)):
-                        chats_available[chat.chat_id] = chat_ext
-                        self.lgz.debug('chat => chat_id=%(id)s added into list available chats' % {'id': chat.chat_id})
-                if not marker:
-                    break
+        for chat in self.iter_chats():
+            self.lgz.debug('Found chat => chat_id=%(id)s; type: %(type)s; status: %(status)s; title: %(title)s; participants: %(participants)s; owner: %(owner)s' %
+                           {'id': chat.chat_id, 'type': chat.type, 'status': chat.status, 'title': chat.title, 'participants': chat.participants_count, 'owner': chat.owner_id})
+            chat_ext = self.chat_is_available(chat, user_id)
+            if chat_ext and (admin_only or self.chat_is_allowed(chat_ext, user_id)):
+                chats_available[chat.chat_id] = chat_ext
+                self.lgz.debug('chat => chat_id=%(id)s added into list available chats' % {'id': chat.chat_id})
         return chats_available
 
-    # Формирует список чатов пользователей, в которых админы и пользователь и бот с возможностью доп проверки разрешений
-    def get_all_chats_with_bot_admin(self, admin_only=False):
-        # type: ([int]) -> dict
-        marker = None
-        chats_available = {'Chats': {}, 'Members': {}, 'ChatsMembers': {}, }
-        chats_available_cm = chats_available['ChatsMembers']
-        chats_available_m = chats_available['Members']
-        chats_available_c = chats_available['Chats']
-        chats_all = {}
+    # То же по индексу "администратор -> чаты" - без перебора всех чатов бота
+    def get_users_chats_with_bot_adm_indexed(self, user_id, admin_only):
+        # type: (int, bool) -> dict
+        chats_available = {}
+        for chat_s, bot_permissions, permissions, dialog_name in self.chats_index.get_user_chats(user_id):
+            chat = self.deserialize_open_api_object(chat_s.encode('utf-8'), 'Chat')
+            if chat.type != ChatType.DIALOG:
+                # Актуальные администраторы чата (из кэша): бот и пользователь могли быть сняты или получить другие разрешения
+                try:
+                    admins = self.get_chat_admins(chat.chat_id, cached=True)
+                except ApiException as err:
+                    if err.status not in (403, 404):
+                        raise
+                    admins = {}
+                if self.user_id not in admins or user_id not in admins:
+                    self.chats_index.mark_stale(chat.chat_id)
+                    continue
+                bot_permissions = list(admins[self.user_id].permissions or [])
+                self.adm_perm_correct(bot_permissions)
+                permissions = list(admins[user_id].permissions or [])
+                self.adm_perm_correct(permissions)
+            chat_ext = ChatExt(chat, dialog_name, {self.user_id: bot_permissions, user_id: permissions})
+            if admin_only or self.chat_is_allowed(chat_ext, user_id):
+                chats_available[chat.chat_id] = chat_ext
+        self.lgz.debug('Found %s available chats for user_id=%s by index' % (len(chats_available), user_id))
+        return chats_available
+
+    def get_bot_member(self):
+        # type: () -> ChatMember
+        # Бот в виде администратора чата - для диалогов
         bot = self.info
         if isinstance(bot, BotInfo):
             bot = ChatMember(
@@ -1189,67 +1403,177 @@ class TamTamBot(object):
                 last_access_time=0, is_owner=False, is_admin=True, join_time=0,
                 permissions=[ChatAdminPermission.WRITE, ChatAdminPermission.READ_ALL_MESSAGES],
             )
+        return bot
+
+    # Администраторы чата; для диалога - собеседник и сам бот
+    def get_chat_admins_ext(self, chat, bot=None):
+        # type: (Chat, ChatMember) -> {int: ChatMember}
+        admins = {}
+        if chat.type == ChatType.DIALOG:
+            bot = bot or self.get_bot_member()
+            dialog_user = chat.dialog_with_user
+            if isinstance(dialog_user, UserWithPhoto):
+                dialog_user = ChatMember(
+                    description=dialog_user.description, user_id=dialog_user.user_id, name=dialog_user.name, username=dialog_user.username,
+                    is_bot=dialog_user.is_bot, last_activity_time=dialog_user.last_activity_time,
+                    avatar_url=dialog_user.avatar_url, full_avatar_url=dialog_user.full_avatar_url,
+                    last_access_time=0, is_owner=False, is_admin=True, join_time=0,
+                    permissions=[ChatAdminPermission.WRITE, ChatAdminPermission.READ_ALL_MESSAGES]
+                )
+            # dialog_user_id = self.user_id ^ chat.chat_id
+            admins[dialog_user.user_id] = dialog_user
+            admins[bot.user_id] = bot
+        else:
+            try:
+                admins = self.get_chat_admins(chat.chat_id, cached=True)
+            except ApiException as err:
+                if err.status != 403:
+                    raise
+        return admins
+
+    # Запись индекса для чата: (chat_id, чат, разрешения бота, [(user_id, разрешения, имя диалога)]) или None, если бот не админ
+    def chats_index_entry(self, chat, admins):
+        # type: (Chat, {int: ChatMember}) -> tuple or None
+        bot_user = admins.get(self.user_id)
+        if chat.status not in [ChatStatus.ACTIVE] or not bot_user:
+            return None
+        bot_permissions = list(bot_user.permissions or [])
+        self.adm_perm_correct(bot_permissions)
+        admins_l = []
+        for admin in admins.values():
+            if admin.user_id != self.user_id:
+                permissions = list(admin.permissions or [])
+                self.adm_perm_correct(permissions)
+                admins_l.append((admin.user_id, permissions, self.get_dialog_name(self.title, user=admin)))
+        return chat.chat_id, self.serialize_open_api_object(chat), bot_permissions, admins_l
+
+    # Полное построение (сверка) индекса по всем чатам бота
+    def chats_index_build(self):
+        entries = []
+        for chat, admins in self.get_chats_admins():
+            entry = self.chats_index_entry(chat, admins)
+            if entry:
+                entries.append(entry)
+        self.chats_index.rebuild(entries)
+
+    # Обновление индекса для одного чата
+    def chats_index_refresh(self, chat_id):
+        # type: (int) -> None
+        try:
+            chat = self.get_chat(chat_id)
+            entry = self.chats_index_entry(chat, self.get_chat_admins_ext(chat))
+        except ApiException as err:
+            if err.status not in (403, 404):
+                raise
+            entry = None
+        if entry:
+            self.chats_index.set_chat(*entry)
+        else:
+            self.chats_index.remove_chat(chat_id)
 
-        while True:
-            if marker:
-                chat_list = self.chats.get_chats(marker=marker)
-            else:
-                chat_list = self.chats.get_chats()
-            if isinstance(chat_list, ChatList):
-                marker = chat_list.marker
-                for chat in chat_list.chats:
-                    self.lgz.debug('Found chat => chat_id=%(id)s; type: %(type)s; status: %(status)s; title: %(title)s; participants: %(participants)s; owner: %(owner)s' %
-                                   {'id': chat.chat_id, 'type': chat.type, 'status': chat.status, 'title': chat.title, 'participants': chat.participants_count, 'owner': chat.owner_id})
-                    if chat.status not in [ChatStatus.ACTIVE]:
-                        continue
+    # Актуализация индекса перед чтением: обновление затронутых событиями чатов, периодическая сверка.
+    # Построение и сверка выполняются в фоне одним потоком. Возвращает False, пока индекс не построен (тогда чаты перебираются через API).
+    def chats_index_sync(self):
+        # type: () -> bool
+        if not self.chats_index.is_built:
+            self.chats_index.reconcile_in_background(self.chats_index_build)
+            return False
+        with self.chats_index.refresh_lock:
+            stale = self.chats_index.pop_stale()
+            for i, chat_id in enumerate(stale):
+                try:
+                    self.chats_index_refresh(chat_id)
+                except Exception:
+                    for chat_id_ in stale[i:]:
+                        self.chats_index.mark_stale(chat_id_)
+                    raise
+        if self.chats_index.needs_reconcile(self.chats_index_reconcile_period):
+            self.chats_index.reconcile_in_background(self.chats_index_build)
+        return True
 
-                    admins = {}
-                    if chat.type == ChatType.DIALOG:
-                        dialog_user = chat.dialog_with_user
-                        if isinstance(dialog_user, UserWithPhoto):
-                            dialog_user = ChatMember(
-                                description=dialog_user.description, user_id=dialog_user.user_id, name=dialog_user.name, username=dialog_user.username,
-                                is_bot=dialog_user.is_bot, last_activity_time=dialog_user.last_activity_time,
-                                avatar_url=dialog_user.avatar_url, full_avatar_url=dialog_user.full_avatar_url,
-                                last_access_time=0, is_owner=False, is_admin=True, join_time=0,
-                                permissions=[ChatAdminPermission.WRITE, ChatAdminPermission.READ_ALL_MESSAGES]
-                            )
-                        # dialog_user_id = self.user_id ^ chat.chat_id
-                        admins[dialog_user.user_id] = dialog_user
-                        admins[bot.user_id] = bot
-                    else:
-                        try:
-                            admins = self.get_chat_admins(chat.chat_id)
-                        except ApiException as err:
-                            if err.status != 403:
-                                raise
-                    bot_user = admins.get(self.user_id)
-                    if bot_user:
-                        for admin in admins.values():
-                            if admin.user_id != self.user_id:
-                                # chat_ext = chats_available[admin.user_id].get(chat.chat_id)
-                                chat_ext = chats_all.get(chat.chat_id)
-                                if not isinstance(chat_ext, ChatExt):
-                                    chat_ext = ChatExt(chat, self.get_dialog_name(self.title, user=admin))
-                                    chats_all[chat.chat_id] = chat_ext
-                                chat_ext.admin_permissions[self.user_id] = bot_user.permissions
-                                self.adm_perm_correct(chat_ext.admin_permissions[self.user_id])
-                                chat_ext.admin_permissions[admin.user_id] = admin.permissions
-                                self.adm_perm_correct(chat_ext.admin_permissions[admin.user_id])
-
-                                if chat_ext and (admin_only or self.chat_is_allowed(chat_ext, admin.user_id)):
-                                    if chats_available_cm.get(admin.user_id) is None:
-                                        chats_available_cm[admin.user_id] = {}
-                                    if chats_available_c.get(chat_ext.chat_id) is None:
-                                        chats_available_c[chat_ext.chat_id] = chat_ext
-                                    if chats_available_m.get(admin.user_id) is None:
-                                        chats_available_m[admin.user_id] = admins.get(admin.user_id)
-
-                                    chats_available_cm[admin.user_id][chat.chat_id] = chat_ext
-                    else:
-                        self.lgz.debug('Pass, because for chat_id=%s bot (id=%s) is not admin' % (chat.chat_id, self.user_id))
-                if not marker:
-                    break
+    def get_chats_page(self, marker=None):
+        # type: (int) -> ChatList
+        if marker:
+            return self.chats.get_chats(marker=marker)
+        return self.chats.get_chats()
+
+    # Администраторы всех активных чатов бота - список (чат, {user_id: ChatMember}) в порядке выдачи чатов API.
+    # Следующая страница чатов запрашивается заранее, администраторы чатов - параллельно
+    # (не более TT_BOT_CHATS_FANOUT_WORKERS запросов одновременно) с общим ограничением частоты запросов к API.
+    # В работе не более 2 * TT_BOT_CHATS_FANOUT_WORKERS запросов: следующие чаты берутся по мере их завершения.
+    # progress(обработано, всего найдено) вызывается по мере получения результатов.
+    def get_chats_admins(self, progress=None):
+        # type: (callable) -> [(Chat, {int: ChatMember})]
+        bot = self.get_bot_member()
+        started = time()
+        found = 0
+        res = []  # (порядковый номер, чат, администраторы)
+        max_in_flight = self.chats_fanout_workers * 2
+        in_flight = {}  # future -> (порядковый номер, чат)
+        pool = ThreadPoolExecutor(max_workers=self.chats_fanout_workers)
+
+        def collect():
+            completed, _ = futures_wait(list(in_flight), return_when=FIRST_COMPLETED)
+            for f in completed:
+                i, chat_ = in_flight.pop(f)
+                res.append((i, chat_, f.result()))
+            if progress:
+                progress(len(res), found)
+
+        try:
+            for chat in self.iter_chats():
+                self.lgz.debug('Found chat => chat_id=%(id)s; type: %(type)s; status: %(status)s; title: %(title)s; participants: %(participants)s; owner: %(owner)s' %
+                               {'id': chat.chat_id, 'type': chat.type, 'status': chat.status, 'title': chat.title, 'participants': chat.participants_count, 'owner': chat.owner_id})
+                if chat.status in [ChatStatus.ACTIVE]:
+                    in_flight[pool.submit(self.get_chat_admins_ext, chat, bot)] = (found, chat)
+                    found += 1
+                    if len(in_flight) >= max_in_flight:
+                        collect()
+            while in_flight:
+                collect()
+        finally:
+            for f in in_flight:
+                f.cancel()
+            pool.shutdown(wait=False)
+        res.sort(key=lambda _: _[0])
+        self.lgz.info('Admins of %s chats received in %.3f sec.' % (len(res), time() - started))
+        return [(chat, admins) for _, chat, admins in res]
+
+    # Формирует список чатов пользователей, в которых админы и пользователь и бот с возможностью доп проверки разрешений
+    def get_all_chats_with_bot_admin(self, admin_only=False, progress=None):
+        # type: (bool, callable) -> dict
+        chats_available = {'Chats': {}, 'Members': {}, 'ChatsMembers': {}, }
+        chats_available_cm = chats_available['ChatsMembers']
+        chats_available_m = chats_available['Members']
+        chats_available_c = chats_available['Chats']
+        chats_all = {}
+
+        for chat, admins in self.get_chats_admins(progress):
+            bot_user = admins.get(self.user_id)
+            if bot_user:
+                for admin in admins.values():
+                    if admin.user_id != self.user_id:
+                        # chat_ext = chats_available[admin.user_id].get(chat.chat_id)
+                        chat_ext = chats_all.get(chat.chat_id)
+                        if not isinstance(chat_ext, ChatExt):
+                            chat_ext = ChatExt(chat, self.get_dialog_name(self.title, user=admin))
+                            chats_all[chat.chat_id] = chat_ext
+                        chat_ext.admin_permissions[self.user_id] = bot_user.permissions
+                        self.adm_perm_correct(chat_ext.admin_permissions[self.user_id])
+                        chat_ext.admin_permissions[admin.user_id] = admin.permissions
+                        self.adm_perm_correct(chat_ext.admin_permissions[admin.user_id])
+
+                        if chat_ext and (admin_only or self.chat_is_allowed(chat_ext, admin.user_id)):
+                            if chats_available_cm.get(admin.user_id) is None:
+                                chats_available_cm[admin.user_id] = {}
+                            if chats_available_c.get(chat_ext.chat_id) is None:
+                                chats_available_c[chat_ext.chat_id] = chat_ext
+                            if chats_available_m.get(admin.user_id) is None:
+                                chats_available_m[admin.user_id] = admins.get(admin.user_id)
+
+                            chats_available_cm[admin.user_id][chat.chat_id] = chat_ext
+            else:
+                self.lgz.debug('Pass, because for chat_id=%s bot (id=%s) is not admin' % (chat.chat_id, self.user_id))
         return chats_available
 
     @staticmethod
@@ -1269,13 +1593,12 @@ class TamTamBot(object):
     @staticmethod
     def limited_buttons_set(index, buttons):
         # type: (str, [[]]) -> None
-        TamTamBot.limited_buttons[index] = buttons
+        TamTamBot.limited_buttons.set(index, buttons)
 
     @staticmethod
     def limited_buttons_del(index):
         # type: (str) -> None
-        if index in TamTamBot.limited_buttons:
-            TamTamBot.limited_buttons.pop(index)
+        TamTamBot.limited_buttons.pop(index)
 
     def cmd_handler_get_buttons_oth(self, update):
         if not isinstance(update.update_current, MessageCallbackUpdate):
@@ -1398,7 +1721,7 @@ class TamTamBot(object):
                          add_info=False, add_close_button=False, start_from=None, max_lines=None):
         # type: (str or None, list, int or None, int or None, NewMessageLink, Update, int, str, str, str, bool, bool, int or None, int or None) -> SendMessageResult
         if lim_items:
-            first_call = update and UpdateCmn(update).cmd_args is None
+            first_call = update and UpdateCmn.get(update).cmd_args is None
             num_subscribers_cur = len(buttons)
             if num_subscribers_cur > lim_items:
                 b = buttons or []
@@ -1444,103 +1767,213 @@ class TamTamBot(object):
 
         return res
 
+    def prev_step_keys_load(self):
+        # Индекс ключей ожидающих ответа команд в памяти - позволяет не обращаться к БД, когда ответа не ждём.
+        # Отключается через TT_BOT_PREV_STEP_KEY_INDEX=False, если БД используется несколькими процессами.
+        if Utils.get_environ_bool('TT_BOT_PREV_STEP_KEY_INDEX', True):
+            # noinspection SqlResolve
+            rows = self.storage.fetchall('SELECT [index] FROM %(table)s' % {'table': self.prev_step_table_name})
+            self.prev_step_keys = set(row[0] for row in rows)
+            self.lgz.debug('Previous step keys loaded: %s' % len(self.prev_step_keys))
+        else:
+            self.prev_step_keys = None
+
     def prev_step_write(self, index, update):
         # type: (str, Update) -> None
-        if not self.prev_step_exists(index):
-            self.lgz.debug('Put index %s into previous step stack.' % index)
-            b_obj = self.serialize_update(update)
-            cursor = self.conn_srv.cursor()
-            # noinspection SqlResolve
-            cursor.execute(
-                'INSERT INTO %(table)s ([index], [update]) VALUES (:index, :update)' %
-                {'table': self.prev_step_table_name}, {'index': index, 'update': b_obj})
-            cursor.connection.commit()
-            cursor.close()
-        self.lgz.debug('previous step stack:\n%s' % self.prev_step_all())
+        self.lgz.debug('Put index %s into previous step stack.' % index)
+        b_obj = self.serialize_update(update)
+        # Уже имеющаяся запись не перезаписывается
+        # noinspection SqlResolve
+        self.storage.execute(
+            'INSERT INTO %(table)s ([index], [update]) VALUES (:index, :update) ON CONFLICT([index]) DO NOTHING' %
+            {'table': self.prev_step_table_name}, {'index': index, 'update': b_obj})
+        if self.prev_step_keys is not None:
+            with self.prev_step_lock:
+                self.prev_step_keys.add(index)
 
     def prev_step_exists(self, index):
         # type: (str) -> bool
-        update = self.prev_step_get(index)
-        if update:
-            return True
-        else:
-            return False
+        if self.prev_step_keys is not None:
+            return index in self.prev_step_keys
+        # noinspection SqlResolve
+        row = self.storage.fetchone(
+            'SELECT 1 FROM %(table)s WHERE [index]=:index' %
+            {'table': self.prev_step_table_name}, {'index': index})
+        return row is not None
 
     def prev_step_delete(self, index):
         # type: (str) -> None
-        if self.prev_step_exists(index):
-            self.lgz.debug('Deleting index %s from previous step stack.' % index)
-            cursor = self.conn_srv.cursor()
-            # noinspection SqlResolve
-            cursor.execute(
+        if self.prev_step_keys is not None:
+            with self.prev_step_lock:
+                if index not in self.prev_step_keys:
+                    return
+                self.prev_step_keys.discard(index)
+        # noinspection SqlResolve
+        if self.storage.execute(
                 'DELETE FROM %(table)s WHERE [index]=:index' %
-                {'table': self.prev_step_table_name}, {'index': index})
-            cursor.connection.commit()
-            cursor.close()
-            self.lgz.debug('previous step stack:\n%s' % self.prev_step_all())
+                {'table': self.prev_step_table_name}, {'index': index}):
+            self.lgz.debug('Deleted index %s from previous step stack.' % index)
 
     def prev_step_all(self):
         # type: () -> {}
+        # Полная выгрузка с десериализацией - только для диагностики
         res = {}
-        cursor = self.conn_srv.cursor()
         # noinspection SqlResolve
-        cursor.execute(
+        sql_res = self.storage.fetchall(
             'SELECT [index], [update] FROM %(table)s' %
             {'table': self.prev_step_table_name})
-        sql_res = cursor.fetchall()
-        cursor.close()
         if sql_res is not None:
             for row in sql_res:
                 res[row[0]] = self.deserialize_update(row[1])
         return res
 
+    def prev_step_dump(self):
+        # type: () -> str
+        res = self.prev_step_all()
+        self.lgz.info('previous step stack (%s):\n%s' % (len(res), res))
+        return str(res)
+
     def prev_step_get(self, index):
         # type: (str) -> Update
-        cursor = self.conn_srv.cursor()
+        if self.prev_step_keys is not None and index not in self.prev_step_keys:
+            return
         # noinspection SqlResolve
-        cursor.execute(
+        row = self.storage.fetchone(
             'SELECT [index], [update] FROM %(table)s WHERE [index]=:index' %
             {'table': self.prev_step_table_name}, {'index': index})
-        row = cursor.fetchone()
-        cursor.close()
         if row:
             return self.deserialize_update(row[1])
 
-    def upload_content(self, content, upload_type, content_name=None):
-        # type: ([], str, str) -> dict
+    @property
+    def upload_session(self):
+        # type: () -> requests.Session
+        # Общая сессия загрузки файлов: соединения с сервером загрузки переиспользуются (keep-alive)
+        if self._upload_session is None:
+            with self.upload_session_lock:
+                if self._upload_session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(self.upload_workers, 4))
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    session.verify = Utils.get_environ_bool('TT_BOT_UPLOAD_SSL_VERIFY', True)
+                    self._upload_session = session
+        return self._upload_session
+
+    def upload_content(self, content, upload_type, content_name=None, chunked=None, progress=None):
+        # type: (bytes or str or object, str, str, bool, callable) -> dict
+        # content - bytes, путь к файлу, файловый объект или итератор по bytes; передаётся потоком, без загрузки в память.
+        # Уже загружавшееся содержимое берётся из кэша по хэшу (отключается через TT_BOT_UPLOAD_CACHE=False).
+        # chunked - загрузка частями (см. ChunkedUpload); None - частями, если размер не меньше upload_chunked_threshold.
+        # progress(отправлено байт, всего байт) - ход загрузки частями
+        key = None
+        digest = None
+        if self.upload_cache is not None:
+            key = self.upload_cache.content_key(content)
+            if key:
+                upl = self.upload_cache.get(key, upload_type)
+                if upl is not None:
+                    self.lgz.debug('Upload skipped, token found in cache (%s bytes).' % key[1])
+                    return upl
+            else:
+                # Хэш неизвестен - вычисляется при передаче, без повторного чтения содержимого
+                digest = self.upload_cache.hasher()
+        # Частями загружается только содержимое известного размера
+        size = ChunkedUpload.content_size(content)
+        chunked = size is not None and (size >= self.upload_chunked_threshold if chunked is None else chunked)
         upload_ep = self.upload.get_upload_url(type=upload_type)
-        if isinstance(upload_ep, UploadEndpoint):
-            rdf = requests.post(
-                upload_ep.url, files={'files': ('file' if not content_name else content_name, content, 'multipart/form-data')},
-                verify=Utils.get_environ_bool('TT_BOT_UPLOAD_SSL_VERIFY', True),
-            )
+        if isinstance(upload_ep, UploadEndpoint) and chunked:
+            upl = self.upload_chunked(upload_ep.url, content, content_name, progress, digest)
+            if upl is None:
+                return
+            # Токен видео/аудио может выдаваться вместе с адресом загрузки, а не в ответе сервера загрузки
+            if not upl.get('token') and getattr(upload_ep, 'token', None):
+                upl = dict(upl, token=upload_ep.token)
+            self.upload_cache_set(content, upload_type, upl, key, digest, size)
+            self.attachment_readiness.uploaded(upl, upload_type)
+            return upl
+        elif isinstance(upload_ep, UploadEndpoint):
+            with MultipartStream(content, filename=content_name, digest=digest) as stream:
+                rdf = self.upload_session.post(upload_ep.url, data=stream.body, headers={'Content-Type': stream.content_type})
             if rdf.status_code == 200:
-                return rdf.json()
+                upl = rdf.json()
+                self.upload_cache_set(content, upload_type, upl, key, digest, stream.sent)
+                self.attachment_readiness.uploaded(upl, upload_type)
+                return upl
+
+    def upload_chunked(self, url, content, content_name=None, progress=None, digest=None):
+        # type: (str, bytes or str or object, str, callable, object) -> dict or None
+        # Если часть не удалось передать и после повторов, загрузка продолжается с подтверждённого сервером смещения
+        # (не более upload_chunk_resumes раз)
+        try:
+            cu = ChunkedUpload(
+                self.upload_session, url, content, content_name, self.upload_chunk_size, self.upload_chunk_max_retry,
+                progress=progress, digest=digest, lgz=self.lgz
+            )
+        except ChunkedUploadError as e:
+            self.lgz.warning('Chunked upload failed: %s' % e)
+            return
+        with cu:
+            resumes = 0
+            while True:
+                try:
+                    return cu.upload()
+                except ChunkedUploadError as e:
+                    if not e.retriable or resumes >= self.upload_chunk_resumes:
+                        self.lgz.warning('Chunked upload failed: %s; %s' % (e, cu.stats()))
+                        return
+                    resumes += 1
+                    self.lgz.warning('Chunked upload interrupted: %s; resuming from offset %s of %s.' % (e, cu.offset, cu.size))
+                    sleep(cu.retry_delay_max)
+
+    def upload_cache_set(self, content, upload_type, upl, key, digest, size):
+        # type: (object, str, dict, (str, int), object, int) -> None
+        # Сохранение результата загрузки в кэше; хэш, вычисленный при передаче файла, запоминается для этого файла
+        if self.upload_cache is None:
+            return
+        if key is None:
+            if digest is None:
+                return
+            key = (digest.hexdigest(), size)
+            if isinstance(content, str) and os.path.isfile(content):
+                self.upload_cache.set_file_hash(content, key)
+        self.upload_cache.set(key, upload_type, upl)
+
+    def attach_content(self, item, progress=None):
+        # type: ((object, str) or (object, str, str), callable) -> AttachmentRequest or None
+        klass = None
+        if item[1] == UploadType.VIDEO:
+            klass = VideoAttachmentRequest
+        elif item[1] == UploadType.IMAGE:
+            klass = PhotoAttachmentRequest
+        elif item[1] == UploadType.AUDIO:
+            klass = AudioAttachmentRequest
+        elif item[1] == UploadType.FILE:
+            klass = FileAttachmentRequest
+
+        if klass:
+            if not isinstance(item[0], dict):
+                upl = self.upload_content(item[0], item[1], None if len(item) < 3 else item[2], progress=progress)
+                if isinstance(upl, dict):
+                    return klass(upl)
+            else:
+                return klass(item[0])
 
-    def attach_contents(self, items):
-        # type: ([(bytes, str)]) -> []
+    def attach_contents(self, items, progress=None):
+        # type: ([(object, str)], callable) -> []
+        # Файлы загружаются параллельно (не более TT_BOT_UPLOAD_WORKERS одновременно), порядок вложений сохраняется.
+        # Большие файлы загружаются частями (см. upload_content); progress(номер вложения, отправлено байт, всего байт)
         if not items:
             return
-        attachments = []
-        for item in items:
-            klass = None
-            if item[1] == UploadType.VIDEO:
-                klass = VideoAttachmentRequest
-            elif item[1] == UploadType.IMAGE:
-                klass = PhotoAttachmentRequest
-            elif item[1] == UploadType.AUDIO:
-                klass = AudioAttachmentRequest
-            elif item[1] == UploadType.FILE:
-                klass = FileAttachmentRequest
-
-            if klass:
-                if not isinstance(item[0], dict):
-                    upl = self.upload_content(item[0], item[1], None if len(item) < 3 else item[2])
-                    if isinstance(upl, dict):
-                        attachments.append(klass(upl))
-                else:
-                    attachments.append(klass(item[0]))
-        return attachments
+
+        def attach(i):
+            return self.attach_content(items[i], (lambda sent, total: progress(i, sent, total)) if progress else None)
+
+        if len(items) == 1:
+            attachments = [attach(0)]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.upload_workers, len(items))) as pool:
+                attachments = list(pool.map(attach, range(len(items))))
+        return [_ for _ in attachments if _ is not None]
 
     # noinspection PyIncorrectDocstring
     def send_message(self, mb, max_retry=20, sl_time=1, **kwargs):
@@ -1555,6 +1988,9 @@ class TamTamBot(object):
                  returns the request thread.
         """
 
+        # Ожидание готовности вложений блокирует вызывающий поток; без блокировки - send_message_async
+        items = self.attachment_readiness.get_items(mb.attachments)
+        started = time()
         rpt = 0
         while rpt < max_retry:
             try:
@@ -1562,16 +1998,130 @@ class TamTamBot(object):
                 self.lgz.debug(str(rpt) + ' trying: send message with post')
                 res_msg = self.msg.send_message(mb, **kwargs)
                 self.lgz.debug(str(rpt) + ' trying: message is sent')
+                self.attachment_readiness.on_ready(items)
                 return res_msg
             except ApiException as e:
                 self.lgz.debug('Warning: status:%(status)s; reason:%(reason)s; body:%(body)s' % {'status': e.status, 'reason': e.reason, 'body': e.body})
-                if rpt >= max_retry or not (e.status == 400 and e.body.find('"code":"attachment.not.ready"') >= 0 or e.status == 429):
+                # Превышение частоты запросов (429) отрабатывается общим ограничителем запросов
+                if rpt >= max_retry or not self.is_attachment_not_ready(e):
+                    self.on_attachments_failed(mb, items, e)
                     raise
-                slt = sl_time
-                if e.status == 429:  # too.many.requests
-                    slt = 2
-                self.lgz.debug(str(rpt) + ' sleep: %s sec.' % slt)
-                sleep(slt)
+                delay = self.attachment_readiness.on_not_ready(items, started, sl_time)
+                self.lgz.debug(str(rpt) + ' sleep: %.2f sec.' % delay)
+                sleep(delay)
+
+    @staticmethod
+    def is_attachment_not_ready(e):
+        # type: (ApiException) -> bool
+        return e.status == 400 and bool(e.body) and e.body.find('"code":"attachment.not.ready"') >= 0
+
+    def on_attachments_failed(self, mb, items, e):
+        # type: (NewMessageBody, [(str, str)], Exception) -> None
+        self.attachment_readiness.forget(items)
+        # Сервер не принял вложение (а не просто ещё обрабатывает его) - его токен в кэше загрузок больше не годится
+        if isinstance(e, ApiException) and e.status == 400 and e.body and e.body.find('attachment') >= 0 and not self.is_attachment_not_ready(e) \
+                and self.upload_cache is not None:
+            for attachment in mb.attachments or []:
+                if isinstance(getattr(attachment, 'payload', None), dict):
+                    self.upload_cache.invalidate_token(attachment.payload)
+
+    @staticmethod
+    def outbound_key(chat_id=None, user_id=None, **kwargs):
+        # type: (int, int, dict) -> object
+        # Ключ очереди исходящих сообщений: сообщения одному получателю отправляются по порядку
+        return chat_id if chat_id is not None else 'user_id=%s' % user_id
+
+    # noinspection PyIncorrectDocstring
+    def send_message_async(self, mb, max_retry=20, sl_time=1, **kwargs):
+        # type: (NewMessageBody, int, int, dict) -> Future
+        """
+        Send message through the outbound queue without waiting for the server response.
+        :param NewMessageBody mb: (required)
+        :param int max_retry: maximum number of repetitions
+        :param int sl_time: delay time for repeating an error
+        :param int user_id: Fill this parameter if you want to send message to user
+        :param int chat_id: Fill this if you send message to chat
+        :return: Future with SendMessageResult
+        """
+        items = self.attachment_readiness.get_items(mb.attachments)
+        if not items:
+            return self.outbound.submit(self.outbound_key(**kwargs), self.send_message, mb, max_retry, sl_time, **kwargs)
+
+        # Сообщение с неготовыми вложениями откладывается планировщиком готовности и не занимает отправителя;
+        # пока оно ждёт, следующие сообщения тому же получателю могут быть отправлены раньше него
+        future = Future()
+        started = time()
+        not_ready = object()
+
+        def attempt():
+            try:
+                return self.msg.send_message(mb, **kwargs)
+            except ApiException as e:
+                if self.is_attachment_not_ready(e):
+                    return not_ready
+                raise
+
+        def submit(rpt):
+            if future.cancelled():
+                self.attachment_readiness.forget(items)
+                return
+            self.outbound.submit(self.outbound_key(**kwargs), attempt).add_done_callback(lambda f: on_done(f, rpt))
+
+        def on_done(f, rpt):
+            e = f.exception()
+            if e is None and f.result() is not_ready:
+                if rpt < max_retry:
+                    delay = self.attachment_readiness.on_not_ready(items, started, sl_time)
+                    self.lgz.debug('%s: attachments are not ready, retry in %.2f sec.' % (rpt, delay))
+                    if self.attachment_readiness.schedule(delay, submit, rpt + 1):
+                        return
+                e = TamTamBotException('Attachments are not ready after %s attempts.' % rpt)
+            if e is not None:
+                self.on_attachments_failed(mb, items, e)
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(e)
+            else:
+                self.attachment_readiness.on_ready(items)
+                if future.set_running_or_notify_cancel():
+                    future.set_result(f.result())
+
+        submit(1)
+        return future
+
+    def edit_message_async(self, mid, mb, chat_id=None):
+        # type: (str, NewMessageBody, int) -> Future
+        return self.outbound.submit(chat_id if chat_id is not None else mid, self.msg.edit_message, mid, mb)
+
+    def delete_message_async(self, mid, chat_id=None):
+        # type: (str, int) -> Future
+        return self.outbound.submit(chat_id if chat_id is not None else mid, self.delete_message, mid)
+
+    def delete_sent_message_async(self, future, **kwargs):
+        # type: (Future, dict) -> Future
+        # Удаление сообщения, отправленного send_message_async с теми же chat_id/user_id, - после его отправки.
+        # Удаление ставится в очередь по завершении отправки: ожидание в потоке-отправителе заблокировало бы полосу,
+        # в которую попадает повтор отложенной отправки (вложения не готовы).
+        res_future = Future()
+
+        def chain(f):
+            if not res_future.set_running_or_notify_cancel():
+                return
+            if f.cancelled():
+                res_future.set_result(None)
+            elif f.exception() is not None:
+                res_future.set_exception(f.exception())
+            else:
+                res_future.set_result(f.result())
+
+        def on_sent(f):
+            if f.cancelled() or f.exception() is not None or not isinstance(f.result(), SendMessageResult):
+                if res_future.set_running_or_notify_cancel():
+                    res_future.set_result(None)
+                return
+            self.outbound.submit_nowait(self.outbound_key(**kwargs), self.delete_message, f.result().message.body.mid).add_done_callback(chain)
+
+        future.add_done_callback(on_sent)
+        return res_future
 
     # noinspection PyIncorrectDocstring
     def send_message_long_text(self, mb, long_text, max_retry=20, sl_time=1, **kwargs):
@@ -1607,6 +2157,95 @@ class TamTamBot(object):
             res_list.append(res)
         return res_list
 
+    @staticmethod
+    def broadcast_recipients(recipients):
+        # type: (object) -> [str]
+        # Список получателей рассылки вида 'chat_id=...'/'user_id=...'. Принимаются: результат get_all_chats_with_bot_admin,
+        # словарь {chat_id: ChatExt}, а также итерируемые chat_id, Chat, ChatExt, {'chat_id': ...}/{'user_id': ...}
+        if isinstance(recipients, dict):
+            recipients = recipients['Chats'].keys() if isinstance(recipients.get('Chats'), dict) else recipients.keys()
+        res = []
+        for el in recipients:
+            if isinstance(el, (Chat, ChatExt)):
+                key = 'chat_id=%s' % el.chat_id
+            elif isinstance(el, dict):
+                key = 'user_id=%s' % el['user_id'] if el.get('user_id') else 'chat_id=%s' % el['chat_id']
+            else:
+                key = 'chat_id=%s' % el
+            if key not in res:
+                res.append(key)
+        return res
+
+    # Массовая рассылка сообщения: ограниченное число параллельных отправок (TT_BOT_BROADCAST_WORKERS) в пределах общего
+    # ограничения частоты запросов и собственного (TT_BOT_BROADCAST_RATE, чтобы не вытеснять обычную работу бота).
+    # Состояние по каждому получателю сохраняется в БД: повторный вызов с тем же broadcast_id продолжает рассылку,
+    # пропуская уже обработанных получателей. По умолчанию broadcast_id новый для каждого вызова (возвращается в отчёте),
+    # так что повтор того же сообщения позже - это новая рассылка. Журнал рассылок старше TT_BOT_BROADCAST_JOURNAL_TTL удаляется.
+    # progress(обработано, всего) вызывается по мере отправки. Возвращает отчёт.
+    def broadcast(self, mb, recipients, broadcast_id=None, workers=None, max_retry=20, sl_time=1, progress=None):
+        # type: (NewMessageBody, object, str, int, int, int, callable) -> dict
+        broadcast_id = broadcast_id or uuid.uuid4().hex
+        recipients = self.broadcast_recipients(recipients)
+        journal = self.broadcast_journal
+        if journal is not None:
+            journal.purge()
+        done = journal.get_done(broadcast_id) if journal is not None else {}
+        pending = [_ for _ in recipients if _ not in done]
+        workers = workers or self.broadcast_workers
+        limiter = RateLimiter(self.broadcast_rate, name='broadcast')
+        report = {'broadcast_id': broadcast_id, 'total': len(recipients), 'already_done': len(recipients) - len(pending),
+                  BroadcastJournal.SENT: 0, BroadcastJournal.SKIPPED: 0, BroadcastJournal.FAILED: 0}
+        self.lgz.info('Broadcast %s started: %s recipients, %s already done.' % (broadcast_id, report['total'], report['already_done']))
+
+        def send(recipient):
+            key, value = recipient.split('=', 1)
+            mid = error = None
+            limiter.acquire()
+            try:
+                res = self.send_message(mb, max_retry, sl_time, **{key: int(value)})
+                mid = res.message.body.mid if isinstance(res, SendMessageResult) else None
+                status = BroadcastJournal.SENT
+            except ApiException as e:
+                # Бот заблокирован, удалён из чата или чат не найден - повторять бессмысленно
+                status = BroadcastJournal.SKIPPED if e.status in (403, 404) else BroadcastJournal.FAILED
+                error = '%s: %s' % (e.status, e.body)
+            except Exception as e:
+                status = BroadcastJournal.FAILED
+                error = repr(e)
+            if journal is not None:
+                journal.set_status(broadcast_id, recipient, status, mid, error)
+            return status
+
+        started = time()
+        processed = 0
+        max_in_flight = workers * 2
+        in_flight = set()
+        pool = ThreadPoolExecutor(max_workers=workers)
+        try:
+            pending_i = iter(pending)
+            while True:
+                for recipient in pending_i:
+                    in_flight.add(pool.submit(send, recipient))
+                    if len(in_flight) >= max_in_flight:
+                        break
+                if not in_flight:
+                    break
+                completed, in_flight = futures_wait(in_flight, return_when=FIRST_COMPLETED)
+                for f in completed:
+                    report[f.result()] += 1
+                    processed += 1
+                if progress:
+                    progress(processed, len(pending))
+        finally:
+            for f in in_flight:
+                f.cancel()
+            pool.shutdown(wait=True)
+        elapsed = time() - started
+        report['elapsed'] = round(elapsed, 3)
+        report['throughput'] = round(report[BroadcastJournal.SENT] / elapsed, 3) if elapsed else 0.0
+        self.lgz.info('Broadcast %s finished: %s' % (broadcast_id, report))
+        return report
+
     def send_notification(self, update, notification):
         """
 
@@ -1653,57 +2292,90 @@ class TamTamBot(object):
 
         return res
 
-    def get_chat_messages(self, chat_id, dt_end=None, dt_start=None, max_msg=1000):
-        # type: (int, datetime, datetime, int or None) -> [Message]
-        message_list = []
+    # Сообщения чата от dt_end к dt_start (от новых к старым), не более max_msg (None - без ограничения)
+    def iter_chat_messages(self, chat_id, dt_end=None, dt_start=None, max_msg=None):
+        # type: (int, datetime, datetime, int or None) -> Iterator[Message]
         ut_start = Utils.datetime_to_unix_time(dt_start) if dt_start else None
         dt_end = dt_end or datetime.now().astimezone() + timedelta(seconds=1)
-        ut_end = Utils.datetime_to_unix_time(dt_end)
-        # [(_.timestamp, datetime_from_unix_time(_.timestamp)) for _ in m_l]
-        while True:
+
+        def fetch_page(ut_end):
             m_l = self.msg.get_messages(chat_id=chat_id, count=MessagesApi.MAX_MESSAGE_COUNT, _from=ut_end).messages
-            if not m_l:
+            if not m_l or (ut_start and m_l[0].timestamp < ut_start):
+                return [], None
+            # [(_.timestamp, datetime_from_unix_time(_.timestamp)) for _ in m_l]
+            return m_l, m_l[-1].timestamp - 1
+
+        cnt = 0
+        for message in self.iter_pages(fetch_page, Utils.datetime_to_unix_time(dt_end), name='messages-prefetch'):
+            cnt += 1
+            yield message
+            if max_msg and cnt >= max_msg:
                 break
-            if ut_start and m_l[0].timestamp < ut_start:
-                break
-            message_list.extend(m_l)
-            ut_end = m_l[-1].timestamp - 1
-            if max_msg and len(message_list) >= max_msg:
-                break
-        return message_list[:max_msg]
+
+    def get_chat_messages(self, chat_id, dt_end=None, dt_start=None, max_msg=1000):
+        # type: (int, datetime, datetime, int or None) -> [Message]
+        return list(self.iter_chat_messages(chat_id, dt_end, dt_start, max_msg))
 
     def get_messages(self, mid_list):
         # type: ([str]) -> [Message]
         try:
             ml = self.msg.get_messages(message_ids=mid_list)
             if isinstance(ml, MessageList) and ml.messages:
+                for message in ml.messages:
+                    self.message_cache.put(message)
                 return ml.messages
         except ApiException:
             pass
 
+    # Запрос сообщений по списку mid одним запросом. При ошибке, указывающей на "битый" mid (400, 404, ошибка разбора ответа),
+    # список делится пополам и части запрашиваются отдельно, так что такие mid выделяются за O(log n) запросов.
+    # Прочие ошибки (429, 5xx и т.п.) не связаны с конкретными mid - часть не делится и не запрашивается по одному.
+    # Возвращает (полученные сообщения, mid, которые получить пакетно не удалось, mid, запрос которых не выполнен)
+    def get_message_chunk(self, mid_list):
+        # type: ([str]) -> ([Message], [str], [str])
+        try:
+            msg_m_list = self.msg.get_messages(message_ids=mid_list, count=MessagesApi.MAX_MESSAGE_COUNT)
+        except (ApiException, ValueError) as e:
+            if isinstance(e, ApiException) and e.status not in (400, 404):
+                self.lgz.warning('Messages request failed (status %s), %s mid not processed.' % (e.status, len(mid_list)))
+                return [], [], mid_list
+            if len(mid_list) == 1:
+                return [], mid_list, []
+            half = len(mid_list) // 2
+            m_l_1, rest_1, failed_1 = self.get_message_chunk(mid_list[:half])
+            m_l_2, rest_2, failed_2 = self.get_message_chunk(mid_list[half:])
+            return m_l_1 + m_l_2, rest_1 + rest_2, failed_1 + failed_2
+        messages = msg_m_list.messages if isinstance(msg_m_list, MessageList) and msg_m_list.messages else []
+        for message in messages:
+            self.message_cache.put(message)
+        getting_mid_list = set(_.body.mid for _ in messages)
+        return messages, [mid for mid in mid_list if mid not in getting_mid_list], []
+
     # Возвращает список сообщений по списку mid ов
     def get_message_list(self, mid_list):
         # type: ([str]) -> [Message]
+        # Сообщения берутся из кэша, остальные части списка запрашиваются параллельно
+        # (не более TT_BOT_MESSAGES_FETCH_WORKERS запросов одновременно), mid, не полученные пакетно, - по одному.
+        # mid частей, запрос которых не выполнен из-за сбоя API, возвращаются как необработанные
         message_list = []
         bad_mid_list = []
+        fetch_mid_list = []
+        for mid in mid_list:
+            message = self.message_cache.get(mid)
+            if message is not None:
+                message_list.append(message)
+            else:
+                fetch_mid_list.append(mid)
         max_cnt_for_mid_list = 80
-        for i in range(math.ceil(len(mid_list) / max_cnt_for_mid_list)):
-            cur_mid_list = mid_list[(i * max_cnt_for_mid_list):((i + 1) * max_cnt_for_mid_list)]
-            try:
-                msg_m_list = self.msg.get_messages(message_ids=cur_mid_list, count=MessagesApi.MAX_MESSAGE_COUNT)
-                if msg_m_list:
-                    message_list.extend(msg_m_list.messages)
-                    getting_mid_list = [_.body.mid for _ in msg_m_list.messages]
-                    for mid in cur_mid_list:
-                        if mid not in getting_mid_list:
-                            msg = self.get_message(mid)
-                            if msg:
-                                message_list.append(msg)
-                            else:
-                                bad_mid_list.append(mid)
-            except (ApiException, ValueError):
-                for mid in cur_mid_list:
-                    msg = self.get_message(mid)
+        chunks = [fetch_mid_list[i:i + max_cnt_for_mid_list] for i in range(0, len(fetch_mid_list), max_cnt_for_mid_list)]
+        if chunks:
+            rest_mid_list = []
+            with ThreadPoolExecutor(max_workers=self.messages_fetch_workers) as pool:
+                for m_l, rest, failed in pool.map(self.get_message_chunk, chunks):
+                    message_list.extend(m_l)
+                    rest_mid_list.extend(rest)
+                    bad_mid_list.extend(failed)
+                for mid, msg in zip(rest_mid_list, pool.map(self.get_message, rest_mid_list)):
                     if msg:
                         message_list.append(msg)
                     else:
@@ -1715,8 +2387,10 @@ class TamTamBot(object):
 
         return message_list
 
-    def get_message(self, mid):
-        # type: ([str]) -> Message
+    def get_message(self, mid, cached=True):
+        # type: (str, bool) -> Message
+        if cached:
+            return self.message_cache.get_or_load(mid, self.get_message, mid, False)
         try:
             return self.msg.get_message_by_id(mid)
         except (ApiException, ValueError):
@@ -0,0 +1,174 @@
+# -*- coding: UTF-8 -*-
+import hashlib
+import os
+import re
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from time import time
+
+from TamTamBot.cls.RateLimiter import RateLimiter
+
+
+class AdminAlerter(object):
+    # Оповещение администраторов об ошибках без "шторма" сообщений.
+    # Исключения различаются по отпечатку (класс исключения и места в стеке вызовов, без текста сообщения):
+    # о первом появлении сообщается сразу, повторы только подсчитываются и раз в digest_period секунд
+    # отправляются одной сводкой. Отпечаток, не повторявшийся forget_period секунд, забывается -
+    # следующее его появление снова оповещается сразу.
+    # Текстовые оповещения без исключения различаются по тексту, в котором числа не учитываются.
+    # Рассылка по контактам администраторов идёт параллельно и в пределах собственного ограничения частоты.
+
+    def __init__(self, deliver, digest_period=60, forget_period=3600, rate=1, burst=10, workers=4, lgz=None):
+        # type: (callable, float, float, float, float, int, object) -> None
+        # deliver(текст) - отправка сводки администраторам
+        self.deliver = deliver
+        self.digest_period = digest_period
+        self.forget_period = forget_period
+        self.lgz = lgz
+
+        self.limiter = RateLimiter(rate, burst, name='admin_alerts')
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.fingerprints = {}  # отпечаток -> {'summary', 'first', 'last', 'count', 'repeats'}
+        self.stop_event = threading.Event()
+        self.stopped = False
+        self.thread = None
+
+        self.alerts = 0
+        self.suppressed = 0
+        self.digests = 0
+        self.dropped = 0
+
+    @staticmethod
+    def fingerprint(exception):
+        # type: (Exception) -> str
+        frames = traceback.extract_tb(exception.__traceback__) if getattr(exception, '__traceback__', None) else []
+        sign = [exception.__class__.__module__, exception.__class__.__name__]
+        sign.extend('%s:%s:%s' % (os.path.basename(f[0]), f[2], f[1]) for f in frames[-5:])
+        return hashlib.sha1('|'.join(sign).encode('utf-8')).hexdigest()[:16]
+
+    @staticmethod
+    def summary(exception):
+        # type: (Exception) -> str
+        frames = traceback.extract_tb(exception.__traceback__) if getattr(exception, '__traceback__', None) else []
+        where = (' at %s:%s in %s' % (os.path.basename(frames[-1][0]), frames[-1][1], frames[-1][2])) if frames else ''
+        return '%s: %s%s' % (exception.__class__.__name__, str(exception)[:200], where)
+
+    @staticmethod
+    def text_fingerprint(text):
+        # type: (str) -> str
+        return hashlib.sha1(('text|%s' % re.sub(r'\d+', '#', text)).encode('utf-8')).hexdigest()[:16]
+
+    def check(self, exception):
+        # type: (Exception) -> bool
+        # True - оповестить сразу, False - повтор, будет учтён в сводке
+        return self._check(self.fingerprint(exception), lambda: self.summary(exception))
+
+    def check_text(self, text):
+        # type: (str) -> bool
+        return self._check(self.text_fingerprint(text), lambda: text[:200])
+
+    def _check(self, fp, get_summary):
+        # type: (str, callable) -> bool
+        now = time()
+        with self.lock:
+            el = self.fingerprints.get(fp)
+            if el is not None:
+                el['count'] += 1
+                el['repeats'] += 1
+                el['last'] = now
+                self.suppressed += 1
+                res = False
+            else:
+                self.fingerprints[fp] = {'summary': get_summary(), 'first': now, 'last': now, 'count': 1, 'repeats': 0}
+                self.alerts += 1
+                res = True
+        self.start()
+        return res
+
+    def acquire(self, timeout=None):
+        # type: (float) -> bool
+        # Разрешение на отправку одного сообщения администраторам в пределах собственного ограничения частоты
+        if self.limiter.acquire(timeout=timeout):
+            return True
+        with self.lock:
+            self.dropped += 1
+        return False
+
+    def map(self, func, items):
+        # type: (callable, list) -> list
+        # Параллельная рассылка; после остановки - последовательно в вызывающем потоке
+        if not self.stopped:
+            try:
+                return list(self.pool.map(func, items))
+            except RuntimeError:
+                if not self.stopped:
+                    raise
+        return [func(item) for item in items]
+
+    def start(self):
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self._run, name='admin-alerts-digest')
+                    self.thread.daemon = True
+                    self.thread.start()
+
+    def _run(self):
+        while not self.stop_event.wait(self.digest_period):
+            # noinspection PyBroadException
+            try:
+                self.send_digest()
+            except Exception:
+                if self.lgz:
+                    self.lgz.exception('Exception')
+
+    def get_digest(self):
+        # type: () -> [dict]
+        # Повторы с прошлой сводки; давно не повторявшиеся отпечатки забываются
+        now = time()
+        res = []
+        with self.lock:
+            for fp, el in list(self.fingerprints.items()):
+                if el['repeats']:
+                    res.append(dict(el, fingerprint=fp))
+                    el['repeats'] = 0
+                elif now - el['last'] > self.forget_period:
+                    self.fingerprints.pop(fp)
+        return res
+
+    def send_digest(self):
+        # type: () -> bool
+        digest = self.get_digest()
+        if not digest:
+            return False
+        lines = ['Errors repeated during last %s sec.:' % self.digest_period]
+        for el in sorted(digest, key=lambda _: -_['repeats']):
+            lines.append('%s × %s (total %s, first %s, last %s) [%s]' % (
+                el['repeats'], el['summary'], el['count'],
+                datetime.fromtimestamp(el['first']).strftime('%Y-%m-%d %H:%M:%S'), datetime.fromtimestamp(el['last']).strftime('%H:%M:%S'),
+                el['fingerprint'],
+            ))
+        self.deliver('\n'.join(lines))
+        self.digests += 1
+        return True
+
+    def stop(self):
+        self.stop_event.set()
+        self.stopped = True
+        # noinspection PyBroadException
+        try:
+            self.send_digest()
+        except Exception:
+            if self.lgz:
+                self.lgz.exception('Exception')
+        self.pool.shutdown(wait=False)
+
+    def stats(self):
+        # type: () -> dict
+        return {
+            'fingerprints': len(self.fingerprints), 'alerts': self.alerts, 'suppressed': self.suppressed,
+            'digests': self.digests, 'dropped': self.dropped, 'limiter': self.limiter.stats(),
+        }
@@ -0,0 +1,50 @@
+# -*- coding: UTF-8 -*-
+from TamTamBot.cls.BoundedStore import BoundedStore
+from TamTamBot.cls.RateLimiter import RateLimiter
+
+
+class ApiRateLimiter(object):
+    # Общий для процесса ограничитель запросов к API: глобальная корзина и корзины отдельных чатов (получателей).
+    # Корзины чатов создаются по требованию и хранятся в BoundedStore - давно не использованные вытесняются.
+    # При отказе сервера (429) по запросу к чату приостанавливается только корзина этого чата,
+    # а глобальная частота снижается; отказ по запросу без чата приостанавливает глобальную корзину.
+
+    def __init__(self, rate=30, chat_rate=5, chat_burst=10, max_chats=10000):
+        # type: (float, float, float, int) -> None
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.limiter = RateLimiter(rate, name='api')
+        self.chats = BoundedStore(max_chats, 600, name='api_chats_limiters')
+
+    def get_chat_limiter(self, key):
+        # type: (object) -> RateLimiter
+        return self.chats.update_with(key, lambda limiter: limiter or RateLimiter(self.chat_rate, self.chat_burst, name=str(key)))
+
+    def acquire(self, key=None, timeout=None):
+        # type: (object, float) -> bool
+        # key - идентификатор чата (получателя) или None
+        if key is not None and not self.get_chat_limiter(key).acquire(timeout=timeout):
+            return False
+        return self.limiter.acquire(timeout=timeout)
+
+    def on_success(self, key=None):
+        # type: (object) -> None
+        self.limiter.on_success()
+        if key is not None:
+            limiter = self.chats.get(key)
+            if limiter is not None:
+                limiter.on_success()
+
+    def on_throttled(self, key=None, retry_after=None):
+        # type: (object, float) -> None
+        if key is None:
+            self.limiter.on_throttled(retry_after)
+        else:
+            self.get_chat_limiter(key).on_throttled(retry_after)
+            self.limiter.on_throttled(block=False)
+
+    def stats(self):
+        # type: () -> dict
+        res = self.limiter.stats()
+        res.update({'chats': self.chats.stats()})
+        return res
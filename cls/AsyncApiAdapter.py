@@ -0,0 +1,27 @@
+# -*- coding: UTF-8 -*-
+import asyncio
+import functools
+from concurrent.futures import Executor
+
+
+class AsyncApiAdapter(object):
+    # Обёртка над блокирующим API-объектом openapi_client: каждый метод возвращает корутину,
+    # а сам вызов выполняется в пуле потоков.
+    # Пример: msg = await AsyncApiAdapter(MessagesApi(client), executor).send_message(mb, chat_id=chat_id)
+
+    def __init__(self, api, executor=None):
+        # type: (object, Executor) -> None
+        self.api = api
+        self.executor = executor
+
+    def __getattr__(self, item):
+        attr = getattr(self.api, item)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        async def wrapper(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(attr, *args, **kwargs))
+
+        return wrapper
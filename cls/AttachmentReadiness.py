@@ -0,0 +1,165 @@
+# -*- coding: UTF-8 -*-
+import heapq
+import json
+import random
+import threading
+from time import time
+
+from TamTamBot.cls.BoundedStore import BoundedStore
+
+
+class AttachmentReadiness(object):
+    # Учёт готовности загруженных вложений (сервер обрабатывает видео, аудио и т.п. некоторое время после загрузки).
+    # Для каждого токена запоминаются время загрузки и число неудачных попыток; задержка до следующей попытки
+    # отправки - не меньше ожидаемого оставшегося времени обработки и растёт с числом попыток, со случайным
+    # разбросом (jitter), чтобы сообщения с одинаковыми вложениями не повторялись одновременно.
+    # Ожидаемое время обработки - скользящее среднее (EWMA) фактического времени по типу вложения.
+    # Отложенные действия выполняет один поток-таймер (куча по времени), рабочие потоки не ждут.
+
+    def __init__(self, min_delay=0.5, max_delay=30, factor=1.5, jitter=0.3, alpha=0.3, max_tokens=10000, token_ttl=3600, lgz=None):
+        # type: (float, float, float, float, float, int, float, object) -> None
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.factor = factor
+        self.jitter = jitter
+        self.alpha = alpha
+        self.lgz = lgz
+
+        self.tokens = BoundedStore(max_tokens, token_ttl, name='attachment_tokens')  # токен -> {'type', 'uploaded', 'attempts'}
+        self.expected = {}  # тип вложения -> ожидаемое время обработки, сек.
+        self.samples = {}  # тип вложения -> число замеров
+        self.lock = threading.Lock()
+
+        self.heap = []  # (время выполнения, порядковый номер, функция, аргументы)
+        self.seq = 0
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.thread = None
+
+        self.not_ready = 0
+        self.ready_count = 0
+        self.parked = 0
+        self.rejected = 0
+
+    @staticmethod
+    def token_key(payload):
+        # type: (object) -> str or None
+        if isinstance(payload, dict):
+            return payload.get('token') or json.dumps(payload, sort_keys=True)
+        return getattr(payload, 'token', None)
+
+    def get_items(self, attachments):
+        # type: (list) -> [(str, str)]
+        # (токен, тип) вложений сообщения, требующих загрузки
+        res = []
+        for attachment in attachments or []:
+            key = self.token_key(getattr(attachment, 'payload', None))
+            if key:
+                res.append((key, getattr(attachment, 'type', None)))
+        return res
+
+    def uploaded(self, payload, media_type):
+        # type: (object, str) -> None
+        key = self.token_key(payload)
+        if key:
+            self.tokens.set(key, {'type': media_type, 'uploaded': time(), 'attempts': 0})
+
+    def on_not_ready(self, items, started, min_delay=None):
+        # type: ([(str, str)], float, float) -> float
+        # Вложения ещё не готовы - задержка до следующей попытки, сек.
+        now = time()
+        delay = 0
+        for key, media_type in items:
+            state = self.tokens.update_with(
+                key, lambda _: dict(_ or {'type': media_type, 'uploaded': started}, attempts=(_ or {}).get('attempts', 0) + 1)
+            )
+            expected_left = self.expected.get(state['type'] or media_type, 0) - (now - state['uploaded'])
+            backoff = (min_delay or self.min_delay) * self.factor ** (state['attempts'] - 1)
+            delay = max(delay, expected_left, backoff)
+        self.not_ready += 1
+        delay = min(max(delay, min_delay or self.min_delay), self.max_delay)
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def on_ready(self, items):
+        # type: ([(str, str)]) -> None
+        # Сообщение с вложениями отправлено - учёт времени обработки (от загрузки или первой неудачной попытки)
+        now = time()
+        for key, media_type in items:
+            state = self.tokens.pop(key)
+            if state is None or not (state['type'] or media_type):
+                # Время загрузки неизвестно - замер не учитывается
+                continue
+            media_type = state['type'] or media_type
+            sample = now - state['uploaded']
+            with self.lock:
+                prev = self.expected.get(media_type)
+                self.expected[media_type] = sample if prev is None else prev + self.alpha * (sample - prev)
+                self.samples[media_type] = self.samples.get(media_type, 0) + 1
+        if items:
+            self.ready_count += 1
+
+    def forget(self, items):
+        # type: ([(str, str)]) -> None
+        for key, _ in items:
+            self.tokens.pop(key)
+
+    def schedule(self, delay, func, *args):
+        # type: (float, callable, list) -> bool
+        # Выполнение func(*args) в потоке-таймере через delay секунд; False - планировщик остановлен
+        with self.cond:
+            if self.stopped:
+                self.rejected += 1
+                return False
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='attachment-readiness')
+                self.thread.daemon = True
+                self.thread.start()
+            self.seq += 1
+            heapq.heappush(self.heap, (time() + delay, self.seq, func, args))
+            self.parked += 1
+            self.cond.notify()
+        return True
+
+    def _run(self):
+        while True:
+            due = []
+            with self.cond:
+                while not self.stopped and (not self.heap or self.heap[0][0] > time()):
+                    self.cond.wait(self.heap[0][0] - time() if self.heap else None)
+                now = time()
+                while self.heap and (self.stopped or self.heap[0][0] <= now):
+                    due.append(heapq.heappop(self.heap))
+                stopped = self.stopped
+            for _, _, func, args in due:
+                # noinspection PyBroadException
+                try:
+                    func(*args)
+                except Exception:
+                    if self.lgz:
+                        self.lgz.exception('Exception')
+            if stopped:
+                break
+
+    def stop(self):
+        # Отложенные действия выполняются сразу (последняя попытка), новые не принимаются
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+            thread = self.thread
+        if thread is not None:
+            thread.join()
+
+    @property
+    def waiting(self):
+        # type: () -> int
+        return len(self.heap)
+
+    def stats(self):
+        # type: () -> dict
+        with self.lock:
+            expected = {k: round(v, 3) for k, v in self.expected.items()}
+            samples = dict(self.samples)
+        return {
+            'waiting': self.waiting, 'parked': self.parked, 'not_ready': self.not_ready, 'ready': self.ready_count,
+            'rejected': self.rejected, 'expected': expected, 'samples': samples, 'tokens': self.tokens.stats(),
+        }
@@ -0,0 +1,130 @@
+# -*- coding: UTF-8 -*-
+import threading
+from collections import OrderedDict
+from time import time
+
+
+class BoundedStore(object):
+    # Потокобезопасный словарь ограниченного размера с вытеснением давно не использованных записей (LRU)
+    # и ограничением времени жизни записей (TTL).
+    # Ключи распределены по нескольким сегментам со своими блокировками (lock striping),
+    # поэтому параллельные обращения к разным ключам почти не конкурируют.
+
+    def __init__(self, max_size=10000, ttl=None, stripes=16, name=None):
+        # type: (int, float or None, int, str) -> None
+        self.max_size = max(max_size, 1)
+        self.ttl = ttl
+        self.name = name
+        stripes = max(min(stripes, self.max_size), 1)
+        self.stripe_max_size = max(self.max_size // stripes, 1)
+        self.stripes = [(threading.Lock(), OrderedDict()) for _ in range(stripes)]
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _stripe(self, key):
+        # type: (object) -> (threading.Lock, OrderedDict)
+        return self.stripes[hash(key) % len(self.stripes)]
+
+    def _get(self, data, key, now):
+        # Под блокировкой сегмента. Возвращает запись (значение, срок) или None
+        el = data.get(key)
+        if el is None:
+            return None
+        if el[1] is not None and el[1] <= now:
+            data.pop(key)
+            self.expirations += 1
+            return None
+        data.move_to_end(key)
+        return el
+
+    def _set(self, data, key, value, ttl, now):
+        # Под блокировкой сегмента
+        ttl = self.ttl if ttl is None else ttl
+        data[key] = (value, now + ttl if ttl else None)
+        data.move_to_end(key)
+        while len(data) > self.stripe_max_size:
+            data.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key, default=None):
+        lock, data = self._stripe(key)
+        with lock:
+            el = self._get(data, key, time())
+            if el is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return el[0]
+
+    def set(self, key, value, ttl=None):
+        # type: (object, object, float) -> None
+        lock, data = self._stripe(key)
+        with lock:
+            self._set(data, key, value, ttl, time())
+
+    def update_with(self, key, func, ttl=None):
+        # type: (object, callable, float) -> object
+        # Атомарное изменение: новое значение = func(старое значение или None)
+        lock, data = self._stripe(key)
+        with lock:
+            now = time()
+            el = self._get(data, key, now)
+            value = func(el[0] if el is not None else None)
+            self._set(data, key, value, ttl, now)
+            return value
+
+    def pop(self, key, default=None):
+        lock, data = self._stripe(key)
+        with lock:
+            el = data.pop(key, None)
+            return el[0] if el is not None else default
+
+    def clear(self):
+        for lock, data in self.stripes:
+            with lock:
+                data.clear()
+
+    def keys(self):
+        # type: () -> list
+        res = []
+        now = time()
+        for lock, data in self.stripes:
+            with lock:
+                res.extend(k for k, el in data.items() if el[1] is None or el[1] > now)
+        return res
+
+    def __getitem__(self, key):
+        lock, data = self._stripe(key)
+        with lock:
+            el = self._get(data, key, time())
+        if el is None:
+            raise KeyError(key)
+        return el[0]
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        lock, data = self._stripe(key)
+        with lock:
+            del data[key]
+
+    def __contains__(self, key):
+        lock, data = self._stripe(key)
+        with lock:
+            return self._get(data, key, time()) is not None
+
+    def __len__(self):
+        return sum(len(data) for _, data in self.stripes)
+
+    def stats(self):
+        # type: () -> dict
+        total = self.hits + self.misses
+        return {
+            'name': self.name, 'size': len(self), 'max_size': self.max_size, 'ttl': self.ttl,
+            'hits': self.hits, 'misses': self.misses, 'hit_ratio': round(self.hits / total, 4) if total else 0.0,
+            'evictions': self.evictions, 'expirations': self.expirations,
+        }
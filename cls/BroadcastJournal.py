@@ -0,0 +1,91 @@
+# -*- coding: UTF-8 -*-
+from time import time
+
+from TamTamBot.cls.SqliteStorage import SqliteStorage
+
+
+# noinspection SqlResolve,SqlNoDataSourceInspection,SqlDialectInspection
+class BroadcastJournal(object):
+    # Журнал рассылок: состояние отправки каждому получателю, чтобы прерванную рассылку можно было продолжить.
+    # Состояния: sent - отправлено, skipped - получатель недоступен (повторять бессмысленно), failed - ошибка (повторяется при возобновлении).
+    # Файл БД может быть общим для нескольких ботов, поэтому записи привязаны к bot_id (user_id бота).
+    # Записи старше ttl секунд (по последнему изменению рассылки) удаляются методом purge.
+    SENT = 'sent'
+    SKIPPED = 'skipped'
+    FAILED = 'failed'
+
+    def __init__(self, storage, bot_id, table_name='tamtambot_broadcast', ttl=7 * 86400):
+        # type: (SqliteStorage, int, str, float) -> None
+        if bot_id is None:
+            raise ValueError("Invalid value for `bot_id`, must not be `None`")  # noqa: E501
+        self.storage = storage
+        self.bot_id = bot_id
+        self.table_name = table_name
+        self.ttl = ttl
+        # Таблица прежнего формата (без bot_id) удаляется
+        columns = [row[1] for row in self.storage.fetchall('PRAGMA table_info(%s)' % self.table_name)]
+        if columns and 'bot_id' not in columns:
+            self.storage.executescript('DROP TABLE IF EXISTS %s;' % self.table_name)
+        self.storage.executescript('''
+            CREATE TABLE IF NOT EXISTS %(table)s (
+                [bot_id]       INT       NOT NULL,
+                [broadcast_id] CHAR (64) NOT NULL,
+                [recipient]    CHAR (64) NOT NULL,
+                [status]       CHAR (10) NOT NULL,
+                [mid]          TEXT,
+                [error]        TEXT,
+                [updated]      REAL,
+                PRIMARY KEY ([bot_id], [broadcast_id], [recipient])
+            );
+            CREATE INDEX IF NOT EXISTS %(table)s_updated ON %(table)s ([bot_id], [updated]);
+        ''' % {'table': self.table_name})
+        self.sql_set = (
+            'INSERT INTO %(table)s ([bot_id], [broadcast_id], [recipient], [status], [mid], [error], [updated]) '
+            'VALUES (:bot_id, :broadcast_id, :recipient, :status, :mid, :error, :updated) '
+            'ON CONFLICT([bot_id], [broadcast_id], [recipient]) DO UPDATE SET '
+            '[status]=excluded.[status], [mid]=excluded.[mid], [error]=excluded.[error], [updated]=excluded.[updated]' % {'table': self.table_name}
+        )
+
+    def get_done(self, broadcast_id):
+        # type: (str) -> {str: str}
+        # Получатели, по которым рассылка завершена (отправлено или пропущено): получатель -> состояние
+        rows = self.storage.fetchall(
+            'SELECT [recipient], [status] FROM %(table)s WHERE [bot_id]=:bot_id AND [broadcast_id]=:broadcast_id AND [status] IN (:sent, :skipped)'
+            % {'table': self.table_name},
+            {'bot_id': self.bot_id, 'broadcast_id': broadcast_id, 'sent': self.SENT, 'skipped': self.SKIPPED}
+        )
+        return {row[0]: row[1] for row in rows}
+
+    def set_status(self, broadcast_id, recipient, status, mid=None, error=None):
+        # type: (str, str, str, str, str) -> None
+        self.storage.execute(self.sql_set, {
+            'bot_id': self.bot_id, 'broadcast_id': broadcast_id, 'recipient': recipient, 'status': status, 'mid': mid,
+            'error': error[:1000] if error else None, 'updated': time(),
+        })
+
+    def get_report(self, broadcast_id):
+        # type: (str) -> {str: int}
+        rows = self.storage.fetchall(
+            'SELECT [status], COUNT(*) FROM %(table)s WHERE [bot_id]=:bot_id AND [broadcast_id]=:broadcast_id GROUP BY [status]' % {'table': self.table_name},
+            {'bot_id': self.bot_id, 'broadcast_id': broadcast_id}
+        )
+        return {row[0]: row[1] for row in rows}
+
+    def delete(self, broadcast_id):
+        # type: (str) -> int
+        return self.storage.execute(
+            'DELETE FROM %(table)s WHERE [bot_id]=:bot_id AND [broadcast_id]=:broadcast_id' % {'table': self.table_name},
+            {'bot_id': self.bot_id, 'broadcast_id': broadcast_id}
+        )
+
+    def purge(self):
+        # type: () -> int
+        # Удаление рассылок, не изменявшихся дольше ttl (рассылка удаляется целиком, чтобы её нельзя было продолжить частично)
+        if not self.ttl:
+            return 0
+        return self.storage.execute(
+            'DELETE FROM %(table)s WHERE [bot_id]=:bot_id AND [broadcast_id] IN ('
+            'SELECT [broadcast_id] FROM %(table)s WHERE [bot_id]=:bot_id GROUP BY [broadcast_id] HAVING MAX([updated])<:updated)'
+            % {'table': self.table_name},
+            {'bot_id': self.bot_id, 'updated': time() - self.ttl}
+        )
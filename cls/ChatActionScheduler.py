@@ -0,0 +1,119 @@
+# -*- coding: UTF-8 -*-
+import heapq
+import threading
+from time import time
+
+from openapi_client import ActionRequestBody, ChatsApi
+
+from TamTamBot.cls.BoundedStore import BoundedStore
+from TamTamBot.cls.UpdateDispatcher import UpdateDispatcher
+
+
+class ChatActionScheduler(object):
+    # Единый планировщик повторяющихся действий в чатах (typing_on и т.п.) вместо потока на каждый чат.
+    # Чат активен, пока для него включено хотя бы одно действие. Каждые period секунд действия активных чатов
+    # повторяются небольшим пулом отправителей. Состояние чатов хранится в BoundedStore: чат, активный дольше
+    # idle_timeout, отключается (защита от невыключенных действий), при превышении max_active вытесняется
+    # давнее всех использованный чат.
+
+    def __init__(self, chats_api, period=5, idle_timeout=60, max_active=1000, senders=2, lgz=None):
+        # type: (ChatsApi, float, float, int, int, object) -> None
+        if chats_api is None:
+            raise ValueError("Invalid value for `chats_api`, must not be `None`")  # noqa: E501
+        self.chats_api = chats_api
+        self.period = period
+        self.idle_timeout = idle_timeout
+        self.max_active = max_active
+        self.lgz = lgz
+
+        self.chats = BoundedStore(max_active, idle_timeout, name='chats_action')  # chat_id -> {'actions': [], 'gen': поколение}
+        self.heap = []  # (время следующей отправки, поколение, chat_id)
+        self.gen = 0
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.thread = None
+        self.senders = UpdateDispatcher(senders, senders * 64, 'chat-action', lgz)
+
+        self.sent = 0
+
+    def start(self):
+        with self.cond:
+            if self.thread is None:
+                self.stopped = False
+                self.thread = threading.Thread(target=self._run, name='chat-action-scheduler')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def action_switch(self, chat_id, action_name, on=True):
+        # type: (int, str, bool) -> None
+        if chat_id is None:
+            raise ValueError("Invalid value for `chat_id`, must not be `None`")  # noqa: E501
+        if self.thread is None:
+            self.start()
+        with self.cond:
+            state = self.chats.get(chat_id)
+            if on:
+                if state is None:
+                    self.gen += 1
+                    state = {'actions': [], 'gen': self.gen}
+                    self.chats.set(chat_id, state)
+                    heapq.heappush(self.heap, (time(), self.gen, chat_id))
+                    self.cond.notify()
+                if action_name not in state['actions']:
+                    state['actions'].append(action_name)
+            elif state is not None:
+                if action_name in state['actions']:
+                    state['actions'].remove(action_name)
+                if not state['actions']:
+                    self.chats.pop(chat_id)
+
+    def _run(self):
+        while True:
+            due = []
+            with self.cond:
+                while not self.stopped and (not self.heap or self.heap[0][0] > time()):
+                    self.cond.wait(self.heap[0][0] - time() if self.heap else None)
+                if self.stopped:
+                    break
+                now = time()
+                while self.heap and self.heap[0][0] <= now:
+                    _, gen, chat_id = heapq.heappop(self.heap)
+                    state = self.chats.get(chat_id)
+                    # Чат отключён (в т.ч. по простою или вытеснен) либо запись от предыдущего включения действий - пропускаем
+                    if state is None or state['gen'] != gen:
+                        continue
+                    due.append((chat_id, list(state['actions'])))
+                    heapq.heappush(self.heap, (now + self.period, gen, chat_id))
+            for chat_id, actions in due:
+                self.senders.submit(self.send_actions, (chat_id, actions), block=False)
+
+    def send_actions(self, chat_id, actions):
+        # type: (int, [str]) -> None
+        for act in actions:
+            # noinspection PyBroadException
+            try:
+                self.chats_api.send_action(chat_id, ActionRequestBody(act))
+                self.sent += 1
+            except Exception:
+                if self.lgz:
+                    self.lgz.debug('Failed send action %s into chat_id=%s' % (act, chat_id))
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.chats.clear()
+            self.heap = []
+            self.cond.notify()
+        self.senders.stop(wait=False)
+
+    @property
+    def active_count(self):
+        # type: () -> int
+        return len(self.chats)
+
+    def stats(self):
+        # type: () -> dict
+        return {
+            'active': self.active_count, 'max_active': self.max_active, 'sent': self.sent,
+            'chats': self.chats.stats(), 'senders': self.senders.stats(),
+        }
@@ -0,0 +1,78 @@
+# -*- coding: UTF-8 -*-
+from time import time
+
+from TamTamBot.cls.BoundedStore import BoundedStore
+
+
+class ChatMembershipCache(object):
+    # Кэш сведений о чатах: членство бота, участники, администраторы, сам чат.
+    # Записи сгруппированы по chat_id, чтобы события чата (добавление/удаление бота и участников,
+    # смена заголовка) точно сбрасывали только затронутые сведения. Время жизни записей ограничено ttl.
+    # Ошибки API (например, 403 - нет доступа) тоже кэшируются и возбуждаются повторно.
+    MEMBERSHIP = 'membership'
+    MEMBERS = 'members'
+    ADMINS = 'admins'
+    CHAT = 'chat'
+
+    def __init__(self, max_size=10000, ttl=300):
+        # type: (int, float) -> None
+        self.ttl = ttl
+        self.store = BoundedStore(max_size, ttl, name='chat_membership')
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_load(self, chat_id, key, loader, *args):
+        # type: (int, tuple, callable, list) -> object
+        now = time()
+        entries = self.store.get(chat_id)
+        el = entries.get(key) if entries else None
+        if el is not None and el[1] > now:
+            self.hits += 1
+            if isinstance(el[0], Exception):
+                raise el[0]
+            return el[0]
+        self.misses += 1
+        try:
+            value = loader(*args)
+        except Exception as e:
+            if not self.is_cacheable_error(e):
+                raise
+            value = e
+        self.store.update_with(chat_id, lambda prev: self._put(prev, key, value, now + self.ttl))
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    @staticmethod
+    def is_cacheable_error(e):
+        # type: (Exception) -> bool
+        return getattr(e, 'status', None) in (403, 404)
+
+    @staticmethod
+    def _put(entries, key, value, expires):
+        entries = dict(entries) if entries else {}
+        entries[key] = (value, expires)
+        return entries
+
+    def invalidate(self, chat_id, *kinds):
+        # type: (int, list) -> None
+        # Сброс сведений чата указанных видов (все сведения, если виды не указаны)
+        if not kinds:
+            self.store.pop(chat_id)
+            return
+
+        def drop(prev):
+            return {k: v for k, v in (prev or {}).items() if k[0] not in kinds}
+
+        if chat_id in self.store:
+            self.store.update_with(chat_id, drop)
+
+    def clear(self):
+        self.store.clear()
+
+    def stats(self):
+        # type: () -> dict
+        total = self.hits + self.misses
+        res = self.store.stats()
+        res.update({'hits': self.hits, 'misses': self.misses, 'hit_ratio': round(self.hits / total, 4) if total else 0.0})
+        return res
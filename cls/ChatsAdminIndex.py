@@ -0,0 +1,193 @@
+# -*- coding: UTF-8 -*-
+import json
+import threading
+from time import time
+
+from TamTamBot.cls.SqliteStorage import SqliteStorage
+
+
+# noinspection SqlResolve,SqlNoDataSourceInspection,SqlDialectInspection
+class ChatsAdminIndex(object):
+    # Локальный индекс "администратор -> чаты с ботом-администратором" с разрешениями.
+    # Хранит сериализованный чат, разрешения бота и разрешения каждого администратора.
+    # Чаты, затронутые событиями, помечаются устаревшими и обновляются при следующем обращении;
+    # полная сверка с API выполняется периодически.
+    # Файл БД может быть общим для нескольких ботов, поэтому все записи привязаны к bot_id (user_id бота).
+
+    def __init__(self, storage, bot_id, table_prefix='tamtambot_chat_index', lgz=None):
+        # type: (SqliteStorage, int, str, object) -> None
+        if bot_id is None:
+            raise ValueError("Invalid value for `bot_id`, must not be `None`")  # noqa: E501
+        self.storage = storage
+        self.bot_id = bot_id
+        self.lgz = lgz
+        self.chats_table_name = table_prefix
+        self.admins_table_name = '%s_admin' % table_prefix
+        self.state_table_name = '%s_state' % table_prefix
+        self.stale = set()
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()  # Обновление устаревших чатов - одним потоком, остальные ждут результата
+        self.reconcile_thread = None
+
+        self.sql = {
+            'chat_upsert': 'INSERT INTO %s ([bot_id], [chat_id], [chat], [bot_permissions], [updated]) VALUES (:bot_id, :chat_id, :chat, :bot_permissions, :updated) '
+                           'ON CONFLICT([bot_id], [chat_id]) DO UPDATE SET [chat]=excluded.[chat], [bot_permissions]=excluded.[bot_permissions], [updated]=excluded.[updated]'
+                           % self.chats_table_name,
+            'chat_delete': 'DELETE FROM %s WHERE [bot_id]=:bot_id AND [chat_id]=:chat_id' % self.chats_table_name,
+            'chats_clear': 'DELETE FROM %s WHERE [bot_id]=:bot_id' % self.chats_table_name,
+            'admins_delete': 'DELETE FROM %s WHERE [bot_id]=:bot_id AND [chat_id]=:chat_id' % self.admins_table_name,
+            'admins_clear': 'DELETE FROM %s WHERE [bot_id]=:bot_id' % self.admins_table_name,
+            'admin_insert': 'INSERT OR REPLACE INTO %s ([bot_id], [user_id], [chat_id], [permissions], [dialog_name]) '
+                            'VALUES (:bot_id, :user_id, :chat_id, :permissions, :dialog_name)' % self.admins_table_name,
+            'user_chats': 'SELECT c.[chat], c.[bot_permissions], a.[permissions], a.[dialog_name] FROM %s a '
+                          'INNER JOIN %s c ON c.[bot_id]=a.[bot_id] AND c.[chat_id]=a.[chat_id] WHERE a.[bot_id]=:bot_id AND a.[user_id]=:user_id'
+                          % (self.admins_table_name, self.chats_table_name),
+            'state_get': 'SELECT [value] FROM %s WHERE [bot_id]=:bot_id AND [name]=:name' % self.state_table_name,
+            'state_set': 'INSERT INTO %s ([bot_id], [name], [value]) VALUES (:bot_id, :name, :value) '
+                         'ON CONFLICT([bot_id], [name]) DO UPDATE SET [value]=excluded.[value]' % self.state_table_name,
+        }
+        self.db_prepare()
+
+    def db_prepare(self):
+        tables = {'chats': self.chats_table_name, 'admins': self.admins_table_name, 'state': self.state_table_name}
+        # Таблицы прежнего формата (без bot_id) удаляются - индекс будет построен заново
+        columns = [row[1] for row in self.storage.fetchall('PRAGMA table_info(%s)' % self.chats_table_name)]
+        if columns and 'bot_id' not in columns:
+            self.storage.executescript('''
+                DROP TABLE IF EXISTS %(chats)s;
+                DROP TABLE IF EXISTS %(admins)s;
+                DROP TABLE IF EXISTS %(state)s;
+            ''' % tables)
+        self.storage.executescript('''
+            CREATE TABLE IF NOT EXISTS %(chats)s (
+                [bot_id]          INT  NOT NULL,
+                [chat_id]         INT  NOT NULL,
+                [chat]            TEXT NOT NULL,
+                [bot_permissions] TEXT,
+                [updated]         REAL,
+                PRIMARY KEY ([bot_id], [chat_id])
+            );
+            CREATE TABLE IF NOT EXISTS %(admins)s (
+                [bot_id]      INT NOT NULL,
+                [user_id]     INT NOT NULL,
+                [chat_id]     INT NOT NULL,
+                [permissions] TEXT,
+                [dialog_name] TEXT,
+                PRIMARY KEY ([bot_id], [user_id], [chat_id])
+            );
+            CREATE INDEX IF NOT EXISTS %(admins)s_chat_id ON %(admins)s ([bot_id], [chat_id]);
+            CREATE TABLE IF NOT EXISTS %(state)s (
+                [bot_id] INT       NOT NULL,
+                [name]   CHAR (64) NOT NULL,
+                [value]  TEXT,
+                PRIMARY KEY ([bot_id], [name])
+            );
+        ''' % tables)
+
+    @property
+    def reconciled_at(self):
+        # type: () -> float or None
+        row = self.storage.fetchone(self.sql['state_get'], {'bot_id': self.bot_id, 'name': 'reconciled_at'})
+        return float(row[0]) if row and row[0] else None
+
+    def needs_reconcile(self, period):
+        # type: (float) -> bool
+        reconciled_at = self.reconciled_at
+        return reconciled_at is not None and time() - reconciled_at > period
+
+    @property
+    def is_built(self):
+        # type: () -> bool
+        return self.reconciled_at is not None
+
+    def _chat_params(self, chat_id, chat_json, bot_permissions, admins):
+        # type: (int, str, [str], [(int, [str], str)]) -> (dict, [dict])
+        chat_p = {'bot_id': self.bot_id, 'chat_id': chat_id, 'chat': chat_json, 'bot_permissions': json.dumps(bot_permissions), 'updated': time()}
+        admins_p = [{'bot_id': self.bot_id, 'user_id': user_id, 'chat_id': chat_id, 'permissions': json.dumps(permissions), 'dialog_name': dialog_name}
+                    for user_id, permissions, dialog_name in admins]
+        return chat_p, admins_p
+
+    def set_chat(self, chat_id, chat_json, bot_permissions, admins):
+        # type: (int, str, [str], [(int, [str], str)]) -> None
+        # admins - список (user_id, разрешения, имя диалога)
+        chat_p, admins_p = self._chat_params(chat_id, chat_json, bot_permissions, admins)
+        conn = self.storage.conn
+        with conn:
+            conn.execute(self.sql['chat_upsert'], chat_p)
+            conn.execute(self.sql['admins_delete'], {'bot_id': self.bot_id, 'chat_id': chat_id})
+            conn.executemany(self.sql['admin_insert'], admins_p)
+
+    def remove_chat(self, chat_id):
+        # type: (int) -> None
+        conn = self.storage.conn
+        with conn:
+            conn.execute(self.sql['chat_delete'], {'bot_id': self.bot_id, 'chat_id': chat_id})
+            conn.execute(self.sql['admins_delete'], {'bot_id': self.bot_id, 'chat_id': chat_id})
+
+    def rebuild(self, chats):
+        # type: ([(int, str, [str], [(int, [str], str)])]) -> None
+        # Полная замена индекса; chats - список (chat_id, чат, разрешения бота, администраторы)
+        conn = self.storage.conn
+        with conn:
+            conn.execute(self.sql['admins_clear'], {'bot_id': self.bot_id})
+            conn.execute(self.sql['chats_clear'], {'bot_id': self.bot_id})
+            for chat_id, chat_json, bot_permissions, admins in chats:
+                chat_p, admins_p = self._chat_params(chat_id, chat_json, bot_permissions, admins)
+                conn.execute(self.sql['chat_upsert'], chat_p)
+                conn.executemany(self.sql['admin_insert'], admins_p)
+            conn.execute(self.sql['state_set'], {'bot_id': self.bot_id, 'name': 'reconciled_at', 'value': str(time())})
+        # Список устаревших чатов не сбрасывается: события могли прийти во время сверки
+        if self.lgz:
+            self.lgz.info('Chats admin index rebuilt: %s chats.' % len(chats))
+
+    def mark_stale(self, chat_id):
+        # type: (int) -> None
+        with self.lock:
+            self.stale.add(chat_id)
+
+    def pop_stale(self):
+        # type: () -> [int]
+        with self.lock:
+            stale = list(self.stale)
+            self.stale.clear()
+        return stale
+
+    def get_user_chats(self, user_id):
+        # type: (int) -> [(str, [str], [str], str)]
+        # Список (чат, разрешения бота, разрешения пользователя, имя диалога)
+        return [(row[0], json.loads(row[1] or '[]'), json.loads(row[2] or '[]'), row[3])
+                for row in self.storage.fetchall(self.sql['user_chats'], {'bot_id': self.bot_id, 'user_id': user_id})]
+
+    @property
+    def reconciling(self):
+        # type: () -> bool
+        return self.reconcile_thread is not None and self.reconcile_thread.is_alive()
+
+    def reconcile_in_background(self, build):
+        # type: (callable) -> bool
+        # Построение (сверка) индекса в отдельном потоке; одновременно выполняется не больше одного
+        with self.lock:
+            if self.reconciling:
+                return False
+            self.reconcile_thread = threading.Thread(target=self._reconcile, args=(build,), name='chats-index-reconcile')
+            self.reconcile_thread.daemon = True
+            self.reconcile_thread.start()
+        return True
+
+    def _reconcile(self, build):
+        # noinspection PyBroadException
+        try:
+            build()
+        except Exception:
+            if self.lgz:
+                self.lgz.exception('Exception')
+
+    def stats(self):
+        # type: () -> dict
+        chats = self.storage.fetchone('SELECT COUNT(*) FROM %s WHERE [bot_id]=:bot_id' % self.chats_table_name, {'bot_id': self.bot_id})
+        admins = self.storage.fetchone('SELECT COUNT(*) FROM %s WHERE [bot_id]=:bot_id' % self.admins_table_name, {'bot_id': self.bot_id})
+        return {
+            'chats': chats[0] if chats else 0, 'admins': admins[0] if admins else 0, 'stale': len(self.stale),
+            'reconciled_at': self.reconciled_at,
+            'reconciling': self.reconciling,
+        }
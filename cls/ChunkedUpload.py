@@ -0,0 +1,168 @@
+# -*- coding: UTF-8 -*-
+import io
+import os
+from time import sleep
+
+import requests
+
+
+class ChunkedUploadError(Exception):
+    # retriable - загрузку можно продолжить повторным вызовом upload() (ошибка сети или сервера, а не отказ в приёме)
+    def __init__(self, message, retriable=False):
+        super(ChunkedUploadError, self).__init__(message)
+        self.retriable = retriable
+
+
+class ChunkedUpload(object):
+    # Загрузка файла частями (заголовок Content-Range) с повтором отдельной части при ошибке.
+    # Подтверждённое сервером смещение хранится в объекте: после исключения повторный вызов upload()
+    # продолжает загрузку с первой неподтверждённой части, а не с начала файла.
+    # В памяти одновременно находится не более одной части.
+    # Содержимое: bytes, путь к файлу или файловый объект с seek (размер должен быть известен).
+
+    def __init__(self, session, url, content, filename=None, chunk_size=4 * 1024 * 1024, max_retry=5, retry_delay=1, retry_delay_max=30,
+                 timeout=60, progress=None, digest=None, lgz=None):
+        # type: (requests.Session, str, bytes or str or object, str, int, int, float, float, float, callable, object, object) -> None
+        # progress(отправлено байт, всего байт) - вызывается после каждой подтверждённой части
+        # digest (hashlib) - обновляется подтверждёнными частями по порядку (хэш без повторного чтения содержимого)
+        self.session = session
+        self.digest = digest
+        self.url = url
+        self.chunk_size = chunk_size
+        self.max_retry = max_retry
+        self.retry_delay = retry_delay
+        self.retry_delay_max = retry_delay_max
+        self.timeout = timeout
+        self.progress = progress
+        self.lgz = lgz
+        self.own_file = False
+
+        if isinstance(content, (bytes, bytearray)):
+            self.source = io.BytesIO(content)
+            self.size = len(content)
+        elif isinstance(content, str) and os.path.isfile(content):
+            filename = filename or os.path.basename(content)
+            self.source = open(content, 'rb')
+            self.own_file = True
+            self.size = os.path.getsize(content)
+        elif hasattr(content, 'read') and hasattr(content, 'seek'):
+            self.source = content
+            self.size = self.get_file_size(content)
+        else:
+            raise ChunkedUploadError('Content of type %s cannot be uploaded by chunks.' % type(content))
+        if self.size is None:
+            raise ChunkedUploadError('Content size is unknown.')
+        self.start = self.source.tell()
+        self.filename = filename or 'file'
+
+        self.offset = 0  # Подтверждено сервером
+        self.result = None
+        self.chunks_sent = 0
+        self.retries = 0
+
+    @staticmethod
+    def get_file_size(f):
+        # type: (object) -> int or None
+        # Размер оставшейся части файлового объекта или None, если его не определить
+        # noinspection PyBroadException
+        try:
+            pos = f.tell()
+            end = f.seek(0, os.SEEK_END)
+            f.seek(pos)
+            return end - pos
+        except Exception:
+            return None
+
+    @staticmethod
+    def content_size(content):
+        # type: (object) -> int or None
+        if isinstance(content, (bytes, bytearray)):
+            return len(content)
+        if isinstance(content, str) and os.path.isfile(content):
+            return os.path.getsize(content)
+        if hasattr(content, 'read') and hasattr(content, 'seek'):
+            return ChunkedUpload.get_file_size(content)
+
+    @property
+    def done(self):
+        # type: () -> bool
+        return self.result is not None
+
+    def read_chunk(self, offset):
+        # type: (int) -> bytes
+        self.source.seek(self.start + offset)
+        chunk = self.source.read(min(self.chunk_size, self.size - offset))
+        return chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+
+    def send_chunk(self, offset, chunk):
+        # type: (int, bytes) -> requests.Response
+        headers = {
+            'Content-Type': 'application/x-binary; charset=x-user-defined',
+            'Content-Disposition': 'attachment; filename="%s"' % self.filename.replace('"', '\\"'),
+            'Content-Range': 'bytes %s-%s/%s' % (offset, offset + len(chunk) - 1, self.size),
+        }
+        return self.session.post(self.url, data=chunk, headers=headers, timeout=self.timeout)
+
+    @staticmethod
+    def parse_result(rdf):
+        # type: (requests.Response) -> dict
+        # noinspection PyBroadException
+        try:
+            res = rdf.json()
+        except Exception:
+            res = None
+        return res if isinstance(res, dict) else {}
+
+    def upload(self):
+        # type: () -> dict
+        # Результат загрузки (ответ сервера на последнюю часть); при исчерпании повторов - ChunkedUploadError
+        if self.size == 0:
+            raise ChunkedUploadError('Empty content.')
+        while not self.done:
+            chunk = self.read_chunk(self.offset)
+            rpt = 0
+            while True:
+                rpt += 1
+                try:
+                    rdf = self.send_chunk(self.offset, chunk)
+                    # 200 - файл получен полностью, 201 - часть принята; 4xx (кроме 408 и 429) повторять бессмысленно
+                    if rdf.status_code in (200, 201):
+                        break
+                    err = 'status %s: %s' % (rdf.status_code, rdf.text[:200])
+                    if 400 <= rdf.status_code < 500 and rdf.status_code not in (408, 429):
+                        raise ChunkedUploadError('Chunk %s-%s/%s rejected, %s' % (self.offset, self.offset + len(chunk) - 1, self.size, err))
+                except requests.RequestException as e:
+                    err = str(e)
+                if rpt >= self.max_retry:
+                    raise ChunkedUploadError(
+                        'Chunk %s-%s/%s failed after %s attempts, %s' % (self.offset, self.offset + len(chunk) - 1, self.size, rpt, err), retriable=True
+                    )
+                self.retries += 1
+                delay = min(self.retry_delay * 2 ** (rpt - 1), self.retry_delay_max)
+                if self.lgz:
+                    self.lgz.warning('Chunk %s-%s/%s of %s failed (%s), retry in %s sec.' % (self.offset, self.offset + len(chunk) - 1, self.size, self.filename, err, delay))
+                sleep(delay)
+            self.chunks_sent += 1
+            if self.digest is not None:
+                self.digest.update(chunk)
+            self.offset += len(chunk)
+            if self.progress:
+                self.progress(self.offset, self.size)
+            if rdf.status_code == 200 or self.offset >= self.size:
+                self.result = self.parse_result(rdf)
+        return self.result
+
+    def close(self):
+        if self.own_file:
+            self.source.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def stats(self):
+        # type: () -> dict
+        return {'size': self.size, 'offset': self.offset, 'chunks_sent': self.chunks_sent, 'retries': self.retries, 'done': self.done}
+
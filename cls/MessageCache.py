@@ -0,0 +1,84 @@
+# -*- coding: UTF-8 -*-
+import threading
+
+from openapi_client import Message, MessageBody
+
+from TamTamBot.cls.BoundedStore import BoundedStore
+
+
+class MessageCache(object):
+    # Кэш сообщений по mid (LRU с ограничением времени жизни, на основе BoundedStore).
+    # Наполняется сообщениями из событий и ответов API, сбрасывается событиями изменения и удаления сообщений.
+    # Одновременные промахи по одному mid объединяются: запрос выполняет первый поток, остальные ждут его результата.
+
+    class Call(object):
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.error = None
+            self.invalidated = False
+
+    def __init__(self, max_size=10000, ttl=3600):
+        # type: (int, float) -> None
+        self.store = BoundedStore(max_size, ttl, name='messages')
+        self.lock = threading.Lock()
+        self.in_flight = {}  # mid -> MessageCache.Call
+
+        self.loads = 0
+        self.coalesced = 0
+
+    def get_or_load(self, mid, loader, *args):
+        # type: (str, callable, list) -> Message or None
+        message = self.store.get(mid)
+        if message is not None:
+            return message
+        with self.lock:
+            call = self.in_flight.get(mid)
+            owner = call is None
+            if owner:
+                call = self.in_flight[mid] = self.Call()
+                self.loads += 1
+            else:
+                self.coalesced += 1
+        if not owner:
+            call.event.wait()
+        else:
+            try:
+                call.result = loader(*args)
+            except Exception as e:
+                call.error = e
+            with self.lock:
+                self.in_flight.pop(mid, None)
+                # Сообщение могло измениться, пока шёл запрос, - тогда результат не кэшируем
+                if not call.invalidated:
+                    self.put(call.result)
+            call.event.set()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def put(self, message):
+        # type: (Message) -> None
+        if isinstance(message, Message) and isinstance(message.body, MessageBody) and message.body.mid:
+            self.store.set(message.body.mid, message)
+
+    def get(self, mid):
+        # type: (str) -> Message or None
+        return self.store.get(mid)
+
+    def invalidate(self, mid):
+        # type: (str) -> None
+        with self.lock:
+            call = self.in_flight.get(mid)
+            if call is not None:
+                call.invalidated = True
+        self.store.pop(mid)
+
+    def clear(self):
+        self.store.clear()
+
+    def stats(self):
+        # type: () -> dict
+        res = self.store.stats()
+        res.update({'loads': self.loads, 'coalesced': self.coalesced, 'in_flight': len(self.in_flight)})
+        return res
@@ -0,0 +1,140 @@
+# -*- coding: UTF-8 -*-
+import io
+import mimetypes
+import os
+import uuid
+
+
+class MultipartStream(object):
+    # Тело запроса multipart/form-data с одним файлом, читаемое по частям (без загрузки содержимого в память).
+    # Содержимое: bytes, путь к файлу, файловый объект или итератор по bytes.
+    # Если размер содержимого известен, объект имеет длину (requests передаёт Content-Length),
+    # иначе тело передаётся через iter_chunks() с поблочной передачей (chunked).
+    # digest (hashlib) - обновляется переданным содержимым, чтобы не читать его повторно для вычисления хэша.
+
+    def __init__(self, content, field='files', filename=None, content_type=None, chunk_size=64 * 1024, digest=None):
+        # type: (bytes or str or object, str, str, str, int, object) -> None
+        self.chunk_size = chunk_size
+        self.digest = digest
+        self.sent = 0  # Передано байт содержимого
+        self.boundary = uuid.uuid4().hex
+        self.own_file = False
+        self.size = None
+
+        if isinstance(content, (bytes, bytearray)):
+            self.source = io.BytesIO(content)
+            self.size = len(content)
+        elif isinstance(content, str) and os.path.isfile(content):
+            filename = filename or os.path.basename(content)
+            self.source = open(content, 'rb')
+            self.own_file = True
+            self.size = os.path.getsize(content)
+        elif isinstance(content, str):
+            content = content.encode('utf-8')
+            self.source = io.BytesIO(content)
+            self.size = len(content)
+        elif hasattr(content, 'read'):
+            self.source = content
+            self.size = self.get_file_size(content)
+        else:
+            self.source = iter(content)
+
+        filename = filename or 'file'
+        content_type = content_type or mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        self.preamble = (
+            '--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\nContent-Type: %s\r\n\r\n' %
+            (self.boundary, field, filename.replace('"', '\\"'), content_type)
+        ).encode('utf-8')
+        self.epilogue = ('\r\n--%s--\r\n' % self.boundary).encode('utf-8')
+        self.parts = None
+        self.chunk = b''
+        self.offset = 0
+
+    @staticmethod
+    def get_file_size(f):
+        # type: (object) -> int or None
+        # Размер оставшейся части файлового объекта или None, если его не определить
+        # noinspection PyBroadException
+        try:
+            pos = f.tell()
+            return os.fstat(f.fileno()).st_size - pos
+        except Exception:
+            pass
+        # noinspection PyBroadException
+        try:
+            pos = f.tell()
+            end = f.seek(0, os.SEEK_END)
+            f.seek(pos)
+            return end - pos
+        except Exception:
+            return None
+
+    @property
+    def content_type(self):
+        # type: () -> str
+        return 'multipart/form-data; boundary=%s' % self.boundary
+
+    @property
+    def has_len(self):
+        # type: () -> bool
+        return self.size is not None
+
+    def __len__(self):
+        if self.size is None:
+            raise TypeError('Content size is unknown.')
+        return len(self.preamble) + self.size + len(self.epilogue)
+
+    def iter_source(self):
+        if hasattr(self.source, 'read'):
+            while True:
+                chunk = self.source.read(self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+        else:
+            for chunk in self.source:
+                if chunk:
+                    yield chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+
+    def iter_chunks(self):
+        yield self.preamble
+        for chunk in self.iter_source():
+            if self.digest is not None:
+                self.digest.update(chunk)
+            self.sent += len(chunk)
+            yield chunk
+        yield self.epilogue
+
+    def read(self, size=-1):
+        # type: (int) -> bytes
+        if self.parts is None:
+            self.parts = self.iter_chunks()
+        size = -1 if size is None else size
+        res = []
+        n = 0
+        while size < 0 or n < size:
+            if self.offset >= len(self.chunk):
+                self.chunk = next(self.parts, b'')
+                self.offset = 0
+                if not self.chunk:
+                    break
+            take = len(self.chunk) - self.offset if size < 0 else min(size - n, len(self.chunk) - self.offset)
+            res.append(self.chunk[self.offset:self.offset + take])
+            self.offset += take
+            n += take
+        return b''.join(res)
+
+    @property
+    def body(self):
+        # Объект для параметра data запроса requests
+        return self if self.has_len else self.iter_chunks()
+
+    def close(self):
+        if self.own_file:
+            self.source.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
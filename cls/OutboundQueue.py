@@ -0,0 +1,81 @@
+# -*- coding: UTF-8 -*-
+from concurrent.futures import Future
+from time import time
+
+from TamTamBot.cls.UpdateDispatcher import UpdateDispatcher
+from TamTamBot.cls.cmn import TimeStat
+
+
+class OutboundQueue(object):
+    # Очередь исходящих запросов (отправка, изменение, удаление сообщений), обслуживаемая небольшим пулом отправителей.
+    # Запросы с одинаковым ключом (чат, получатель) выполняются строго в порядке постановки.
+    # Вызывающий сразу получает Future и не ждёт ответа сервера.
+
+    def __init__(self, senders=4, queue_max_size=None, put_timeout=None, lgz=None):
+        # type: (int, int, float, object) -> None
+        self.put_timeout = put_timeout
+        self.lgz = lgz
+        self.dispatcher = UpdateDispatcher(senders, queue_max_size or senders * 256, 'outbound', lgz, sharded=True)
+
+        self.failed = 0
+        self.latency_stat = TimeStat()  # От постановки в очередь до получения ответа
+        self.send_stat = TimeStat()  # Время выполнения запроса
+
+    def submit(self, key, func, *args, **kwargs):
+        # type: (object, callable, list, dict) -> Future
+        # Очередь заполнена дольше put_timeout секунд - исключение возвращается через Future
+        return self._submit(key, func, args, kwargs, True)
+
+    def submit_nowait(self, key, func, *args, **kwargs):
+        # type: (object, callable, list, dict) -> Future
+        # Без ожидания места в очереди - для постановки из потока-отправителя (там ожидание может заблокировать его же полосу)
+        return self._submit(key, func, args, kwargs, False)
+
+    def _submit(self, key, func, args, kwargs, block):
+        # type: (object, callable, tuple, dict, bool) -> Future
+        future = Future()
+        queued = time()
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+            started = time()
+            try:
+                res = func(*args, **kwargs)
+            except Exception as e:
+                self.failed += 1
+                if self.lgz:
+                    self.lgz.warning('Outbound request %s (key=%s) failed: %s' % (getattr(func, '__name__', func), key, e))
+                future.set_exception(e)
+            else:
+                future.set_result(res)
+            finally:
+                now = time()
+                self.send_stat.add(now - started)
+                self.latency_stat.add(now - queued)
+
+        try:
+            submitted = self.dispatcher.submit(run, block=block, timeout=self.put_timeout if block else None, key=key)
+        except RuntimeError as e:
+            submitted = False
+            future.set_exception(e)
+        if not submitted and not future.done():
+            future.set_exception(RuntimeError('Outbound queue is full.'))
+        return future
+
+    @property
+    def queue_depth(self):
+        # type: () -> int
+        return self.dispatcher.queue_depth
+
+    def stop(self, wait=True):
+        # type: (bool) -> None
+        self.dispatcher.stop(wait)
+
+    def stats(self):
+        # type: () -> dict
+        return {
+            'queue_depth': self.queue_depth, 'failed': self.failed,
+            'latency': self.latency_stat.as_dict(), 'send': self.send_stat.as_dict(),
+            'dispatcher': self.dispatcher.stats(),
+        }
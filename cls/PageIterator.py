@@ -0,0 +1,94 @@
+# -*- coding: UTF-8 -*-
+import threading
+
+from six.moves import queue
+
+
+class PageIterator(object):
+    # Итератор по элементам постраничной выдачи API.
+    # fetch_page(marker) возвращает (элементы страницы, маркер следующей страницы или None - страниц больше нет).
+    # При prefetch следующая страница запрашивается фоновым потоком, пока обрабатывается текущая
+    # (впрок - не более одной страницы). Обход можно прервать в любой момент вызовом close().
+
+    def __init__(self, fetch_page, marker=None, prefetch=True, name='page-prefetch'):
+        # type: (callable, object, bool, str) -> None
+        self.fetch_page = fetch_page
+        self.marker = marker
+        self.prefetch = prefetch
+        self.name = name
+
+        self.queue = queue.Queue(maxsize=1)
+        self.closed = threading.Event()
+        self.thread = None
+        self.items = iter(())
+        self.done = False
+        self.pages = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while True:
+            for item in self.items:
+                return item
+            if self.done:
+                raise StopIteration
+            self.items = iter(self._next_page())
+
+    next = __next__
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _next_page(self):
+        # type: () -> list
+        # Первая страница запрашивается сразу, фоновый поток запускается, только если есть следующие
+        if not self.prefetch or self.thread is None:
+            items, self.marker = self.fetch_page(self.marker)
+            self.pages += 1
+            if self.marker is None:
+                self.done = True
+            elif self.prefetch:
+                self.thread = threading.Thread(target=self._run, name=self.name)
+                self.thread.daemon = True
+                self.thread.start()
+            return items or []
+
+        kind, value = self.queue.get()
+        if kind == 'page':
+            self.pages += 1
+            return value or []
+        self.done = True
+        if kind == 'error':
+            raise value
+        return []
+
+    def _run(self):
+        marker = self.marker
+        try:
+            while not self.closed.is_set():
+                items, marker = self.fetch_page(marker)
+                self._put(('page', items))
+                if marker is None:
+                    break
+        except Exception as e:
+            self._put(('error', e))
+            return
+        self._put(('end', None))
+
+    def _put(self, el):
+        # Ожидание места в очереди с проверкой закрытия итератора
+        while not self.closed.is_set():
+            try:
+                self.queue.put(el, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+
+    def close(self):
+        self.done = True
+        self.items = iter(())
+        self.closed.set()
@@ -0,0 +1,90 @@
+# -*- coding: UTF-8 -*-
+from time import time
+
+from TamTamBot.cls.cmn import TimeStat
+
+
+class PollingTuner(object):
+    # Подстройка параметров long polling по наблюдаемому трафику:
+    # * при наличии обновлений - повторный запрос без паузы; при полной пачке размер пачки (limit) растёт,
+    #   при малых пачках - уменьшается;
+    # * при пустом ответе пауза нужна только если сервер вернул ответ сразу, не выдержав таймаут;
+    #   подряд идущие пустые ответы увеличивают таймаут ожидания до максимума;
+    # * при ошибках пауза растёт экспоненциально, а таймаут уменьшается (соединение могло быть разорвано по простою).
+    # Также собирается статистика задержки обновлений: от времени создания (update.timestamp)
+    # до получения ботом и до окончания обработки.
+    LIMIT_MIN = 10
+    LIMIT_MAX = 1000
+    TIMEOUT_MIN = 5
+    TIMEOUT_MAX = 90
+    REQUEST_TIMEOUT_MARGIN = 15
+
+    def __init__(self, limit=100, timeout=30, sleep_max=5, error_sleep=5, error_sleep_max=60):
+        # type: (int, int, float, float, float) -> None
+        self.limit = min(max(limit, self.LIMIT_MIN), self.LIMIT_MAX)
+        self.timeout = min(max(timeout, self.TIMEOUT_MIN), self.TIMEOUT_MAX)
+        self.sleep_max = sleep_max
+        self.error_sleep = error_sleep
+        self.error_sleep_max = error_sleep_max
+
+        self.request_started = None
+        self.empty_count = 0
+        self.error_count = 0
+        self.requests = 0
+        self.updates = 0
+        self.receive_latency = TimeStat()
+        self.handle_latency = TimeStat()
+
+    def request_params(self):
+        # type: () -> dict
+        self.request_started = time()
+        self.requests += 1
+        return {'limit': self.limit, 'timeout': self.timeout, '_request_timeout': self.timeout + self.REQUEST_TIMEOUT_MARGIN}
+
+    def on_updates(self, updates):
+        # type: (list) -> float
+        # Возвращает паузу перед следующим запросом
+        self.error_count = 0
+        if not updates:
+            self.empty_count += 1
+            held = time() - (self.request_started or time()) >= self.timeout / 2
+            if self.empty_count > 1:
+                self.timeout = min(self.timeout * 2, self.TIMEOUT_MAX)
+            if held:
+                return 0
+            return min(0.25 * 2 ** (self.empty_count - 1), self.sleep_max)
+
+        self.empty_count = 0
+        self.updates += len(updates)
+        if len(updates) >= self.limit:
+            self.limit = min(self.limit * 2, self.LIMIT_MAX)
+        elif len(updates) < self.limit // 4:
+            self.limit = max(self.limit // 2, self.LIMIT_MIN)
+        now = time()
+        for update in updates:
+            self.add_latency(self.receive_latency, update, now)
+        return 0
+
+    def on_error(self):
+        # type: () -> float
+        self.error_count += 1
+        self.timeout = max(self.timeout // 2, self.TIMEOUT_MIN)
+        return min(self.error_sleep * 2 ** (self.error_count - 1), self.error_sleep_max)
+
+    def on_handled(self, update):
+        self.add_latency(self.handle_latency, update)
+
+    @staticmethod
+    def add_latency(stat, update, now=None):
+        # type: (TimeStat, object, float) -> None
+        ts = getattr(update, 'timestamp', None)
+        if ts:
+            stat.add(max((now or time()) - ts / 1000.0, 0))
+
+    def stats(self):
+        # type: () -> dict
+        return {
+            'limit': self.limit, 'timeout': self.timeout, 'requests': self.requests, 'updates': self.updates,
+            'empty_count': self.empty_count, 'error_count': self.error_count,
+            'receive_latency': self.receive_latency.as_dict(), 'handle_latency': self.handle_latency.as_dict(),
+        }
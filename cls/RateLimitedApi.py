@@ -0,0 +1,73 @@
+# -*- coding: UTF-8 -*-
+import functools
+import random
+
+from openapi_client.rest import ApiException
+
+from TamTamBot.cls.ApiRateLimiter import ApiRateLimiter
+
+
+class RateLimitedApi(object):
+    # Обёртка над API-объектом openapi_client: каждый вызов метода проходит через общий ограничитель запросов,
+    # а отказ из-за превышения частоты (429 too.many.requests) повторяется с учётом Retry-After не более max_retry раз.
+    # Корзина чата выбирается по аргументу chat_id (при chat_id_positional - и по первому позиционному аргументу),
+    # иначе - по user_id получателя.
+    # Пример: msg = RateLimitedApi(MessagesApi(client), limiter)
+
+    def __init__(self, api, limiter, max_retry=5, chat_id_positional=False, lgz=None):
+        # type: (object, ApiRateLimiter, int, bool, object) -> None
+        self.api = api
+        self.limiter = limiter
+        self.max_retry = max_retry
+        self.chat_id_positional = chat_id_positional
+        self.lgz = lgz
+
+    def limiter_key(self, args, kwargs):
+        # type: (tuple, dict) -> object
+        chat_id = kwargs.get('chat_id')
+        if chat_id is None and self.chat_id_positional and args and isinstance(args[0], int):
+            chat_id = args[0]
+        if chat_id is not None:
+            return chat_id
+        if kwargs.get('user_id') is not None:
+            return 'user_id=%s' % kwargs.get('user_id')
+
+    @staticmethod
+    def get_retry_after(e):
+        # type: (ApiException) -> float or None
+        # noinspection PyBroadException
+        try:
+            retry_after = float((e.headers or {}).get('Retry-After'))
+            return retry_after if retry_after > 0 else None
+        except Exception:
+            return None
+
+    def __getattr__(self, item):
+        attr = getattr(self.api, item)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def wrapper(*args, **kwargs):
+            key = self.limiter_key(args, kwargs)
+            rpt = 0
+            while True:
+                rpt += 1
+                self.limiter.acquire(key)
+                try:
+                    res = attr(*args, **kwargs)
+                except ApiException as e:
+                    if e.status != 429 or rpt > self.max_retry:
+                        raise
+                    retry_after = self.get_retry_after(e)
+                    if retry_after is None:
+                        # Разброс паузы, чтобы одновременно получившие отказ потоки не повторяли запросы синхронно
+                        retry_after = random.uniform(0.5, 1.5) * rpt
+                    self.limiter.on_throttled(key, retry_after)
+                    if self.lgz:
+                        self.lgz.debug('Too many requests (%s, key=%s): retry %s after %.2f sec.' % (item, key, rpt, retry_after))
+                    continue
+                self.limiter.on_success(key)
+                return res
+
+        return wrapper
@@ -0,0 +1,91 @@
+# -*- coding: UTF-8 -*-
+import threading
+from time import time, sleep
+
+from TamTamBot.cls.cmn import TimeStat
+
+
+class RateLimiter(object):
+    # Ограничитель частоты запросов по схеме "корзина маркеров" (token bucket):
+    # в среднем не более rate запросов в секунду, подряд - не более burst.
+    # Один экземпляр разделяется всеми потоками, которые обращаются к API.
+    # Частота подстраивается под ответы сервера (AIMD): при отказе из-за превышения частоты (429)
+    # она уменьшается вдвое (не ниже rate_min), а выдача разрешений приостанавливается на указанное сервером время;
+    # каждый успешный запрос понемногу возвращает частоту к исходной.
+
+    def __init__(self, rate=30, burst=None, name=None, rate_min=None, increase=None):
+        # type: (float, float, str, float, float) -> None
+        if not rate or rate <= 0:
+            raise ValueError("Invalid value for `rate`, must be positive")  # noqa: E501
+        self.rate_max = float(rate)
+        self.rate = self.rate_max
+        self.rate_min = float(rate_min or self.rate_max / 16)
+        self.increase = float(increase or self.rate_max / 20)
+        self.burst = float(burst or max(rate, 1))
+        self.name = name
+        self.tokens = self.burst
+        self.updated = time()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+        self.acquired = 0
+        self.rejected = 0
+        self.throttled = 0
+        self.wait_stat = TimeStat()  # Время ожидания разрешения
+
+    def _refill(self, now):
+        # Под блокировкой
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def acquire(self, tokens=1, timeout=None):
+        # type: (float, float) -> bool
+        # Ожидает разрешения на запрос; False - если не дождались за timeout секунд
+        started = time()
+        deadline = None if timeout is None else started + timeout
+        while True:
+            with self.lock:
+                now = time()
+                self._refill(now)
+                if now < self.blocked_until:
+                    delay = self.blocked_until - now
+                elif self.tokens >= tokens:
+                    self.tokens -= tokens
+                    self.acquired += 1
+                    self.wait_stat.add(now - started)
+                    return True
+                else:
+                    delay = (tokens - self.tokens) / self.rate
+            if deadline is not None and now + delay > deadline:
+                with self.lock:
+                    self.rejected += 1
+                return False
+            sleep(delay)
+
+    def on_success(self):
+        if self.rate < self.rate_max:
+            with self.lock:
+                self.rate = min(self.rate_max, self.rate + self.increase)
+
+    def on_throttled(self, retry_after=None, block=True):
+        # type: (float, bool) -> None
+        # Сервер отказал из-за превышения частоты; retry_after - рекомендованная сервером пауза (сек.)
+        with self.lock:
+            now = time()
+            self._refill(now)
+            self.throttled += 1
+            self.rate = max(self.rate_min, self.rate / 2)
+            self.tokens = 0
+            if block:
+                # После паузы сразу разрешается один запрос
+                self.blocked_until = max(self.blocked_until, now + (retry_after if retry_after else 1 / self.rate))
+                self.tokens = 1
+                self.updated = self.blocked_until
+
+    def stats(self):
+        # type: () -> dict
+        return {
+            'name': self.name, 'rate': round(self.rate, 3), 'rate_max': self.rate_max, 'burst': self.burst,
+            'acquired': self.acquired, 'rejected': self.rejected, 'throttled': self.throttled, 'wait': self.wait_stat.as_dict(),
+        }
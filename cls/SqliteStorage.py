@@ -0,0 +1,105 @@
+# -*- coding: UTF-8 -*-
+import atexit
+import sqlite3
+import threading
+
+
+class SqliteStorage(object):
+    # Хранилище на SQLite с постоянными соединениями: по одному на поток (рабочие потоки долгоживущие).
+    # Используется журнал WAL - читатели не блокируют писателя.
+    # Скомпилированные запросы переиспользуются кэшем выражений sqlite3 при неизменном тексте запроса,
+    # поэтому тексты запросов следует формировать один раз.
+    # Все соединения закрываются в close() (вызывается и при завершении процесса).
+
+    def __init__(self, path, busy_timeout=30, cached_statements=256, lgz=None):
+        # type: (str, int, int, object) -> None
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.cached_statements = cached_statements
+        self.lgz = lgz
+
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = {}  # поток -> соединение
+        self.closed = False
+        atexit.register(self.close)
+
+    def connect(self):
+        # type: () -> sqlite3.Connection
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout, check_same_thread=False, cached_statements=self.cached_statements)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    @property
+    def conn(self):
+        # type: () -> sqlite3.Connection
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            if self.closed:
+                raise sqlite3.ProgrammingError('Storage %s is closed.' % self.path)
+            conn = self.connect()
+            self.local.conn = conn
+            with self.lock:
+                self.release_dead()
+                self.connections[threading.current_thread()] = conn
+            if self.lgz:
+                self.lgz.debug('Opened connection to %s. Connections count=%s' % (self.path, len(self.connections)))
+        return conn
+
+    def release_dead(self):
+        # Закрытие соединений завершившихся потоков
+        for t in [_ for _ in self.connections.keys() if not _.is_alive()]:
+            self.connections.pop(t).close()
+
+    def fetchone(self, sql, params=()):
+        # type: (str, dict or tuple) -> tuple
+        cursor = self.conn.execute(sql, params)
+        try:
+            return cursor.fetchone()
+        finally:
+            cursor.close()
+
+    def fetchall(self, sql, params=()):
+        # type: (str, dict or tuple) -> [tuple]
+        cursor = self.conn.execute(sql, params)
+        try:
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
+    def execute(self, sql, params=()):
+        # type: (str, dict or tuple) -> int
+        # Выполнение изменяющего запроса с фиксацией; возвращает число затронутых строк
+        conn = self.conn
+        with conn:
+            cursor = conn.execute(sql, params)
+            try:
+                return cursor.rowcount
+            finally:
+                cursor.close()
+
+    def executemany(self, sql, seq_of_params):
+        # type: (str, list) -> int
+        conn = self.conn
+        with conn:
+            cursor = conn.executemany(sql, seq_of_params)
+            try:
+                return cursor.rowcount
+            finally:
+                cursor.close()
+
+    def executescript(self, sql_script):
+        # type: (str) -> None
+        self.conn.executescript(sql_script)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            for conn in self.connections.values():
+                try:
+                    conn.close()
+                except sqlite3.Error:
+                    pass
+            self.connections.clear()
+        self.local = threading.local()
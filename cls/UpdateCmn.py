@@ -140,6 +140,28 @@ class UpdateCmn(object):
 
         self._index = None
 
+    @classmethod
+    def get(cls, update, ttb=None):
+        # type: (Update or UpdateCmn, object) -> UpdateCmn
+        # Разбор обновления выполняется однократно: результат сохраняется в самом обновлении
+        # и используется на всех этапах его обработки
+        if isinstance(update, UpdateCmn):
+            return update
+        update_cmn = getattr(update, '_update_cmn', None)
+        if not isinstance(update_cmn, cls):
+            update_cmn = cls(update, ttb)
+            update._update_cmn = update_cmn
+        elif ttb is not None and update_cmn.ttb is None:
+            update_cmn.ttb = ttb
+        return update_cmn
+
+    @staticmethod
+    def reset(update):
+        # type: (Update) -> None
+        # Сброс результата разбора - после изменения самого обновления
+        if getattr(update, '_update_cmn', None) is not None:
+            update._update_cmn = None
+
     @property
     def index(self):
         if not self._index:
@@ -151,8 +173,9 @@ class UpdateCmn(object):
         res = False
         if isinstance(self.update_current, MessageCallbackUpdate):
             ind = self.get_callback_index(self.update_current.callback)
-            if len(callbacks_list[ind]) == 2:
-                res = (callbacks_list[ind][0] - callbacks_list[ind][1]) <= 1000
+            clicks = callbacks_list.get(ind) or []
+            if len(clicks) == 2:
+                res = (clicks[0] - clicks[1]) <= 1000
         return res
 
     @staticmethod
@@ -0,0 +1,156 @@
+# -*- coding: UTF-8 -*-
+import threading
+from time import time
+
+from six.moves import queue
+
+from TamTamBot.cls.cmn import TimeStat
+
+
+class UpdateDispatcher(object):
+    # Пул долгоживущих рабочих потоков, получающих задания из ограниченной очереди.
+    # При заполнении очереди submit блокирует вызывающего (обратное давление).
+    # В режиме sharded у каждого потока своя очередь (полоса), задания с одинаковым ключом
+    # попадают в одну полосу и выполняются строго последовательно в порядке поступления.
+
+    def __init__(self, workers_count, queue_max_size=None, name='worker', lgz=None, sharded=False):
+        # type: (int, int, str, object, bool) -> None
+        self.workers_count = max(workers_count or 1, 1)
+        self.queue_max_size = queue_max_size or self.workers_count * 2
+        self.name = name
+        self.lgz = lgz
+        self.sharded = sharded
+
+        if self.sharded:
+            lane_max_size = max(self.queue_max_size // self.workers_count, 1)
+            self.lanes = [queue.Queue(lane_max_size) for _ in range(self.workers_count)]
+        else:
+            self.lanes = [queue.Queue(self.queue_max_size)]
+        self.lane_next = 0
+        self.workers = []
+        self.lock = threading.Lock()
+        self.stopped = False
+
+        self.busy = 0
+        self.submitted = 0
+        self.processed = 0
+        self.errors = 0
+        self.rejected = 0
+        self.queue_depth_max = 0
+        self.wait_stat = TimeStat()  # Время ожидания задания в очереди
+        self.put_stat = TimeStat()  # Время блокировки постановщика из-за заполненной очереди
+        self.work_stat = TimeStat()  # Время выполнения задания
+
+    def start(self):
+        with self.lock:
+            if self.workers:
+                return
+            self.stopped = False
+            for i in range(self.workers_count):
+                lane = self.lanes[i % len(self.lanes)]
+                t = threading.Thread(target=self._run, args=(lane,), name='%s-thr-%04d' % (self.name, i + 1))
+                t.daemon = True
+                self.workers.append(t)
+                t.start()
+
+    def get_lane(self, key=None):
+        # type: (object) -> queue.Queue
+        if len(self.lanes) == 1:
+            return self.lanes[0]
+        if key is not None:
+            return self.lanes[hash(key) % len(self.lanes)]
+        # Задания без ключа порядка не требуют - по кругу
+        with self.lock:
+            self.lane_next = (self.lane_next + 1) % len(self.lanes)
+            return self.lanes[self.lane_next]
+
+    def submit(self, func, args=(), block=True, timeout=None, key=None):
+        # type: (callable, tuple, bool, float, object) -> bool
+        if self.stopped:
+            raise RuntimeError('Dispatcher %s is stopped.' % self.name)
+        if not self.workers:
+            self.start()
+        lane = self.get_lane(key)
+        ts = time()
+        try:
+            lane.put((func, args, ts), block, timeout)
+        except queue.Full:
+            with self.lock:
+                self.rejected += 1
+            return False
+        self.put_stat.add(time() - ts)
+        with self.lock:
+            self.submitted += 1
+            self.queue_depth_max = max(self.queue_depth_max, self.queue_depth)
+        return True
+
+    def _run(self, lane):
+        # type: (queue.Queue) -> None
+        while True:
+            task = lane.get()
+            try:
+                if task is None:
+                    break
+                func, args, ts = task
+                started = time()
+                self.wait_stat.add(started - ts)
+                with self.lock:
+                    self.busy += 1
+                # noinspection PyBroadException
+                try:
+                    func(*args)
+                except Exception:
+                    with self.lock:
+                        self.errors += 1
+                    if self.lgz:
+                        self.lgz.exception('Exception in %s' % threading.current_thread().name)
+                finally:
+                    self.work_stat.add(time() - started)
+                    with self.lock:
+                        self.busy -= 1
+                        self.processed += 1
+            finally:
+                lane.task_done()
+
+    def stop(self, wait=True):
+        # type: (bool) -> None
+        with self.lock:
+            if self.stopped:
+                return
+            self.stopped = True
+            workers = self.workers
+            self.workers = []
+        for i in range(len(workers)):
+            self.lanes[i % len(self.lanes)].put(None)
+        if wait:
+            for t in workers:
+                t.join()
+
+    @property
+    def queue_depth(self):
+        # type: () -> int
+        return sum(_.qsize() for _ in self.lanes)
+
+    @property
+    def lanes_depth(self):
+        # type: () -> [int]
+        return [_.qsize() for _ in self.lanes]
+
+    def stats(self):
+        # type: () -> dict
+        return {
+            'workers': self.workers_count,
+            'sharded': self.sharded,
+            'busy': self.busy,
+            'queue_depth': self.queue_depth,
+            'queue_depth_max': self.queue_depth_max,
+            'queue_max_size': self.queue_max_size,
+            'lanes_depth': self.lanes_depth if self.sharded else None,
+            'submitted': self.submitted,
+            'processed': self.processed,
+            'errors': self.errors,
+            'rejected': self.rejected,
+            'wait': self.wait_stat.as_dict(),
+            'put_wait': self.put_stat.as_dict(),
+            'work': self.work_stat.as_dict(),
+        }
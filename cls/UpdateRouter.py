@@ -0,0 +1,98 @@
+# -*- coding: UTF-8 -*-
+import threading
+
+
+def update_handler(*update_classes):
+    # Декларативная регистрация метода бота (или примеси) обработчиком обновлений указанных классов:
+    #     @update_handler(MessageEditedUpdate)
+    #     def on_edit(self, update): ...
+    def decorator(func):
+        func.tt_update_classes = update_classes
+        return func
+
+    return decorator
+
+
+def cmd_handler(*names):
+    # Декларативная регистрация метода бота (или примеси) обработчиком команд; первое имя - основное, остальные - псевдонимы:
+    #     @cmd_handler('help', 'h')
+    #     def show_help(self, update): ...
+    def decorator(func):
+        func.tt_cmd_names = names
+        return func
+
+    return decorator
+
+
+class UpdateRouter(object):
+    # Таблицы диспетчеризации, построенные однократно для класса бота:
+    # * класс обновления -> имя метода-обработчика (с учётом наследования классов обновлений);
+    # * имя команды (и псевдонима) -> имя метода-обработчика.
+    # Источники: методы cmd_handler_<имя>, словарь псевдонимов класса CMD_ALIASES,
+    # таблица обработчиков по умолчанию UPDATE_HANDLERS и декораторы update_handler / cmd_handler.
+    CMD_HANDLER_PREFIX = 'cmd_handler_'
+
+    routers = {}
+    lock = threading.Lock()
+
+    def __init__(self, bot_class):
+        # type: (type) -> None
+        self.bot_class = bot_class
+        self.update_handlers_base = list(getattr(bot_class, 'UPDATE_HANDLERS', []))
+        self.update_handlers = {}
+        self.cmd_handlers = {}
+
+        for name in dir(bot_class):
+            attr = getattr(bot_class, name, None)
+            if not callable(attr):
+                continue
+            if name.startswith(self.CMD_HANDLER_PREFIX):
+                self.cmd_handlers[name[len(self.CMD_HANDLER_PREFIX):]] = name
+            for cmd in getattr(attr, 'tt_cmd_names', None) or ():
+                self.cmd_handlers[cmd] = name
+            for update_class in getattr(attr, 'tt_update_classes', None) or ():
+                self.update_handlers_base.insert(0, (update_class, name))
+
+        for alias, cmd in (getattr(bot_class, 'CMD_ALIASES', None) or {}).items():
+            if cmd in self.cmd_handlers:
+                self.cmd_handlers[alias] = self.cmd_handlers[cmd]
+
+    @classmethod
+    def get(cls, bot_class):
+        # type: (type) -> UpdateRouter
+        router = cls.routers.get(bot_class)
+        if router is None:
+            with cls.lock:
+                router = cls.routers.get(bot_class)
+                if router is None:
+                    router = cls(bot_class)
+                    cls.routers[bot_class] = router
+        return router
+
+    @classmethod
+    def reset(cls, bot_class=None):
+        # type: (type) -> None
+        # Сброс таблиц - после динамического изменения класса бота
+        with cls.lock:
+            if bot_class is None:
+                cls.routers.clear()
+            else:
+                cls.routers.pop(bot_class, None)
+
+    def get_update_handler_name(self, update_class):
+        # type: (type) -> str or None
+        try:
+            return self.update_handlers[update_class]
+        except KeyError:
+            pass
+        name = None
+        for klass, handler_name in self.update_handlers_base:
+            if issubclass(update_class, klass):
+                name = handler_name
+                break
+        self.update_handlers[update_class] = name
+        return name
+
+    def get_cmd_handler_name(self, cmd):
+        # type: (str) -> str or None
+        return self.cmd_handlers.get(cmd)
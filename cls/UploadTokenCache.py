@@ -0,0 +1,180 @@
+# -*- coding: UTF-8 -*-
+import hashlib
+import json
+import os
+from time import time
+
+from TamTamBot.cls.BoundedStore import BoundedStore
+from TamTamBot.cls.SqliteStorage import SqliteStorage
+
+
+# noinspection SqlResolve,SqlNoDataSourceInspection,SqlDialectInspection
+class UploadTokenCache(object):
+    # Кэш результатов загрузки файлов (словарь с токеном/адресом вложения) по хэшу содержимого и типу загрузки.
+    # Хранится в БД, записи действительны ttl секунд. Повторное вложение того же содержимого не загружается заново.
+    # Файл БД может быть общим для нескольких ботов, токены привязаны к bot_id (токен одного бота другому не годится).
+    # Содержимое заранее не перечитывается: хэш bytes и строк вычисляется сразу, хэш файла берётся из сохранённых
+    # ранее по (путь, размер, время изменения), в остальных случаях хэш считается при передаче (см. hasher) и
+    # запоминается после успешной загрузки.
+
+    def __init__(self, storage, bot_id, table_name='tamtambot_upload_cache', ttl=86400):
+        # type: (SqliteStorage, int, str, float) -> None
+        self.storage = storage
+        self.bot_id = bot_id
+        self.table_name = table_name
+        self.files_table_name = '%s_file' % table_name
+        self.ttl = ttl
+        self.file_hashes = BoundedStore(10000, name='upload_file_hashes')  # (путь, размер, mtime) -> (хэш, размер)
+
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.invalidated = 0
+
+        # Таблица прежнего формата (без bot_id) удаляется
+        columns = [row[1] for row in self.storage.fetchall('PRAGMA table_info(%s)' % self.table_name)]
+        if columns and 'bot_id' not in columns:
+            self.storage.executescript('DROP TABLE IF EXISTS %s;' % self.table_name)
+        self.storage.executescript('''
+            CREATE TABLE IF NOT EXISTS %(table)s (
+                [bot_id]      INT       NOT NULL,
+                [hash]        CHAR (64) NOT NULL,
+                [upload_type] CHAR (10) NOT NULL,
+                [token]       TEXT      NOT NULL,
+                [size]        INT,
+                [created]     REAL,
+                PRIMARY KEY ([bot_id], [hash], [upload_type])
+            );
+            CREATE INDEX IF NOT EXISTS %(table)s_token ON %(table)s ([bot_id], [token]);
+            CREATE TABLE IF NOT EXISTS %(files)s (
+                [path]    TEXT      NOT NULL,
+                [size]    INT       NOT NULL,
+                [mtime]   REAL      NOT NULL,
+                [hash]    CHAR (64) NOT NULL,
+                [created] REAL,
+                PRIMARY KEY ([path], [size], [mtime])
+            );
+        ''' % {'table': self.table_name, 'files': self.files_table_name})
+
+    @staticmethod
+    def hasher():
+        # Хэш, вычисляемый при передаче содержимого
+        return hashlib.sha256()
+
+    @staticmethod
+    def file_key(path):
+        # type: (str) -> (str, int, float)
+        st = os.stat(path)
+        return os.path.abspath(path), st.st_size, st.st_mtime
+
+    def content_key(self, content):
+        # type: (object) -> (str, int) or None
+        # (хэш, размер) содержимого, если он известен без чтения файла; иначе None
+        if isinstance(content, (bytes, bytearray)):
+            return hashlib.sha256(content).hexdigest(), len(content)
+        if isinstance(content, str) and os.path.isfile(content):
+            file_key = self.file_key(content)
+            res = self.file_hashes.get(file_key)
+            if res is None:
+                row = self.storage.fetchone(
+                    'SELECT [hash] FROM %(table)s WHERE [path]=:path AND [size]=:size AND [mtime]=:mtime' % {'table': self.files_table_name},
+                    {'path': file_key[0], 'size': file_key[1], 'mtime': file_key[2]}
+                )
+                if row:
+                    res = (row[0], file_key[1])
+                    self.file_hashes.set(file_key, res)
+            return res
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+            return hashlib.sha256(content).hexdigest(), len(content)
+
+    def set_file_hash(self, path, key):
+        # type: (str, (str, int)) -> None
+        # Запоминание хэша файла, вычисленного при передаче
+        file_key = self.file_key(path)
+        if file_key[1] != key[1]:
+            return  # Файл изменился во время загрузки
+        self.file_hashes.set(file_key, key)
+        self.storage.execute(
+            'INSERT OR REPLACE INTO %(table)s ([path], [size], [mtime], [hash], [created]) VALUES (:path, :size, :mtime, :hash, :created)' %
+            {'table': self.files_table_name}, {'path': file_key[0], 'size': file_key[1], 'mtime': file_key[2], 'hash': key[0], 'created': time()}
+        )
+
+    @staticmethod
+    def is_valid(token):
+        # type: (dict) -> bool
+        return isinstance(token, dict) and bool(token) and not token.get('error_code')
+
+    def get(self, key, upload_type):
+        # type: ((str, int), str) -> dict or None
+        row = self.storage.fetchone(
+            'SELECT [token], [created] FROM %(table)s WHERE [bot_id]=:bot_id AND [hash]=:hash AND [upload_type]=:upload_type' % {'table': self.table_name},
+            {'bot_id': self.bot_id, 'hash': key[0], 'upload_type': upload_type}
+        )
+        token = None
+        if row:
+            if self.ttl and time() - row[1] > self.ttl:
+                self.delete(key, upload_type)
+            else:
+                # noinspection PyBroadException
+                try:
+                    token = json.loads(row[0])
+                except Exception:
+                    token = None
+                if not self.is_valid(token):
+                    token = None
+                    self.delete(key, upload_type)
+        if token is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.bytes_saved += key[1]
+        return token
+
+    def set(self, key, upload_type, token):
+        # type: ((str, int), str, dict) -> None
+        if not self.is_valid(token):
+            return
+        self.storage.execute(
+            'INSERT OR REPLACE INTO %(table)s ([bot_id], [hash], [upload_type], [token], [size], [created]) '
+            'VALUES (:bot_id, :hash, :upload_type, :token, :size, :created)' % {'table': self.table_name},
+            {
+                'bot_id': self.bot_id, 'hash': key[0], 'upload_type': upload_type, 'token': json.dumps(token, sort_keys=True),
+                'size': key[1], 'created': time(),
+            }
+        )
+
+    def delete(self, key, upload_type):
+        # type: ((str, int), str) -> None
+        self.storage.execute(
+            'DELETE FROM %(table)s WHERE [bot_id]=:bot_id AND [hash]=:hash AND [upload_type]=:upload_type' % {'table': self.table_name},
+            {'bot_id': self.bot_id, 'hash': key[0], 'upload_type': upload_type}
+        )
+
+    def invalidate_token(self, token):
+        # type: (dict) -> int
+        # Сброс записей с токеном, который сервер перестал принимать
+        cnt = self.storage.execute(
+            'DELETE FROM %(table)s WHERE [bot_id]=:bot_id AND [token]=:token' % {'table': self.table_name},
+            {'bot_id': self.bot_id, 'token': json.dumps(token, sort_keys=True)}
+        )
+        self.invalidated += cnt or 0
+        return cnt
+
+    def purge(self):
+        # type: () -> int
+        # Удаление просроченных записей (хэши файлов хранятся столько же)
+        if not self.ttl:
+            return 0
+        created = time() - self.ttl
+        self.storage.execute('DELETE FROM %(table)s WHERE [created]<:created' % {'table': self.files_table_name}, {'created': created})
+        return self.storage.execute('DELETE FROM %(table)s WHERE [created]<:created' % {'table': self.table_name}, {'created': created})
+
+    def stats(self):
+        # type: () -> dict
+        total = self.hits + self.misses
+        row = self.storage.fetchone('SELECT COUNT(*) FROM %(table)s WHERE [bot_id]=:bot_id' % {'table': self.table_name}, {'bot_id': self.bot_id})
+        return {
+            'size': row[0] if row else 0, 'ttl': self.ttl, 'hits': self.hits, 'misses': self.misses,
+            'hit_ratio': round(self.hits / total, 4) if total else 0.0, 'bytes_saved': self.bytes_saved, 'invalidated': self.invalidated,
+        }
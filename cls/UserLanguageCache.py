@@ -0,0 +1,149 @@
+# -*- coding: UTF-8 -*-
+import atexit
+import threading
+
+from TamTamBot.cls.BoundedStore import BoundedStore
+from TamTamBot.cls.SqliteStorage import SqliteStorage
+
+
+# noinspection SqlResolve,SqlNoDataSourceInspection,SqlDialectInspection
+class UserLanguageCache(object):
+    # LRU-кэш языков пользователей (user_id -> язык) с ограничением времени жизни записей (на основе BoundedStore).
+    # Отсутствие записи в БД тоже кэшируется (значение None).
+    # Изменения копятся в памяти и пачками записываются в БД фоновым потоком (write-behind)
+    # одним UPSERT-ом; "мягкая" установка языка не перезаписывает уже имеющееся значение.
+    MISSING = object()
+
+    def __init__(self, storage, table_name, max_size=100000, ttl=3600, flush_period=1.0, lgz=None):
+        # type: (SqliteStorage, str, int, float, float, object) -> None
+        self.storage = storage
+        self.table_name = table_name
+        self.flush_period = flush_period
+        self.lgz = lgz
+
+        self.lock = threading.Lock()
+        self.data = BoundedStore(max_size, ttl, name='user_language')  # user_id -> язык
+        self.dirty = {}  # user_id -> (language, soft)
+        self.flush_event = threading.Event()
+        self.stopped = False
+        self.flusher = None
+
+        self.flushes = 0
+        self.written = 0
+
+        self.sql_select = 'SELECT [language] FROM %(table)s WHERE [user_id]=:user_id' % {'table': self.table_name}
+        self.sql_upsert = (
+            'INSERT INTO %(table)s ([user_id], [language]) VALUES (:user_id, :language) '
+            'ON CONFLICT([user_id]) DO UPDATE SET [language]=excluded.[language]' % {'table': self.table_name}
+        )
+        self.sql_insert_soft = (
+            'INSERT INTO %(table)s ([user_id], [language]) VALUES (:user_id, :language) '
+            'ON CONFLICT([user_id]) DO NOTHING' % {'table': self.table_name}
+        )
+        atexit.register(self.close)
+
+    def get(self, user_id):
+        # type: (int) -> str or None
+        # Язык пользователя или None, если он не задан
+        language = self.data.get(user_id, self.MISSING)
+        if language is not self.MISSING:
+            return language
+        with self.lock:
+            pending = self.dirty.get(user_id)
+        if pending is not None and not pending[1]:
+            self.data.set(user_id, pending[0])
+            return pending[0]
+        row = self.storage.fetchone(self.sql_select, {'user_id': user_id})
+        language = row[0] if row else None
+        with self.lock:
+            pending = self.dirty.get(user_id)
+            if pending is not None and (not pending[1] or language is None):
+                language = pending[0]
+            self.data.set(user_id, language)
+        return language
+
+    def set(self, user_id, language, soft=False):
+        # type: (int, str, bool) -> None
+        with self.lock:
+            if soft:
+                cached = self.data.get(user_id, self.MISSING)
+                if cached is not self.MISSING and cached is not None:
+                    return
+                if user_id not in self.dirty:
+                    self.dirty[user_id] = (language, True)
+                if cached is not self.MISSING:
+                    self.data.set(user_id, language)
+            else:
+                self.dirty[user_id] = (language, False)
+                self.data.set(user_id, language)
+        self._start_flusher()
+
+    def _start_flusher(self):
+        if self.flusher is None and not self.stopped:
+            with self.lock:
+                if self.flusher is None:
+                    self.flusher = threading.Thread(target=self._run, name='lang-cache-flusher')
+                    self.flusher.daemon = True
+                    self.flusher.start()
+
+    def _run(self):
+        while not self.stopped:
+            self.flush_event.wait(self.flush_period)
+            self.flush_event.clear()
+            # noinspection PyBroadException
+            try:
+                self.flush()
+            except Exception:
+                if self.lgz:
+                    self.lgz.exception('Exception')
+
+    def flush(self):
+        # type: () -> int
+        with self.lock:
+            if not self.dirty:
+                return 0
+            dirty = self.dirty
+            self.dirty = {}
+        hard = [{'user_id': k, 'language': v[0]} for k, v in dirty.items() if not v[1]]
+        soft = [{'user_id': k, 'language': v[0]} for k, v in dirty.items() if v[1]]
+        try:
+            if hard:
+                self.storage.executemany(self.sql_upsert, hard)
+            if soft:
+                self.storage.executemany(self.sql_insert_soft, soft)
+        except Exception:
+            # Возвращаем несохранённое, не затирая более свежие изменения
+            with self.lock:
+                for k, v in dirty.items():
+                    self.dirty.setdefault(k, v)
+            raise
+        self.flushes += 1
+        self.written += len(dirty)
+        if self.lgz:
+            self.lgz.debug('Languages flushed: %s' % len(dirty))
+        return len(dirty)
+
+    def invalidate(self, user_id=None):
+        # type: (int) -> None
+        if user_id is None:
+            self.data.clear()
+        else:
+            self.data.pop(user_id)
+
+    def close(self):
+        self.stopped = True
+        self.flush_event.set()
+        if self.flusher is not None and self.flusher is not threading.current_thread():
+            self.flusher.join()
+        # noinspection PyBroadException
+        try:
+            self.flush()
+        except Exception:
+            if self.lgz:
+                self.lgz.exception('Exception')
+
+    def stats(self):
+        # type: () -> dict
+        res = self.data.stats()
+        res.update({'pending': len(self.dirty), 'flushes': self.flushes, 'written': self.written})
+        return res
@@ -2,4 +2,24 @@
 from .CallbackButtonCmd import CallbackButtonCmd
 from .ChatExt import ChatExt
 from .UpdateCmn import UpdateCmn
-from .ChatActionRequestRepeater import ChatActionRequestRepeater
+from .ChatActionScheduler import ChatActionScheduler
+from .UpdateDispatcher import UpdateDispatcher
+from .PollingTuner import PollingTuner
+from .SqliteStorage import SqliteStorage
+from .UserLanguageCache import UserLanguageCache
+from .UpdateRouter import UpdateRouter, update_handler, cmd_handler
+from .BoundedStore import BoundedStore
+from .ChatMembershipCache import ChatMembershipCache
+from .ChatsAdminIndex import ChatsAdminIndex
+from .RateLimiter import RateLimiter
+from .PageIterator import PageIterator
+from .MessageCache import MessageCache
+from .ApiRateLimiter import ApiRateLimiter
+from .RateLimitedApi import RateLimitedApi
+from .OutboundQueue import OutboundQueue
+from .AdminAlerter import AdminAlerter
+from .BroadcastJournal import BroadcastJournal
+from .MultipartStream import MultipartStream
+from .UploadTokenCache import UploadTokenCache
+from .ChunkedUpload import ChunkedUpload, ChunkedUploadError
+from .AttachmentReadiness import AttachmentReadiness
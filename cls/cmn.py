@@ -1,5 +1,6 @@
 # -*- coding: UTF-8 -*-
 import re
+import threading
 
 
 class TtUtils:
@@ -12,3 +13,29 @@ class TtUtils:
         found = re.match('.*(%s%s=(.+?)%s).*' % ('\\' + ends[0], parameter, '\\' + ends[1]), content)
         if found:
             return found.group(2)
+
+
+class TimeStat(object):
+    # Накопитель статистики по длительностям (сек.): количество, сумма, максимум
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        # type: (float) -> None
+        with self.lock:
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+
+    @property
+    def avg(self):
+        # type: () -> float
+        return self.total / self.count if self.count else 0.0
+
+    def as_dict(self):
+        # type: () -> dict
+        return {'count': self.count, 'avg': round(self.avg, 4), 'max': round(self.max, 4)}
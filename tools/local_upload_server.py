@@ -0,0 +1,163 @@
+# -*- coding: UTF-8 -*-
+import json
+import os
+import re
+import sys
+import threading
+import uuid
+
+from six.moves import BaseHTTPServer, socketserver
+
+
+class LocalUploadServer(object):
+    # Локальная замена сервера загрузки файлов для отладки загрузки (не входит в пакет).
+    # Запуск как скрипта - проверка ChunkedUpload и MultipartStream с ошибками сервера: python tools/local_upload_server.py
+    # Принимает обычную загрузку (multipart/form-data) и загрузку частями (Content-Range):
+    # на промежуточную часть отвечает 201 с диапазоном принятых байт, на последнюю - 200 с {"token": ...}.
+    # fail_every - каждый N-й запрос завершается ошибкой 503 (проверка повтора частей).
+    # Полностью полученные файлы доступны в received: путь загрузки -> bytes.
+
+    def __init__(self, host='127.0.0.1', port=0, fail_every=0):
+        # type: (str, int, int) -> None
+        self.fail_every = fail_every
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.failed = 0
+        self.parts = {}  # путь загрузки -> {смещение: bytes}
+        self.received = {}  # путь загрузки -> bytes
+        self.tokens = {}  # путь загрузки -> токен
+
+        server = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def reply(self, status, body, content_type='application/json'):
+                body = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def read_body(self):
+                # type: () -> bytes
+                if self.headers.get('Transfer-Encoding', '').lower() != 'chunked':
+                    return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                # Поблочная передача (тело неизвестного размера, см. MultipartStream)
+                res = []
+                while True:
+                    size = int(self.rfile.readline().split(b';')[0].strip() or b'0', 16)
+                    if not size:
+                        while self.rfile.readline().strip():  # Завершающие заголовки
+                            pass
+                        break
+                    res.append(self.rfile.read(size))
+                    self.rfile.readline()
+                return b''.join(res)
+
+            # noinspection PyPep8Naming
+            def do_POST(self):
+                data = self.read_body()
+                status, body, content_type = server.handle(self.path, self.headers.get('Content-Range'), data)
+                self.reply(status, body, content_type)
+
+        class Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        self.httpd = Server((host, port), Handler)
+        self.thread = None
+
+    @property
+    def base_url(self):
+        # type: () -> str
+        return 'http://%s:%s' % self.httpd.server_address[:2]
+
+    def new_url(self):
+        # type: () -> str
+        # Адрес для одной загрузки (аналог UploadEndpoint.url)
+        return '%s/upload/%s' % (self.base_url, uuid.uuid4().hex)
+
+    def handle(self, path, content_range, data):
+        # type: (str, str, bytes) -> (int, str, str)
+        with self.lock:
+            self.requests += 1
+            if self.fail_every and self.requests % self.fail_every == 0:
+                self.failed += 1
+                return 503, '{"error_code": "service.unavailable"}', 'application/json'
+            if not content_range:
+                self.received[path] = data
+                return 200, json.dumps({'token': self.get_token(path)}), 'application/json'
+            m = re.match(r'bytes (\d+)-(\d+)/(\d+)', content_range)
+            if not m:
+                return 400, '{"error_code": "bad.range"}', 'application/json'
+            start, end, total = int(m.group(1)), int(m.group(2)), int(m.group(3))
+            if end - start + 1 != len(data) or end >= total:
+                return 400, '{"error_code": "bad.range"}', 'application/json'
+            parts = self.parts.setdefault(path, {})
+            parts[start] = data
+            # Смещение, до которого файл получен без пропусков
+            offset = 0
+            while offset in parts:
+                offset += len(parts[offset])
+            if offset < total:
+                return 201, '0-%s/%s' % (offset - 1, total) if offset else '', 'text/plain'
+            self.received[path] = b''.join(parts[_] for _ in sorted(parts))
+            self.parts.pop(path)
+            return 200, json.dumps({'token': self.get_token(path)}), 'application/json'
+
+    def get_token(self, path):
+        # type: (str) -> str
+        return self.tokens.setdefault(path, uuid.uuid4().hex)
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.httpd.serve_forever, name='local-upload-server')
+            self.thread.daemon = True
+            self.thread.start()
+        return self
+
+    def stop(self):
+        if self.thread is not None:
+            self.httpd.shutdown()
+            self.thread = None
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def stats(self):
+        # type: () -> dict
+        return {'requests': self.requests, 'failed': self.failed, 'in_progress': len(self.parts), 'received': len(self.received)}
+
+
+def check():
+    # Загрузка через сервер, отвечающий ошибкой на каждый третий запрос
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+    import requests
+    from TamTamBot.cls.ChunkedUpload import ChunkedUpload
+    from TamTamBot.cls.MultipartStream import MultipartStream
+
+    content = os.urandom(1000003)
+    session = requests.Session()
+    with LocalUploadServer(fail_every=3) as server:
+        url = server.new_url()
+        with ChunkedUpload(session, url, content, 'check.bin', chunk_size=100000, retry_delay=0.01) as cu:
+            res = cu.upload()
+        assert res.get('token') and server.received[url[len(server.base_url):]] == content, 'chunked upload'
+        print('Chunked upload: %s; server: %s' % (cu.stats(), server.stats()))
+
+        server.fail_every = 0
+        url = server.new_url()
+        with MultipartStream(iter([content[:500000], content[500000:]]), filename='check.bin') as stream:
+            rdf = session.post(url, data=stream.body, headers={'Content-Type': stream.content_type})
+        assert rdf.status_code == 200 and content in server.received[url[len(server.base_url):]], 'streamed multipart upload'
+        print('Streamed multipart upload: %s bytes' % stream.sent)
+
+
+if __name__ == '__main__':
+    check()